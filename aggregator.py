@@ -0,0 +1,76 @@
+# aggregator.py
+import threading
+from datetime import datetime, timezone
+
+
+class WindowAggregator:
+    """
+    Tumbling-window summaries of Influx points. Points with the same measurement and
+    tags fall into windows of `window` seconds aligned to the epoch; each closed window
+    becomes one point at the window start, where every numeric field carries the mean
+    plus <field>_min and <field>_max, and `count` is the number of readings. Keeping
+    the mean under the original field name means existing queries keep working.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        # (measurement, tags) -> [window_start, tags, count, {field: [sum, min, max]}]
+        self._open = {}
+        self._lock = threading.Lock()
+        self._counts = {"readings": 0, "windows": 0}
+
+    def add(self, point, now):
+        """Fold a point into its window; returns any points for windows this one closed."""
+        tags = point["tags"]
+        key = (point["measurement"], tuple(sorted(tags.items())))
+        start = now - now % self.window
+        closed = []
+        with self._lock:
+            self._counts["readings"] += 1
+            current = self._open.get(key)
+            if current is not None and current[0] != start:
+                closed.append(self._close(key, current))
+                current = None
+            if current is None:
+                current = self._open[key] = [start, tags, 0, {}]
+            current[2] += 1
+            for field, value in point["fields"].items():
+                totals = current[3].get(field)
+                if totals is None:
+                    current[3][field] = [value, value, value]
+                else:
+                    totals[0] += value
+                    if value < totals[1]:
+                        totals[1] = value
+                    if value > totals[2]:
+                        totals[2] = value
+        return closed
+
+    def expire(self, now):
+        """Close every window that ended before `now` (sensors that went quiet)."""
+        with self._lock:
+            ended = [key for key, current in self._open.items() if current[0] + self.window <= now]
+            return [self._close(key, self._open[key]) for key in ended]
+
+    def _close(self, key, current):
+        """Turn an open window into a point; caller holds _lock."""
+        del self._open[key]
+        start, tags, count, totals = current
+        fields = {"count": count}
+        for field, (total, low, high) in totals.items():
+            fields[field] = total / count
+            fields[f"{field}_min"] = low
+            fields[f"{field}_max"] = high
+        self._counts["windows"] += 1
+        return {
+            "measurement": key[0],
+            "tags": dict(tags),
+            "time": datetime.fromtimestamp(start, timezone.utc).isoformat(),
+            "fields": fields,
+        }
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counts)
+            stats["open"] = len(self._open)
+        return stats
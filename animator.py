@@ -0,0 +1,172 @@
+# animator.py
+import logging
+import threading
+import time
+
+# LED animations are declared as timelines: a list of (offset_seconds, device_id, color_hex)
+# steps plus the colours to restore once the timeline finishes. A single engine thread
+# sends each step when it falls due, so callers (scheduler, MQTT handlers) return at once.
+
+
+class Animation:
+    def __init__(self, name, steps, restore=None, duration=None):
+        self.name = name
+        self.steps = sorted(((float(at), int(dev), color) for at, dev, color in steps), key=lambda s: s[0])
+        # Restore happens at `duration`, which defaults to the last step
+        self.duration = duration if duration is not None else (self.steps[-1][0] if self.steps else 0.0)
+        self.restore = {int(dev): color for dev, color in (restore or {}).items()}
+        self.devices = {dev for _, dev, _ in self.steps} | set(self.restore)
+        self.started = None
+        self.index = 0
+        self.cancelled = False
+        self.done = threading.Event()
+
+    def next_due(self):
+        if self.index < len(self.steps):
+            return self.started + self.steps[self.index][0]
+        return self.started + self.duration
+
+    def wait(self, timeout=None):
+        """Block until the animation has finished or been cancelled."""
+        return self.done.wait(timeout)
+
+
+class Timeline:
+    """Builder for animation steps: blink N, fade, hold."""
+
+    def __init__(self):
+        self.steps = []
+        self.offset = 0.0
+
+    def set(self, device_id, color_hex, hold=0.0):
+        self.steps.append((self.offset, device_id, color_hex))
+        self.offset += hold
+        return self
+
+    def wait(self, seconds):
+        self.offset += seconds
+        return self
+
+    def fade(self, device_id, from_hex, to_hex, duration, frames=10):
+        start = [int(from_hex[i:i + 2], 16) for i in (0, 2, 4)]
+        end = [int(to_hex[i:i + 2], 16) for i in (0, 2, 4)]
+        for frame in range(1, frames + 1):
+            mix = [round(a + (b - a) * frame / frames) for a, b in zip(start, end)]
+            self.set(device_id, "{:02X}{:02X}{:02X}".format(*mix), hold=duration / frames)
+        return self
+
+    def build(self, name, restore=None):
+        return Animation(name, self.steps, restore, duration=self.offset)
+
+
+def blink_animation(count, blink_color, status_id, status_before, eyes_id, eyes_before):
+    """The hourly blink: both LEDs off, `count` flashes of blink_color, then restore."""
+    timeline = Timeline()
+    timeline.set(status_id, "000000", hold=0.2).set(eyes_id, "000000", hold=2)
+    for _ in range(count):
+        timeline.set(status_id, blink_color, hold=0.2).set(eyes_id, blink_color, hold=1)
+        timeline.set(status_id, "000000", hold=0.2).set(eyes_id, "000000", hold=0.5)
+    return timeline.build(f"blink x{count}", restore={status_id: status_before, eyes_id: eyes_before})
+
+
+class Animator:
+    def __init__(self, send):
+        self._send = send
+        self._cond = threading.Condition()
+        self._active = []
+        self._thread = None
+        self._wakeup = None
+
+    def attach_driver(self, wakeup):
+        """
+        Drive the engine from outside (the asyncio runtime) instead of its own thread:
+        wakeup() is called when timing changes, and the driver calls run_due().
+        """
+        self._wakeup = wakeup
+
+    def play(self, animation):
+        """
+        Start an animation. Any running animation on the same LEDs is stopped; the new
+        one inherits its restore colours so the LEDs still end on the pre-animation state.
+        """
+        with self._cond:
+            for other in list(self._active):
+                shared = other.devices & animation.devices
+                if not shared:
+                    continue
+                for dev in shared:
+                    if dev in other.restore:
+                        animation.restore[dev] = other.restore[dev]
+                self._finish(other, skip=shared)
+                logging.info(f"[Animator] '{other.name}' replaced by '{animation.name}'")
+
+            animation.started = time.monotonic()
+            self._active.append(animation)
+            self._cond.notify()
+            if self._wakeup is not None:
+                self._wakeup()
+            elif self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="animator", daemon=True)
+                self._thread.start()
+        return animation
+
+    def preempt(self, device_id):
+        """
+        A colour was set explicitly on device_id: stop animations using it. Other LEDs in
+        those animations are restored; device_id keeps the colour that was just set.
+        """
+        device_id = int(device_id)
+        with self._cond:
+            for animation in list(self._active):
+                if device_id in animation.devices:
+                    self._finish(animation, skip={device_id})
+                    logging.info(f"[Animator] '{animation.name}' preempted by update to {device_id}")
+
+    def cancel_all(self, restore=True):
+        with self._cond:
+            for animation in list(self._active):
+                self._finish(animation, skip=set() if restore else animation.devices)
+
+    def is_animating(self, device_id=None):
+        with self._cond:
+            if device_id is None:
+                return bool(self._active)
+            return any(int(device_id) in a.devices for a in self._active)
+
+    def _finish(self, animation, skip=()):
+        """Send restore colours (except for `skip`) and retire the animation; caller holds _cond."""
+        for dev, color in animation.restore.items():
+            if dev not in skip:
+                self._send(dev, color)
+        animation.cancelled = animation.index < len(animation.steps)
+        self._active.remove(animation)
+        animation.done.set()
+
+    def run_due(self):
+        """Send every step that is due; returns the next deadline (monotonic) or None if idle."""
+        with self._cond:
+            try:
+                now = time.monotonic()
+                for animation in list(self._active):
+                    while animation.index < len(animation.steps) and animation.next_due() <= now:
+                        _, dev, color = animation.steps[animation.index]
+                        animation.index += 1
+                        self._send(dev, color)
+                    if animation.index >= len(animation.steps) and animation.next_due() <= now:
+                        self._finish(animation)
+                        logging.info(f"[Animator] '{animation.name}' finished, LED colors restored")
+            except Exception as e:
+                logging.error(f"[Animator] Error running animation step: {e}")
+
+            if not self._active:
+                return None
+            return min(a.next_due() for a in self._active)
+
+    def _run(self):
+        while True:
+            deadline = self.run_due()
+            with self._cond:
+                if deadline is None and not self._active:
+                    self._cond.wait()
+                elif deadline is not None:
+                    self._cond.wait(max(0.0, deadline - time.monotonic()))
@@ -0,0 +1,428 @@
+# asyncruntime.py
+"""
+Alternative runtime (python ninja2mqtt.py --asyncio): serial I/O, MQTT, the scheduler,
+LED animations and the Influx/Pushover sinks all run as tasks on one event loop.
+
+The handlers are the same ones the threaded runtime uses; this module only replaces the
+threads that drive them:
+  - each cape's serial fd is read with loop.add_reader; the readers stop reading while
+    the shared frame queue is full and resume once it has drained to half (backpressure)
+  - paho's socket is driven by the loop (add_reader/add_writer + loop_misc) instead of
+    loop_start()'s network thread
+  - the timer service (LED schedule, animation steps, window flushes) runs from one task
+    that sleeps until the next deadline
+  - Influx and Pushover use aiohttp with a pooled session when it is installed, and
+    fall back to the blocking clients in a worker thread otherwise
+"""
+import asyncio
+import logging
+import os
+import socket
+import threading
+import time
+from functools import partial
+
+import paho.mqtt.client as mqtt
+
+import influxhandler
+import metrics
+import mqtthandler
+import notifier
+import scheduler
+import serialhandler
+from timerservice import timers
+from config import MQTT_BROKER, MQTT_PORT, MQTT_RECONNECT_MIN_DELAY, MQTT_RECONNECT_MAX_DELAY
+from config import INFLUX_HOST, INFLUX_PORT, INFLUX_DB, INFLUX_BATCH_SIZE, INFLUX_FLUSH_INTERVAL
+from config import NOTIFY_TIMEOUT, SERIAL_QUEUE_SIZE, SERIAL_WRITE_GAP, SERIAL_STALL_SECONDS
+from config import METRICS_TOPIC, METRICS_INTERVAL
+
+INFLUX_WRITE_URL = f"http://{INFLUX_HOST}:{INFLUX_PORT}/write"
+PROCESS_YIELD_EVERY = 32  # frames handled back to back before letting other tasks run
+
+_reader_pauses = metrics.counter("serial_reader_paused")
+
+
+def _wakeup_event(loop):
+    """An Event plus a wakeup() that may be called from any thread."""
+    event = asyncio.Event()
+
+    def wakeup():
+        loop.call_soon_threadsafe(event.set)
+
+    return event, wakeup
+
+
+async def _wait(event, timeout):
+    try:
+        await asyncio.wait_for(event.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    event.clear()
+
+
+# --- Serial ---
+
+class _SerialReader:
+    """
+    Reads a cape's serial fd when it is readable and queues complete (cape, line) pairs.
+    Failures, stalls and reopening go through the cape's SerialLink, with the retries
+    scheduled on the loop.
+    """
+
+    def __init__(self, loop, cape, frames):
+        self.loop = loop
+        self.cape = cape
+        self.link = cape.link
+        self.frames = frames
+        self.framer = serialhandler.LineFramer()
+        self.fd = None
+        self.paused = False       # frame queue full (backpressure)
+        self.backing_off = False  # pausing after a read error
+        self._reading_fd = None
+        # the writer may drop the link too; pick that up on the loop
+        self.link.on_drop = lambda cape: loop.call_soon_threadsafe(self._reconnect_later)
+        self._connect()
+        if SERIAL_STALL_SECONDS:
+            self.loop.call_later(SERIAL_STALL_SECONDS, self._check_stall)
+
+    def _connect(self):
+        if not self.link.is_open and not self.link.try_open():
+            self.loop.call_later(self.link.retry_in(), self._connect)
+            return
+        self.fd = self.cape.ser.fileno()
+        self.framer = serialhandler.LineFramer()
+        self.backing_off = False
+        self._sync_reader()
+
+    def _reconnect_later(self):
+        if self.fd is None:
+            return  # already waiting for a reopen
+        self.fd = None
+        self._sync_reader()
+        self.loop.call_later(self.link.retry_in(), self._connect)
+
+    def _sync_reader(self):
+        """Register the fd with the loop only while there is a port and nothing holds reads back."""
+        wanted = None if self.paused or self.backing_off else self.fd
+        if wanted == self._reading_fd:
+            return
+        if self._reading_fd is not None:
+            self.loop.remove_reader(self._reading_fd)
+        if wanted is not None:
+            self.loop.add_reader(wanted, self._on_readable)
+        self._reading_fd = wanted
+
+    def _on_readable(self):
+        try:
+            chunk = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self._failed(e)
+            return
+        if not chunk:
+            self._failed(EOFError("end of file on the serial port"))
+            return
+
+        self.link.received()
+        for frame in self.framer.feed(chunk):
+            serialhandler.capture_frame(self.cape, frame)
+            self.frames.put_nowait((self.cape, frame))
+            serialhandler.record_frame_read()
+        if self.frames.qsize() >= SERIAL_QUEUE_SIZE:
+            self.pause()
+
+    def _failed(self, error):
+        pause = self.link.failed(error)
+        if not self.link.is_open:
+            self._reconnect_later()
+            return
+        self.backing_off = True
+        self._sync_reader()
+        self.loop.call_later(pause, self._end_backoff)
+
+    def _end_backoff(self):
+        self.backing_off = False
+        self._sync_reader()
+
+    def _check_stall(self):
+        if not self.paused and self.link.check_stall():
+            self._reconnect_later()
+        last_rx = self.link.last_rx or time.monotonic()
+        self.loop.call_later(max(1.0, last_rx + SERIAL_STALL_SECONDS - time.monotonic()), self._check_stall)
+
+    def pause(self):
+        if not self.paused:
+            self.paused = True
+            _reader_pauses.inc()
+            self._sync_reader()
+            logging.debug(f"[Async] Frame queue full, serial reads paused ({self.cape.name})")
+
+    def resume(self):
+        if self.paused:
+            self.paused = False
+            self._sync_reader()
+
+    def close(self):
+        self.fd = None
+        self._sync_reader()
+
+
+async def _process_frames(client, frames, readers):
+    handled = 0
+    while True:
+        cape, raw = await frames.get()
+        serialhandler.process_frame(client, raw, cape)
+        if frames.qsize() <= SERIAL_QUEUE_SIZE // 2:
+            for reader in readers:
+                if reader.paused:
+                    reader.resume()
+        handled += 1
+        if handled % PROCESS_YIELD_EVERY == 0:
+            # a burst never empties the queue, so give MQTT I/O and timers a turn
+            await asyncio.sleep(0)
+
+
+async def _write_serial(cape, event):
+    while True:
+        # while the link is down, writes wait in the cape's queue (or were dropped, per SERIAL_OUTAGE_WRITES)
+        command = serialhandler.pop_next_write(cape) if cape.ser is not None else None
+        if command is None:
+            await _wait(event, None)
+            continue
+        try:
+            delay = serialhandler.write_command(cape, command)
+        except Exception as e:
+            logging.error(f"Serial write error ({cape.name}): {e}")
+            serialhandler.requeue_write(cape, command)
+            delay = max(cape.link.failed(e, "write"), SERIAL_WRITE_GAP)
+        await asyncio.sleep(delay)
+
+
+async def run_ingest(mqtt_client, capes=None):
+    """Serial readers, frame processing and a paced serial writer per cape on the running loop."""
+    loop = asyncio.get_running_loop()
+    capes = capes or serialhandler.capes
+    frames = asyncio.Queue()  # bounded by pausing the readers at SERIAL_QUEUE_SIZE
+    readers = [_SerialReader(loop, cape, frames) for cape in capes]
+    writers = []
+    for cape in capes:
+        write_event, wakeup = _wakeup_event(loop)
+        serialhandler.attach_writer(cape, wakeup)
+        writers.append(_write_serial(cape, write_event))
+    try:
+        await asyncio.gather(_process_frames(mqtt_client, frames, readers), *writers)
+    finally:
+        for reader in readers:
+            reader.close()
+
+
+# --- MQTT ---
+
+class _PahoLoopAdapter:
+    """
+    Drives paho's socket from the event loop instead of loop_start()'s network thread.
+    connect() runs in a worker thread, so socket callbacks from there are handed to the loop.
+    """
+
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def _on_loop(self, func, *args):
+        if threading.get_ident() == self.loop_thread:
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def on_socket_open(self, client, userdata, sock):
+        self._on_loop(self.loop.add_reader, sock, client.loop_read)
+
+    def on_socket_close(self, client, userdata, sock):
+        self._on_loop(self.loop.remove_reader, sock)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self._on_loop(self.loop.add_writer, sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self._on_loop(self.loop.remove_writer, sock)
+
+
+async def _run_mqtt(client):
+    loop = asyncio.get_running_loop()
+    _PahoLoopAdapter(loop, client)
+    delay = MQTT_RECONNECT_MIN_DELAY
+    while True:
+        try:
+            # resolve and connect off the loop: both block, for up to the socket timeout
+            # while the broker is unreachable
+            infos = await loop.getaddrinfo(MQTT_BROKER, MQTT_PORT, type=socket.SOCK_STREAM)
+            await loop.run_in_executor(None, partial(client.connect, infos[0][4][0], MQTT_PORT, keepalive=60))
+            while client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+                if client.is_connected():
+                    delay = MQTT_RECONNECT_MIN_DELAY
+                await asyncio.sleep(1)
+        except (OSError, ValueError) as e:
+            logging.warning(f"[MQTTHandler] Connection to {MQTT_BROKER}:{MQTT_PORT} failed: {e}")
+        logging.info(f"[MQTTHandler] Reconnecting in {delay}s")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, MQTT_RECONNECT_MAX_DELAY)
+
+
+async def _publish_metrics(client):
+    while True:
+        await asyncio.sleep(METRICS_INTERVAL)
+        metrics.publish_snapshot(client, METRICS_TOPIC)
+
+
+# --- Scheduler and LEDs ---
+
+async def _run_timers(event):
+    logging.info("[Scheduler] Starting timer task")
+    scheduler.schedule_jobs()
+    while True:
+        event.clear()
+        deadline = timers.run_due()
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        await _wait(event, timeout)
+
+
+# --- Sinks ---
+
+async def _open_http_session():
+    try:
+        import aiohttp
+    except ImportError:
+        logging.info("[Async] aiohttp not installed, Influx/Pushover use blocking clients in a worker thread")
+        return None
+    connect_timeout, read_timeout = NOTIFY_TIMEOUT
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit_per_host=2, keepalive_timeout=60),
+        timeout=aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout),
+    )
+
+
+async def _run_influx(event, http):
+    loop = asyncio.get_running_loop()
+
+    async def write(points, spool=True):
+        started = time.monotonic()
+        ok = False
+        try:
+            if http is not None:
+                body = influxhandler.to_line_protocol(points).encode("utf-8")
+                async with http.post(INFLUX_WRITE_URL, params={"db": INFLUX_DB}, data=body) as response:
+                    if response.status >= 300:
+                        raise RuntimeError(f"HTTP {response.status}: {await response.text()}")
+            else:
+                await loop.run_in_executor(None, lambda: influxhandler.get_client().write_points(points))
+            ok = True
+        except Exception as e:
+            logging.error(f"[Influx] Write operation failed{', spooling' if spool else ''} {len(points)} points: {e}")
+        influxhandler.record_flush(points, ok, time.monotonic() - started, spool)
+        return ok
+
+    logging.info("[Influx] Async writer started")
+    while True:
+        await _wait(event, INFLUX_FLUSH_INTERVAL)
+        ok = True
+        while ok:
+            batch = influxhandler.drain_points()
+            if not batch:
+                break
+            ok = await write(batch)
+
+        if ok and influxhandler.replay_due():
+            # Database is reachable, so drain anything left over from an outage
+            points = influxhandler.read_spool()
+            written = 0
+            for i in range(0, len(points), INFLUX_BATCH_SIZE):
+                if not await write(points[i:i + INFLUX_BATCH_SIZE], spool=False):
+                    break
+                written = min(i + INFLUX_BATCH_SIZE, len(points))
+            influxhandler.spool_replayed(points, written)
+
+
+async def _run_notifier(event, http):
+    loop = asyncio.get_running_loop()
+    in_flight = set()
+    blocking = {}
+
+    def blocking_post(title, message):
+        if "session" not in blocking:
+            import requests
+            blocking["session"] = requests.Session()
+        response = blocking["session"].post(notifier.PUSHOVER_URL, data=notifier.pushover_form(title, message),
+                                            timeout=NOTIFY_TIMEOUT)
+        response.raise_for_status()
+
+    async def post(title, message):
+        started = time.perf_counter()
+        ok = False
+        try:
+            if http is not None:
+                async with http.post(notifier.PUSHOVER_URL, data=notifier.pushover_form(title, message)) as response:
+                    response.raise_for_status()
+            else:
+                await loop.run_in_executor(None, blocking_post, title, message)
+            ok = True
+        except Exception as e:
+            logging.error(f"Failed to send Pushover notification: {e}")
+        notifier.record_post(ok, time.perf_counter() - started)
+
+    def start_post(title, message):
+        task = loop.create_task(post(title, message))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+
+    dispatcher = notifier.make_dispatcher(start_post)
+    while True:
+        deadline = dispatcher.next_deadline()
+        await _wait(event, None if deadline is None else max(0.0, deadline - time.monotonic()))
+        try:
+            now = time.monotonic()
+            for category, title, message in notifier.drain_notifications():
+                dispatcher.handle(category, title, message, now)
+            dispatcher.expire(time.monotonic())
+        except Exception as e:
+            logging.error(f"[Notifier] Dispatcher error: {e}")
+
+
+# --- Entry point ---
+
+async def _main():
+    loop = asyncio.get_running_loop()
+    client = mqtthandler.create_mqtt_client()
+    http = await _open_http_session()
+
+    # Attach the loop-driven replacements before any task can send, so none of the
+    # handlers falls back to starting its own thread
+    timer_event, wakeup = _wakeup_event(loop)
+    timers.attach_driver(wakeup)
+    influx_event, wakeup = _wakeup_event(loop)
+    influxhandler.attach_writer(wakeup)
+    notifier_event, wakeup = _wakeup_event(loop)
+    notifier.attach_dispatcher(wakeup)
+
+    try:
+        await asyncio.gather(
+            run_ingest(client),
+            _run_mqtt(client),
+            _run_timers(timer_event),
+            _run_influx(influx_event, http),
+            _run_notifier(notifier_event, http),
+            _publish_metrics(client),
+        )
+    finally:
+        if http is not None:
+            await http.close()
+
+
+def run():
+    """Run the bridge on one event loop; init_serial has already tried to open the ports."""
+    logging.info("[Async] Starting asyncio runtime")
+    asyncio.run(_main())
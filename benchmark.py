@@ -0,0 +1,230 @@
+# benchmark.py
+"""
+End-to-end ingest benchmark: a NinjaCape emulator on a pty feeds the real serial
+reader/processing pipeline, publishing into an in-process broker stand-in.
+
+    python benchmark.py --rate 50 --duration 10
+    python benchmark.py --find-max
+    python benchmark.py --startup      # time-to-first-publish and steady-state RSS
+    python benchmark.py --asyncio      # same ingest path driven by the asyncio runtime
+"""
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import serial
+
+import emulator
+import historyhandler
+import influxhandler
+import notifier
+import serialhandler
+from config import BAUD_RATE
+
+
+class NullInfluxClient:
+    """Dry-run sink so the benchmark never talks to a real database."""
+
+    def write_points(self, points):
+        return True
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+_active_broker = None
+
+
+class _ClientProxy:
+    """Lets each run record into a fresh broker stand-in while the pipeline keeps running."""
+
+    def __getattr__(self, name):
+        return getattr(_active_broker, name)
+
+
+def start_pipeline(cape, use_asyncio=False):
+    """Open the emulator's pty as the bridge's serial port and start processing in the background."""
+    # synthetic frames must not evict real ones from the capture ring or reach the history,
+    # and the garbage in the mix must not turn into Pushover alerts
+    serialhandler.set_capture(False)
+    historyhandler.set_recording(False)
+    notifier.attach_dispatcher(notifier.drain_notifications)
+    serialhandler.default_cape.ser = serial.Serial(cape.port, BAUD_RATE, timeout=0.5)
+    if use_asyncio:
+        # imported here so --startup measures the threaded bridge only, as ninja2mqtt.main loads it
+        import asyncio
+        import asyncruntime
+
+        def target():
+            asyncio.run(asyncruntime.run_ingest(_ClientProxy()))
+        thread = threading.Thread(target=target, name="bench-event-loop", daemon=True)
+    else:
+        thread = threading.Thread(target=serialhandler.process_ninjacape_messages, args=(_ClientProxy(),),
+                                  name="bench-processing", daemon=True)
+    thread.start()
+
+
+def run(cape, rate, duration, settle=2.0):
+    global _active_broker
+    broker = emulator.FakeBroker()
+    _active_broker = broker
+    dropped_before = serialhandler.get_serial_stats()["dropped"]
+
+    started = time.monotonic()
+    cape.start(duration=duration, rate=rate)
+    cape.wait()
+    elapsed = time.monotonic() - started
+
+    # give the pipeline a moment to drain before counting
+    deadline = time.monotonic() + settle
+    while time.monotonic() < deadline and len(broker.probe_arrivals()) < len(cape.probes_sent):
+        time.sleep(0.05)
+
+    arrivals = broker.probe_arrivals()
+    latencies = [(arrivals[seq] - sent) * 1000 for seq, sent in cape.probes_sent.items() if seq in arrivals]
+    return {
+        "rate": rate,
+        "frames_sent": cape.frames_sent,
+        "sent_fps": round(cape.frames_sent / elapsed, 1) if elapsed else 0.0,
+        "probes_sent": len(cape.probes_sent),
+        "probes_received": len(latencies),
+        "dropped": len(cape.probes_sent) - len(latencies),
+        "frames_dropped": serialhandler.get_serial_stats()["dropped"] - dropped_before,
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+        "max_ms": max(latencies) if latencies else None,
+        "serial": serialhandler.get_serial_stats(),
+    }
+
+
+def find_max_rate(cape, duration, start_rate=25, p99_limit_ms=250):
+    """Double the frame rate until probes are dropped or p99 latency passes the limit."""
+    best = None
+    rate = start_rate
+    while rate <= 100000:
+        result = run(cape, rate, duration)
+        print_result(result)
+        if result["dropped"] or result["frames_dropped"] or result["p99_ms"] is None or result["p99_ms"] > p99_limit_ms:
+            break
+        if result["sent_fps"] < 0.9 * rate:
+            print("emulator cannot generate frames any faster; bridge limit not reached")
+            best = result
+            break
+        best = result
+        rate *= 2
+    return best
+
+
+def _rss_kb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def startup_child(rate, duration):
+    """Runs in a fresh interpreter: import the bridge, ingest until the first publish, then measure RSS."""
+    import ninja2mqtt  # noqa: F401 - the full bridge import is part of what is measured
+    imported_at = time.time()
+    influxhandler.influx_client = NullInfluxClient()
+
+    cape = emulator.NinjaCapeEmulator(mix={"probe": 1}, seed=1)
+    start_pipeline(cape)
+    global _active_broker
+    broker = emulator.FakeBroker()
+    _active_broker = broker
+    cape.start(count=1)
+    while not broker.published:
+        time.sleep(0.001)
+    first_publish_at = time.time() - (time.monotonic() - broker.published[0][0])
+
+    result = run(cape, rate, duration)
+    cape.close()
+    print(json.dumps({
+        "imported_at": imported_at,
+        "first_publish_at": first_publish_at,
+        "rss_kb": _rss_kb(),
+        "p99_ms": result["p99_ms"],
+    }))
+
+
+def startup_benchmark(rate, duration, runs=3):
+    results = []
+    for _ in range(runs):
+        started = time.time()
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), "--startup-child",
+                              "--rate", str(rate), "--duration", str(duration)],
+                             capture_output=True, text=True, check=True).stdout
+        child = json.loads(out.strip().splitlines()[-1])
+        results.append({
+            "import_ms": (child["imported_at"] - started) * 1000,
+            "first_publish_ms": (child["first_publish_at"] - started) * 1000,
+            "rss_kb": child["rss_kb"],
+        })
+    for key in ("import_ms", "first_publish_ms", "rss_kb"):
+        values = sorted(r[key] for r in results)
+        print(f"{key}: median={values[len(values) // 2]:.0f} min={values[0]:.0f} max={values[-1]:.0f}")
+
+
+def print_result(result):
+    def ms(value):
+        return "-" if value is None else f"{value:.2f}"
+    print(f"rate={result['rate']}/s sent={result['frames_sent']} ({result['sent_fps']}/s) "
+          f"probes={result['probes_received']}/{result['probes_sent']} dropped={result['dropped']} "
+          f"frames_dropped={result['frames_dropped']} "
+          f"latency ms p50={ms(result['p50_ms'])} p95={ms(result['p95_ms'])} "
+          f"p99={ms(result['p99_ms'])} max={ms(result['max_ms'])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="NinjaCape bridge ingest benchmark")
+    parser.add_argument("--rate", type=float, default=50, help="frames per second")
+    parser.add_argument("--duration", type=float, default=10, help="seconds per run")
+    parser.add_argument("--baud", type=int, default=None, help="limit the emulated wire to this baud rate")
+    parser.add_argument("--find-max", action="store_true", help="ramp the rate to find max sustained frames/sec")
+    parser.add_argument("--startup", action="store_true", help="measure time-to-first-publish and steady-state RSS")
+    parser.add_argument("--startup-child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--asyncio", action="store_true", help="drive the pipeline with the asyncio runtime")
+    parser.add_argument("--verbose", action="store_true", help="keep bridge logging enabled")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logging.disable(logging.CRITICAL)
+    if args.startup_child:
+        startup_child(args.rate, args.duration)
+        return
+    if args.startup:
+        startup_benchmark(args.rate, args.duration)
+        return
+    influxhandler.influx_client = NullInfluxClient()
+
+    cape = emulator.NinjaCapeEmulator(baud=args.baud, seed=1)
+    start_pipeline(cape, use_asyncio=args.asyncio)
+    try:
+        if args.find_max:
+            best = find_max_rate(cape, args.duration)
+            print(f"max sustained: {best['sent_fps'] if best else 0} frames/sec")
+        else:
+            print_result(run(cape, args.rate, args.duration))
+    finally:
+        cape.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -11,13 +11,48 @@ SERIAL_TIMEOUT = 5  # Timeout for serial read to prevent blocking
 # LED device IDs
 STATUS_LED_ID = 999
 EYES_LED_ID = 1007
+DEFAULT_LED_COLOR = "0000FF"    # used when no colour is known for an LED
+
+#capes bridged by this process, one serial port each. Device ids only need to be unique
+#per cape: each has its own topic prefix (<prefix>/input/<id>, <prefix>/output/<id>), LED
+#ids and state namespace. The first entry is the default cape (debug topics, scheduler
+#defaults); an empty state_namespace keeps the original flat state keys and Influx series.
+CAPES = [
+    {"name": "ninjaCape", "port": SERIAL_PORT, "topic_prefix": "ninjaCape",
+     "status_led_id": STATUS_LED_ID, "eyes_led_id": EYES_LED_ID, "state_namespace": ""},
+    # {"name": "rf2", "port": "/dev/ttyUSB0", "topic_prefix": "ninjaCape2",
+    #  "status_led_id": 999, "eyes_led_id": 1007, "state_namespace": "rf2"},
+]
 
 #time zone
 TIME_ZONE = "Australia/Melbourne"
 
-#shelving location
+#timers: how late (seconds) a job may run before its missed-run policy applies, and how
+#often to check whether the wall clock was stepped while wall-clock jobs are pending
+TIMER_GRACE = 60
+TIMER_CLOCK_CHECK = 300
+
+#shelving location (legacy shelve file, imported into PERSIST_DB_PATH on first start)
 SHELF_PATH = '/home/debian/db/ninja2mqtt_state.db'
 
+#persistent state store
+PERSIST_DB_PATH = '/home/debian/db/ninja2mqtt_state.sqlite'
+PERSIST_FLUSH_INTERVAL = 5      # seconds between write-behind commits, 0 = commit every write
+PERSIST_SYNC = "NORMAL"         # SQLite synchronous: NORMAL (fsync at checkpoint) or FULL (fsync every commit)
+
+#local reading history: raw readings plus 1-minute and 1-hour rollups, each kept for
+#HISTORY_RETENTION seconds; past HISTORY_MAX_BYTES the oldest raw rows, then minutes, are trimmed.
+#Query by publishing {"series", "start", "end", "resolution"} JSON to HISTORY_QUERY_TOPIC.
+HISTORY_DB_PATH = '/home/debian/db/ninja2mqtt_history.sqlite'
+HISTORY_FLUSH_INTERVAL = 30     # seconds between batched writes
+HISTORY_RETRY_MAX_DELAY = 600   # seconds, cap for the backoff after the store could not be opened or written
+HISTORY_RETENTION = {"raw": 2 * 86400, "1m": 30 * 86400, "1h": 5 * 365 * 86400}
+HISTORY_MAX_BYTES = 64 * 1024 * 1024
+HISTORY_QUERY_TOPIC = "ninjaCape/history/query"
+HISTORY_RESPONSE_TOPIC = "ninjaCape/history/response"
+HISTORY_RAW_QUERY_SPAN = 6 * 3600  # "auto" resolution answers from raw rows only for spans up to this
+HISTORY_QUERY_MAX_POINTS = 1500
+
 # PUSHOVER config - retrieved from environment varables
 PUSHOVER_USER_KEY = os.getenv("PUSHOVER_USER_KEY")
 PUSHOVER_API_TOKEN = os.getenv("PUSHOVER_API_TOKEN")
@@ -26,3 +61,96 @@ PUSHOVER_API_TOKEN = os.getenv("PUSHOVER_API_TOKEN")
 INFLUX_HOST = "raspberrypi"
 INFLUX_PORT = 8086
 INFLUX_DB = "weather_data"
+
+#influx background writer
+INFLUX_BATCH_SIZE = 50          # points per write_points call
+INFLUX_FLUSH_INTERVAL = 10      # seconds between flushes of a partial batch
+INFLUX_QUEUE_SIZE = 1000        # readings held in memory before dropping
+INFLUX_SPOOL_PATH = '/home/debian/db/influx_spool.jsonl'
+INFLUX_SPOOL_MAX_BYTES = 5 * 1024 * 1024
+INFLUX_TIMEOUT = 10             # seconds per HTTP request to InfluxDB
+INFLUX_REPLAY_MAX_DELAY = 600   # seconds, cap for the backoff between failed spool replays
+
+#influx pre-aggregation per measurement:
+#  mode   - "raw" writes every reading, "aggregate" writes one point per tumbling window
+#           with the mean under the field name plus <field>_min, <field>_max and count
+#  window - seconds per window
+INFLUX_AGGREGATION = {
+    "readings": {"mode": "raw", "window": 300},
+}
+
+#pushover dispatcher
+NOTIFY_QUEUE_SIZE = 100
+NOTIFY_TIMEOUT = (3.05, 10)     # connect / read seconds
+NOTIFY_COALESCE_SECONDS = 60    # identical messages inside this window are sent once, then summarised
+NOTIFY_RATE_LIMIT = 10          # notifications per category ...
+NOTIFY_RATE_PERIOD = 3600       # ... per this many seconds
+
+#serial ingestion
+SERIAL_QUEUE_SIZE = 500         # framed lines waiting for processing
+SERIAL_MAX_FRAME_BYTES = 4096   # discard partial lines longer than this
+SERIAL_RETRY_MAX_DELAY = 60     # seconds, cap for the open-port retry backoff
+SERIAL_ERROR_LIMIT = 3          # consecutive read/write errors before the port is closed and reopened
+SERIAL_STALL_SECONDS = 300      # reopen the port after this long without receiving anything (None disables)
+SERIAL_OUTAGE_WRITES = "buffer" # while a link is down: "buffer" (latest per device, sent on reconnect) or "drop"
+SERIAL_PACK_DEVICES = False     # pack several pending device updates into one DEVICE array frame
+SERIAL_WRITE_MAX_DEVICES = 4    # max devices per packed frame
+SERIAL_WRITE_GAP = 0.02         # extra seconds between frames on top of the baud-rate pacing
+
+#raw frame capture: every serial line with its receive time, in a fixed-size memory-mapped
+#ring file (replay.py reads it back); None disables
+CAPTURE_PATH = '/home/debian/db/ninja2mqtt_frames.ring'
+CAPTURE_BYTES = 8 * 1024 * 1024
+
+#rf burst collapsing: identical (D, V, DA) entries from these device ids within the window
+#are one transmission; for a registered RF sensor (RF_SENSORS) the number of copies is
+#published to <prefix>/input/rf/<name>/repeats
+RF_BURST_DEVICES = (11,)
+RF_BURST_WINDOW = 1.0           # seconds, 0 disables
+
+#known protocol 5 RF sensors, keyed by the decoded (house, station, id); an id of None matches
+#any id (it changes when the batteries do). Each sensor publishes to
+#<prefix>/input/rf/<name>/temperature and /humidity and writes sensor_id=<name> to Influx;
+#"legacy" keeps the original input/31, input/30 and sensor_id 3130. "filter" may give publish
+#filter rules per field ({"temperature": {...}, "humidity": {...}}), default those of 31/30.
+#Readings from any other sensor are quarantined (listed via ninjaCape/debug/sensors), not published.
+RF_SENSORS = {
+    (1, 1, None): {"name": "outdoor", "legacy": True},
+    # (2, 1, None): {"name": "shed"},
+}
+RF_QUARANTINE_SIZE = 32         # unknown sensors remembered
+
+#publish filter, rules keyed by topic or device id:
+#  window    - seconds an unchanged payload is not republished
+#  deadband  - minimum numeric change from the last published value
+#  heartbeat - republish after this many seconds regardless
+PUBLISH_FILTER_RULES = {
+    999: {"window": 300},
+    1007: {"window": 300},
+    30: {"window": 300, "deadband": 1, "heartbeat": 900},      # humidity %
+    31: {"window": 300, "deadband": 0.2, "heartbeat": 900},    # temperature °C
+}
+PUBLISH_FILTER_CACHE_SIZE = 256
+
+#mqtt outbound publishing
+#per-topic policy, first matching pattern wins; latest_only keeps just the newest value while offline
+MQTT_TOPIC_POLICIES = [
+    ("+/input/#", {"qos": 1, "retain": False, "latest_only": True}),     # every cape's input topics
+]
+MQTT_OFFLINE_BUFFER_SIZE = 500
+MQTT_RECONNECT_MIN_DELAY = 1
+MQTT_RECONNECT_MAX_DELAY = 120
+
+#metrics
+METRICS_TOPIC = "ninjaCape/metrics"
+METRICS_INTERVAL = 60           # seconds between snapshots published to METRICS_TOPIC
+METRICS_HTTP_PORT = None        # e.g. 9105 to serve Prometheus text at /metrics
+
+#logging: handlers from logging.conf run on listener threads behind an in-memory queue
+LOG_QUEUE_SIZE = 10000          # records held before new ones are dropped
+SUSPICIOUS_LOG_RATE = 20        # suspicious-frame warnings written ...
+SUSPICIOUS_LOG_PERIOD = 60      # ... per this many seconds; the rest are counted and summarised
+
+#state store checkpoint for warm starts
+STATE_SNAPSHOT_PATH = '/home/debian/db/ninja2mqtt_states.json'
+STATE_CHECKPOINT_INTERVAL = 60  # seconds
@@ -0,0 +1,138 @@
+# devicehandlers.py
+import logging
+import time
+from utils import hex_to_rgb_string
+from notifier import send_notification
+from rfhandler import parse_sensor_data, check_suspicious_device
+from statehandler import set_state
+from influxhandler import log_reading
+from historyhandler import record_reading
+from sensorregistry import registry as sensor_registry
+import metrics
+
+# Handlers for entries of a {"DEVICE": [...]} frame, keyed by (D, V). A handler registered
+# with protocol=None matches any V for that device id; anything unregistered goes to
+# handle_unknown_device. Each handler is called as handler(mqtt_client, device, line, cape),
+# where cape (serialhandler.Cape) supplies the topic prefix and state namespace. LED ids
+# differ per cape, so those are matched against cape.led_ids before the registry.
+_handlers = {}
+
+_rf_decode_seconds = metrics.histogram("rf_decode_seconds")
+_rf_invalid = metrics.counter("rf_invalid_readings")
+
+
+def register(dev_id, protocol=None):
+    """Decorator registering a handler for device id `dev_id` (and optionally protocol V)."""
+    def decorator(handler):
+        _handlers[(int(dev_id), None if protocol is None else int(protocol))] = handler
+        return handler
+    return decorator
+
+
+def dispatch_device(mqtt_client, device, line, cape):
+    dev_id = device["D"]
+    protocol = device["V"]
+    if type(dev_id) is not int:
+        dev_id = int(dev_id)
+    if type(protocol) is not int:
+        protocol = int(protocol)
+
+    if dev_id in cape.led_ids:
+        handler = handle_led
+    else:
+        handler = _handlers.get((dev_id, protocol)) or _handlers.get((dev_id, None)) or handle_unknown_device
+    handler(mqtt_client, device, line, cape)
+
+
+def publish_to_mqtt(mqtt_client, topic, payload, dev_id):
+    from mqtthandler import publish_payload
+    publish_payload(mqtt_client, topic, payload, dev_id=dev_id)
+
+
+def publish_device(mqtt_client, dev_id, dev_value, cape):
+    """Default publish: store state and publish to <prefix>/input/<id>."""
+    set_state(cape.state_key(dev_id), dev_value)
+    publish_to_mqtt(mqtt_client, cape.input_topic(dev_id), dev_value, dev_id=dev_id)
+
+
+def handle_unknown_device(mqtt_client, device, line, cape):
+    dev_id = device["D"]
+    dev_value = str(device["DA"])
+    publish_device(mqtt_client, dev_id, dev_value, cape)
+    # log and notify if anything other than a known device
+    logging.info("Published Else: %s -> %s", cape.input_topic(dev_id), dev_value)
+    send_notification(f"Published Else: {cape.input_topic(dev_id)} -> {dev_value}", category="serial-else")
+
+
+def handle_led(mqtt_client, device, line, cape):
+    dev_id = device["D"]
+    #convert to rgb for ninja status (999) and rgb eyes (1007) led's
+    dev_value = hex_to_rgb_string(str(device["DA"]))
+    publish_device(mqtt_client, dev_id, dev_value, cape)
+    logging.debug("Published dev_id: %s -> %s", dev_id, dev_value)
+
+    # specific on / off for LED's
+    on_value = "false" if dev_value == "0,0,0" else "true"
+    publish_to_mqtt(mqtt_client, cape.input_topic(dev_id, "on"), on_value, dev_id=dev_id)
+    logging.debug("Published On dev_id: %s -> %s", dev_id, on_value)
+
+
+@register(1)
+def handle_onboard_temperature(mqtt_client, device, line, cape):
+    publish_device(mqtt_client, device["D"], str(device["DA"]), cape)
+    record_reading(cape.state_key(device["D"]), device["DA"])
+
+
+@register(11)
+def handle_rf(mqtt_client, device, line, cape):
+    check_suspicious_device(device, line)
+    handle_unknown_device(mqtt_client, device, line, cape)
+
+
+@register(11, 5)
+def handle_rf_weather(mqtt_client, device, line, cape):
+    dev_value = str(device["DA"])
+    started = time.perf_counter()
+    result = parse_sensor_data(dev_value)
+    _rf_decode_seconds.observe(time.perf_counter() - started)
+    check_suspicious_device(device, line, reading=result)
+    if not result.valid:
+        _rf_invalid.inc()
+        logging.info("[MQTTHandler] Unrecognized or non-temperature protocol 5 data: %s (Reason: %s)",
+                     dev_value, result.reason_text)
+        handle_unknown_device(mqtt_client, device, line, cape)
+        return
+
+    # Always log all parsed fields (formatted lazily, only if DEBUG is enabled)
+    logging.debug(
+        "Parsed sensor data (raw=%s): House=%s, Station=%s, Temperature=%s°C, Humidity=%s%%, "
+        "ID=%s, Unknown=%s (Valid=%s, Reason=%s)",
+        dev_value, result.house, result.station, result.temperature, result.humidity,
+        result.id, result.unknown, result.valid, result.reason_text
+    )
+
+    sensor = sensor_registry.lookup(result)
+    if sensor is None:
+        sensor_registry.quarantine(result)
+        return
+
+    temp = result.temperature
+    hum = result.humidity
+    temp_topic, hum_topic = sensor.topics(cape)
+    temp_key, hum_key = sensor.state_keys(cape)
+    temp_dev_id, hum_dev_id = sensor.dev_ids
+
+    publish_to_mqtt(mqtt_client, temp_topic, temp, dev_id=temp_dev_id)
+    set_state(temp_key, temp)
+    logging.debug("[MQTTHandler] Published: (11/5) %s -> %s (temperature)", temp_topic, temp)
+
+    publish_to_mqtt(mqtt_client, hum_topic, hum, dev_id=hum_dev_id)
+    set_state(hum_key, hum)
+    logging.debug("[MQTTHandler] Published: (11/5) %s -> %s (humidity)", hum_topic, hum)
+
+    #log to influx
+    log_reading("ninja", sensor.sensor_id, result.station, temp, hum, tags=cape.influx_tags)
+
+    # local history last: it only buffers, but must never come before the Influx record
+    record_reading(temp_key, temp)
+    record_reading(hum_key, hum)
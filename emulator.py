@@ -0,0 +1,173 @@
+# emulator.py
+import json
+import os
+import random
+import threading
+import time
+
+# Emulates the NinjaCape end of the serial link for tests and benchmarks. Frames are
+# written to the master side of a pty; the bridge opens the slave path like a real port.
+
+PROBE_DEVICE_ID = 1  # onboard temperature: published as-is, no filter rule, no notification
+
+DEFAULT_MIX = {
+    "rf_weather": 40,
+    "rf_other": 5,
+    "led_echo": 20,
+    "probe": 20,
+    "ack": 5,
+    "error": 5,
+    "garbage": 5,
+}
+
+
+def rf_weather_frame(rng):
+    house, station = 1, 0
+    humidity = rng.randint(20, 95)
+    temperature_raw = rng.randint(40, 90)
+    fraction = rng.randint(0, 15)
+    word = (house << 28) | (station << 26) | (humidity << 16) | (temperature_raw << 8) | (fraction << 4) | 0x3
+    return {"DEVICE": [{"G": "0", "V": 5, "D": 11, "DA": str(word)}]}
+
+
+def make_frame(kind, rng, seq=0):
+    """One line (without newline) of the given kind, as the cape would send it."""
+    if kind == "rf_weather":
+        return json.dumps(rf_weather_frame(rng))
+    if kind == "rf_other":
+        return json.dumps({"DEVICE": [{"G": "0", "V": 2, "D": 11, "DA": str(rng.getrandbits(24))}]})
+    if kind == "led_echo":
+        return json.dumps({"DEVICE": [{"G": "0", "V": 0, "D": rng.choice((999, 1007)), "DA": "%06X" % rng.getrandbits(24)}]})
+    if kind == "probe":
+        return json.dumps({"DEVICE": [{"G": "0", "V": 0, "D": PROBE_DEVICE_ID, "DA": str(seq)}]})
+    if kind == "ack":
+        return json.dumps({"ACK": [{"G": "0", "V": 0, "D": 999, "DA": "0000FF"}]})
+    if kind == "error":
+        return json.dumps({"ERROR": [{"ERR": "Bad JSON", "CODE": 2}]})
+    if kind == "garbage":
+        return "".join(rng.choice("{}[]\":,abcdef0123456789") for _ in range(rng.randint(5, 40)))
+    raise ValueError(f"Unknown frame kind: {kind}")
+
+
+class NinjaCapeEmulator:
+    """
+    Writes a weighted mix of frames to a pty at `rate` frames/sec. Probe frames carry a
+    sequence number so the time each one was written can be matched to its publish.
+    """
+
+    def __init__(self, mix=None, rate=20.0, baud=None, seed=None, capture=None):
+        self.mix = dict(mix or DEFAULT_MIX)
+        self.rate = rate
+        self.baud = baud
+        self.rng = random.Random(seed)
+        self.capture = capture  # optional list of recorded lines to replay instead of the mix
+        self.master_fd, slave_fd = os.openpty()
+        self.port = os.ttyname(slave_fd)
+        self._slave_fd = slave_fd  # held open so the pty survives until the bridge opens it
+        self.probes_sent = {}
+        self.frames_sent = 0
+        self.received = []
+        self._stop = threading.Event()
+        self._writer = None
+        self._reader = None
+        self._seq = 0
+
+    def start(self, duration=None, count=None, rate=None):
+        """Begin a run; may be called again after wait() to run another phase on the same pty."""
+        if rate is not None:
+            self.rate = rate
+        self.probes_sent = {}
+        self.frames_sent = 0
+        self._writer = threading.Thread(target=self._write_frames, args=(duration, count), name="emulator-writer", daemon=True)
+        self._writer.start()
+        if self._reader is None:
+            self._reader = threading.Thread(target=self._read_commands, name="emulator-reader", daemon=True)
+            self._reader.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def wait(self, timeout=None):
+        self._writer.join(timeout)
+
+    def close(self):
+        self.stop()
+        for fd in (self.master_fd, self._slave_fd):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def next_line(self, seq):
+        if self.capture:
+            return self.capture[seq % len(self.capture)], None
+        kinds = list(self.mix)
+        kind = self.rng.choices(kinds, weights=[self.mix[k] for k in kinds])[0]
+        return make_frame(kind, self.rng, seq), kind
+
+    def _write_frames(self, duration, count):
+        interval = 1.0 / self.rate if self.rate else 0.0
+        started = time.monotonic()
+        next_due = started
+        sent = 0
+        while not self._stop.is_set():
+            if count is not None and sent >= count:
+                break
+            if duration is not None and time.monotonic() - started >= duration:
+                break
+            seq = self._seq
+            line, kind = self.next_line(seq)
+            data = (line + "\n").encode("utf-8")
+            now = time.monotonic()
+            if next_due > now:
+                time.sleep(next_due - now)
+            os.write(self.master_fd, data)
+            if kind == "probe":
+                self.probes_sent[str(seq)] = time.monotonic()
+            self.frames_sent += 1
+            self._seq += 1
+            sent += 1
+            next_due += interval
+            if self.baud:
+                # never faster than the wire: 10 bit times per byte
+                next_due = max(next_due, time.monotonic() + len(data) * 10 / self.baud)
+
+    def _read_commands(self):
+        """Collect what the bridge writes to the cape."""
+        while not self._stop.is_set():
+            try:
+                data = os.read(self.master_fd, 4096)
+            except OSError:
+                return
+            if data:
+                self.received.append(data)
+
+
+class FakeBroker:
+    """Stand-in for the paho client: records every publish with its arrival time."""
+
+    def __init__(self):
+        self.published = []
+        self._lock = threading.Lock()
+
+    def is_connected(self):
+        return True
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        with self._lock:
+            self.published.append((time.monotonic(), topic, payload))
+            mid = len(self.published)
+        return _MessageInfo(mid)
+
+    def probe_arrivals(self):
+        topic = f"ninjaCape/input/{PROBE_DEVICE_ID}"
+        with self._lock:
+            return {str(payload): at for at, t, payload in self.published if t == topic}
+
+
+class _MessageInfo:
+    rc = 0
+
+    def __init__(self, mid):
+        self.mid = mid
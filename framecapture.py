@@ -0,0 +1,114 @@
+# framecapture.py
+import logging
+import mmap
+import os
+import struct
+import threading
+
+# Every raw serial line is appended to a fixed-size memory-mapped ring file, so incidents
+# can be replayed later (replay.py). Appending is a struct.pack_into plus a slice copy
+# into the page cache; the kernel writes dirty pages back in the background.
+#
+# Layout: a 64-byte header, then `capacity` bytes of records. Each record is
+#   timestamp (float64, unix seconds) | length (uint16) | cape index (uint8) | line bytes
+# A record never straddles the end of the ring: a WRAP length (or fewer than RECORD.size
+# bytes left) means the next record starts at offset 0. `tail` is the oldest record,
+# `head` where the next one goes, `count` how many are live; old records are evicted as
+# the writer laps them.
+
+MAGIC = b"NJRF"
+VERSION = 1
+HEADER = struct.Struct("<4sHHIIIQ")  # magic, version, reserved, capacity, head, tail, count
+HEADER_SIZE = 64
+RECORD = struct.Struct("<dHB")
+WRAP = 0xFFFF
+MAX_LINE = WRAP - 1
+
+
+class FrameRing:
+    def __init__(self, path, capacity=None, readonly=False):
+        """Open (or, given a capacity, create) a ring file."""
+        self.path = path
+        self._lock = threading.Lock()
+        exists = os.path.exists(path) and os.path.getsize(path) > HEADER_SIZE
+        if not exists and (readonly or capacity is None):
+            raise FileNotFoundError(path)
+
+        if readonly:
+            with open(path, "rb") as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            with open(path, "a+b") as f:
+                if not exists:
+                    f.truncate(HEADER_SIZE + capacity)
+                self._map = mmap.mmap(f.fileno(), 0)
+
+        if exists:
+            magic, version, _, self.capacity, self.head, self.tail, self.count = HEADER.unpack_from(self._map, 0)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f"{path} is not a frame capture ring")
+            if capacity is not None and capacity != self.capacity:
+                logging.warning(f"[Capture] {path} has capacity {self.capacity}, ignoring configured {capacity}")
+        else:
+            self.capacity, self.head, self.tail, self.count = capacity, 0, 0, 0
+            self._write_header()
+
+    def _write_header(self):
+        HEADER.pack_into(self._map, 0, MAGIC, VERSION, 0, self.capacity, self.head, self.tail, self.count)
+
+    def append(self, line, timestamp, cape_index=0):
+        size = RECORD.size + len(line)
+        if len(line) > MAX_LINE or size > self.capacity:
+            return False
+        with self._lock:
+            pos = self.head
+            if pos + size > self.capacity:
+                # the rest of the ring is dead space until the next lap
+                self._evict(pos, self.capacity)
+                if self.capacity - pos >= RECORD.size:
+                    RECORD.pack_into(self._map, HEADER_SIZE + pos, 0.0, WRAP, 0)
+                pos = 0
+            self._evict(pos, pos + size)
+            if self.count == 0:
+                self.tail = pos
+
+            start = HEADER_SIZE + pos
+            RECORD.pack_into(self._map, start, timestamp, len(line), cape_index)
+            self._map[start + RECORD.size:start + size] = line
+            self.head = pos + size
+            self.count += 1
+            self._write_header()
+        return True
+
+    def _evict(self, start, end):
+        """Drop the oldest records while the tail lies in [start, end)."""
+        while self.count and start <= self.tail < end:
+            _, length, _ = RECORD.unpack_from(self._map, HEADER_SIZE + self.tail)
+            self.tail = self._normalise(self.tail + RECORD.size + length)
+            self.count -= 1
+
+    def _normalise(self, offset):
+        """Follow an implicit or explicit wrap to where the record at `offset` really starts."""
+        if self.capacity - offset < RECORD.size:
+            return 0
+        if RECORD.unpack_from(self._map, HEADER_SIZE + offset)[1] == WRAP:
+            return 0
+        return offset
+
+    def records(self, since=None, until=None):
+        """Yield (timestamp, cape_index, line) from oldest to newest."""
+        with self._lock:
+            _, _, _, capacity, head, tail, count = HEADER.unpack_from(self._map, 0)
+        offset = self._normalise(tail) if count else tail
+        for _ in range(count):
+            timestamp, length, cape_index = RECORD.unpack_from(self._map, HEADER_SIZE + offset)
+            if length > capacity:
+                logging.warning(f"[Capture] Corrupt record at offset {offset}, stopping")
+                return
+            start = HEADER_SIZE + offset + RECORD.size
+            if (since is None or timestamp >= since) and (until is None or timestamp <= until):
+                yield timestamp, cape_index, bytes(self._map[start:start + length])
+            offset = self._normalise(offset + RECORD.size + length)
+
+    def close(self):
+        self._map.close()
@@ -0,0 +1,407 @@
+# historyhandler.py
+import atexit
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from zoneinfo import ZoneInfo
+from config import HISTORY_DB_PATH, HISTORY_MAX_BYTES, HISTORY_FLUSH_INTERVAL, HISTORY_RETRY_MAX_DELAY
+from config import HISTORY_RETENTION, HISTORY_RAW_QUERY_SPAN, HISTORY_QUERY_MAX_POINTS
+from config import TIME_ZONE
+from timerservice import timers
+import metrics
+
+# Local history of every reading, so "what was it overnight" needs neither the network
+# nor InfluxDB. Readings are buffered in memory and written every HISTORY_FLUSH_INTERVAL
+# seconds in one transaction: the raw rows, plus 1-minute and 1-hour rollups (count, sum,
+# min, max per series and bucket) that are upserted from per-flush partial sums. Each
+# tier keeps HISTORY_RETENTION[tier] seconds; if the file still grows past
+# HISTORY_MAX_BYTES the oldest raw rows, then the oldest minutes, are trimmed.
+#
+# Series are named by state key ("31", "rf/shed/temperature", "rf2/1", ...).
+#
+# The ingest path only appends to the buffer. Flushes, pruning and queries run on one
+# "history" worker thread. If the store cannot be opened or written (locked, disk full,
+# missing directory) the buffer is kept and the store is tried again after a backoff,
+# doubling up to HISTORY_RETRY_MAX_DELAY; readings are only lost once the buffer is full.
+
+TIERS = (("raw", 0), ("1m", 60), ("1h", 3600))
+_TABLES = {"raw": "raw", "1m": "rollup_1m", "1h": "rollup_1h"}
+MAX_BUFFERED = 10000  # readings held between flushes before new ones are dropped
+
+_lock = threading.Lock()     # the buffer
+_db_lock = threading.Lock()  # the connection
+_conn = None
+_series_ids = {}
+_buffer = []  # (series, ts, value) waiting for the next flush
+_recording = True
+_retry_after = 0.0  # monotonic time before which a failed store is not tried again
+_retry_delay = 0.0
+_started = False
+_tasks = queue.Queue(maxsize=64)
+_worker_thread = None
+_stats = {"recorded": 0, "dropped": 0, "flushes": 0, "failures": 0, "queries": 0, "pruned_rows": 0,
+          "trimmed_rows": 0, "used_bytes": 0}
+
+_flush_seconds = metrics.histogram("history_flush_seconds")
+_query_seconds = metrics.histogram("history_query_seconds")
+
+
+def _open():
+    """Open the store on first use; caller holds _db_lock."""
+    global _conn
+    if _conn is not None:
+        return
+    conn = sqlite3.connect(HISTORY_DB_PATH, check_same_thread=False, isolation_level=None)
+    try:
+        # set before the first table exists, so deleted pages can be handed back to the filesystem
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS series (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)")
+        conn.execute("CREATE TABLE IF NOT EXISTS raw (series INTEGER NOT NULL, ts REAL NOT NULL, value REAL NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS raw_series_ts ON raw (series, ts)")
+        for tier in ("1m", "1h"):
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {_TABLES[tier]} (series INTEGER NOT NULL, "
+                         "bucket INTEGER NOT NULL, count INTEGER NOT NULL, sum REAL NOT NULL, min REAL NOT NULL, "
+                         "max REAL NOT NULL, PRIMARY KEY (series, bucket)) WITHOUT ROWID")
+        series_ids = dict((name, series_id) for series_id, name in conn.execute("SELECT id, name FROM series"))
+    except sqlite3.Error:
+        conn.close()
+        raise
+    _series_ids.clear()
+    _series_ids.update(series_ids)
+    _conn = conn
+    logging.info(f"[History] Recording readings to {HISTORY_DB_PATH}")
+
+
+def _start():
+    """Schedule the flush and prune jobs on first use; caller holds _lock."""
+    global _started
+    if _started:
+        return
+    _started = True
+    atexit.register(flush)
+    timers.every(HISTORY_FLUSH_INTERVAL, lambda: _submit(flush), name="history-flush")
+    timers.every(3600, lambda: _submit(prune), name="history-prune", first=60)
+
+
+def _submit(task):
+    """Run task() on the history worker thread; False if its queue is full."""
+    global _worker_thread
+    if _worker_thread is None or not _worker_thread.is_alive():
+        with _db_lock:
+            if _worker_thread is None or not _worker_thread.is_alive():
+                _worker_thread = threading.Thread(target=_run_worker, name="history", daemon=True)
+                _worker_thread.start()
+    try:
+        _tasks.put_nowait(task)
+        return True
+    except queue.Full:
+        return False
+
+
+def _run_worker():
+    while True:
+        task = _tasks.get()
+        try:
+            task()
+        except Exception as e:
+            logging.error(f"[History] Worker task failed: {e}")
+
+
+def _failed(error):
+    """Close the store after an error and back off before it is tried again; caller holds no locks."""
+    global _conn, _retry_after, _retry_delay
+    with _db_lock:
+        if _conn is not None:
+            try:
+                _conn.close()
+            except sqlite3.Error:
+                pass
+            _conn = None
+    _retry_delay = min(max(2 * _retry_delay, HISTORY_FLUSH_INTERVAL), HISTORY_RETRY_MAX_DELAY)
+    _retry_after = time.monotonic() + _retry_delay
+    with _lock:
+        _stats["failures"] += 1
+    logging.error(f"[History] Cannot use {HISTORY_DB_PATH}, retrying in {_retry_delay:.0f}s: {error}")
+
+
+def _recovered():
+    global _retry_after, _retry_delay
+    if _retry_delay:
+        logging.info(f"[History] {HISTORY_DB_PATH} is usable again")
+        _retry_after = _retry_delay = 0.0
+
+
+def _backing_off():
+    return time.monotonic() < _retry_after
+
+
+def _requeue(rows):
+    """Put rows that could not be written back in front of the buffer, keeping the newest MAX_BUFFERED."""
+    with _lock:
+        _buffer[:0] = rows
+        overflow = len(_buffer) - MAX_BUFFERED
+        if overflow > 0:
+            del _buffer[:overflow]
+            _stats["dropped"] += overflow
+
+
+def set_recording(enabled):
+    """Turn recording on or off (replay.py keeps replayed readings out of the history)."""
+    global _recording
+    _recording = enabled
+
+
+def record_reading(series, value, ts=None):
+    """Buffer one numeric reading for `series`; non-numeric values are ignored. Never touches the store."""
+    if not _recording:
+        return
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return
+    ts = time.time() if ts is None else ts
+    with _lock:
+        _start()
+        if len(_buffer) >= MAX_BUFFERED:
+            _stats["dropped"] += 1
+            return
+        _buffer.append((series, ts, value))
+        _stats["recorded"] += 1
+
+
+def flush():
+    """Write buffered readings and fold them into the rollups, in one transaction; kept for a retry on failure."""
+    with _lock:
+        if not _buffer or _backing_off():
+            return
+        rows = list(_buffer)
+        _buffer.clear()
+    started = time.perf_counter()
+    committed = False
+    try:
+        with _db_lock:
+            _open()
+            id_rows = [(_series_id(series), ts, value) for series, ts, value in rows]
+            with _conn:
+                _conn.execute("BEGIN")
+                _conn.executemany("INSERT INTO raw (series, ts, value) VALUES (?, ?, ?)", id_rows)
+                for tier, width in TIERS[1:]:
+                    _conn.executemany(
+                        f"INSERT INTO {_TABLES[tier]} (series, bucket, count, sum, min, max) VALUES (?, ?, ?, ?, ?, ?) "
+                        "ON CONFLICT (series, bucket) DO UPDATE SET count = count + excluded.count, "
+                        "sum = sum + excluded.sum, min = MIN(min, excluded.min), max = MAX(max, excluded.max)",
+                        _partial_sums(id_rows, width))
+            committed = True
+            used = _used_bytes()
+    except (sqlite3.Error, OSError) as e:
+        if not committed:
+            _requeue(rows)
+        _failed(e)
+        return
+    _recovered()
+    with _lock:
+        _stats["flushes"] += 1
+        _stats["used_bytes"] = used
+    _flush_seconds.observe(time.perf_counter() - started)
+
+
+def _series_id(name):
+    """Id of a series, created on first use; caller holds _db_lock."""
+    series_id = _series_ids.get(name)
+    if series_id is None:
+        series_id = _conn.execute("INSERT INTO series (name) VALUES (?)", (name,)).lastrowid
+        _series_ids[name] = series_id
+    return series_id
+
+
+def _partial_sums(rows, width):
+    buckets = {}
+    for series_id, ts, value in rows:
+        key = (series_id, int(ts // width * width))
+        bucket = buckets.get(key)
+        if bucket is None:
+            buckets[key] = [1, value, value, value]
+        else:
+            bucket[0] += 1
+            bucket[1] += value
+            if value < bucket[2]:
+                bucket[2] = value
+            if value > bucket[3]:
+                bucket[3] = value
+    return [(series_id, start, *bucket) for (series_id, start), bucket in buckets.items()]
+
+
+def _used_bytes():
+    page_size = _conn.execute("PRAGMA page_size").fetchone()[0]
+    pages = _conn.execute("PRAGMA page_count").fetchone()[0] - _conn.execute("PRAGMA freelist_count").fetchone()[0]
+    return pages * page_size
+
+
+def prune(now=None):
+    """Drop rows past each tier's retention, then trim the oldest data while over HISTORY_MAX_BYTES."""
+    now = time.time() if now is None else now
+    flush()
+    if _backing_off():
+        return
+    pruned = trimmed = 0
+    try:
+        with _db_lock:
+            if _conn is None:
+                return
+            series_ids = list(_series_ids.values())
+            with _conn:
+                _conn.execute("BEGIN")
+                for tier, _ in TIERS:
+                    retention = HISTORY_RETENTION.get(tier)
+                    if retention:
+                        pruned += _delete_before(tier, series_ids, now - retention)
+
+            # over budget: give up raw history first, then minutes, the oldest tenth of the rows
+            # at a time (by row count, so one stray timestamp from before NTP cannot empty a tier)
+            for tier in ("raw", "1m"):
+                column = "ts" if tier == "raw" else "bucket"
+                while _used_bytes() > HISTORY_MAX_BYTES:
+                    rows = _conn.execute(f"SELECT COUNT(*) FROM {_TABLES[tier]}").fetchone()[0]
+                    if not rows:
+                        break
+                    cutoff = _conn.execute(f"SELECT {column} FROM {_TABLES[tier]} ORDER BY {column} LIMIT 1 OFFSET ?",
+                                           (rows // 10,)).fetchone()[0]
+                    with _conn:
+                        _conn.execute("BEGIN")
+                        trimmed += _delete_before(tier, series_ids, cutoff, inclusive=True)
+            _conn.execute("PRAGMA incremental_vacuum")
+            used = _used_bytes()
+    except (sqlite3.Error, OSError) as e:
+        _failed(e)
+        return
+    with _lock:
+        _stats["pruned_rows"] += pruned
+        _stats["trimmed_rows"] += trimmed
+        _stats["used_bytes"] = used
+    if trimmed:
+        logging.warning(f"[History] Store over {HISTORY_MAX_BYTES} bytes, trimmed {trimmed} of the oldest rows")
+
+
+def _delete_before(tier, series_ids, cutoff, inclusive=False):
+    """Delete one tier's rows older than `cutoff`, series by series along the index; caller holds _db_lock."""
+    column = "ts" if tier == "raw" else "bucket"
+    operator = "<=" if inclusive else "<"
+    deleted = 0
+    for series_id in series_ids:
+        deleted += _conn.execute(f"DELETE FROM {_TABLES[tier]} WHERE series = ? AND {column} {operator} ?",
+                                 (series_id, cutoff)).rowcount
+    return deleted
+
+
+def choose_tier(start, end, now=None):
+    """The finest tier that still covers `start` and answers within HISTORY_QUERY_MAX_POINTS."""
+    now = time.time() if now is None else now
+    for tier, width in TIERS:
+        retention = HISTORY_RETENTION.get(tier)
+        if retention and start < now - retention:
+            continue
+        if tier == "raw":
+            if end - start <= HISTORY_RAW_QUERY_SPAN:
+                return tier
+        elif (end - start) / width <= HISTORY_QUERY_MAX_POINTS:
+            return tier
+    return TIERS[-1][0]
+
+
+def query(series, start, end=None, resolution="auto"):
+    """
+    Readings of `series` between `start` and `end` (unix seconds) as (ts, mean, min, max,
+    count) rows, from the raw table or a rollup tier; returns (tier, rows, truncated).
+    At most HISTORY_QUERY_MAX_POINTS rows are returned, oldest first, and truncated says
+    whether more follow. With resolution "auto", raw rows that would not fit are answered
+    from the 1-minute rollups instead.
+    """
+    end = time.time() if end is None else end
+    tier = choose_tier(start, end) if resolution == "auto" else resolution
+    if tier not in _TABLES:
+        raise ValueError(f"Unknown resolution '{resolution}'")
+    flush()
+    started = time.perf_counter()
+    with _db_lock:
+        _open()
+        series_id = _series_ids.get(series)
+        rows = [] if series_id is None else _select(tier, series_id, start, end)
+        if len(rows) > HISTORY_QUERY_MAX_POINTS and tier == "raw" and resolution == "auto":
+            tier = "1m"
+            rows = _select(tier, series_id, start, end)
+    with _lock:
+        _stats["queries"] += 1
+    _query_seconds.observe(time.perf_counter() - started)
+    return tier, rows[:HISTORY_QUERY_MAX_POINTS], len(rows) > HISTORY_QUERY_MAX_POINTS
+
+
+def _select(tier, series_id, start, end):
+    """Up to HISTORY_QUERY_MAX_POINTS + 1 rows, so the caller can tell the range was cut; caller holds _db_lock."""
+    limit = HISTORY_QUERY_MAX_POINTS + 1
+    if tier == "raw":
+        return _conn.execute("SELECT ts, value, value, value, 1 FROM raw WHERE series = ? AND ts >= ? AND ts <= ? "
+                             "ORDER BY ts LIMIT ?", (series_id, start, end, limit)).fetchall()
+    return _conn.execute(f"SELECT bucket, sum / count, min, max, count FROM {_TABLES[tier]} "
+                         "WHERE series = ? AND bucket >= ? AND bucket <= ? ORDER BY bucket LIMIT ?",
+                         (series_id, start - start % dict(TIERS)[tier], end, limit)).fetchall()
+
+
+def _parse_time(value, default):
+    """Unix seconds or an ISO date/time; one without an offset is local time in TIME_ZONE."""
+    if value is None:
+        return default
+    if isinstance(value, (int, float)):
+        return float(value)
+    when = datetime.fromisoformat(value)
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=ZoneInfo(TIME_ZONE))
+    return when.timestamp()
+
+
+def handle_query(payload):
+    """
+    Answer a JSON request {"series", "start", "end"?, "resolution"?, "id"?} (times as unix
+    seconds or ISO strings; start defaults to a day ago); returns the JSON response.
+    """
+    request = {}
+    try:
+        request = json.loads(payload)
+        now = time.time()
+        start = _parse_time(request.get("start"), now - 86400)
+        end = _parse_time(request.get("end"), now)
+        tier, rows, truncated = query(str(request["series"]), start, end, request.get("resolution", "auto"))
+        response = {"series": request["series"], "resolution": tier, "start": start, "end": end,
+                    "truncated": truncated,
+                    "points": [[ts, round(mean, 3), low, high, count] for ts, mean, low, high, count in rows]}
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        response = {"error": str(e)}
+    except sqlite3.Error as e:
+        logging.error(f"[History] Query failed: {e}")
+        response = {"error": f"history unavailable: {e}"}
+    if isinstance(request, dict) and "id" in request:
+        response["id"] = request["id"]
+    return json.dumps(response, separators=(",", ":"))
+
+
+def submit_query(payload, reply):
+    """Answer a query on the history worker thread; reply(response) is called from there."""
+    if not _submit(lambda: reply(handle_query(payload))):
+        reply(json.dumps({"error": "history busy"}, separators=(",", ":")))
+
+
+def get_history_stats():
+    with _lock:
+        stats = dict(_stats)
+        stats["buffered"] = len(_buffer)
+    stats["series"] = len(_series_ids)
+    stats["retry_in"] = max(0.0, round(_retry_after - time.monotonic(), 1))
+    return stats
+
+
+metrics.register_stats("history", get_history_stats)
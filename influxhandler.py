@@ -1,43 +1,352 @@
 # influxhandler.py
 
-from influxdb import InfluxDBClient
 from datetime import datetime
+import json
 import logging
+import os
+import queue
+import threading
+import time
 from config import INFLUX_HOST, INFLUX_PORT, INFLUX_DB
+from config import INFLUX_BATCH_SIZE, INFLUX_FLUSH_INTERVAL, INFLUX_QUEUE_SIZE
+from config import INFLUX_SPOOL_PATH, INFLUX_SPOOL_MAX_BYTES, INFLUX_AGGREGATION
+from config import INFLUX_TIMEOUT, INFLUX_REPLAY_MAX_DELAY
+from aggregator import WindowAggregator
+from timerservice import timers, aligned
+import metrics
 
 logger = logging.getLogger("influx")
 
-# Initialize InfluxDB client at module level
-try:
-    influx_client = InfluxDBClient(host=INFLUX_HOST, port=INFLUX_PORT)
-    influx_client.switch_database(INFLUX_DB)
-    logger.info(f"[Influx] Connected to database '{INFLUX_DB}' at {INFLUX_HOST}:{INFLUX_PORT}")
-except Exception as e:
-    logger.exception("[Influx] Connection failed during initialization")
+# Created on the writer thread the first time it is needed, so importing this module
+# stays cheap and never touches the network
+influx_client = None
 
-def log_reading(model, sensor_id, channel, temperature_C, humidity):
-    """Send temperature and humidity data to InfluxDB."""
+
+def get_client():
+    global influx_client
+    if influx_client is None:
+        # influxdb (and requests under it) is a heavy import on the BeagleBone; defer it
+        from influxdb import InfluxDBClient
+        # bounded, so a hung request cannot stall the only writer while the queue fills
+        client = InfluxDBClient(host=INFLUX_HOST, port=INFLUX_PORT, timeout=INFLUX_TIMEOUT)
+        client.switch_database(INFLUX_DB)
+        influx_client = client
+        logger.info(f"[Influx] Connected to database '{INFLUX_DB}' at {INFLUX_HOST}:{INFLUX_PORT}")
+    return influx_client
+
+# Points waiting for the background writer
+_queue = queue.Queue(maxsize=INFLUX_QUEUE_SIZE)
+_writer_thread = None
+_writer_wakeup = None
+_writer_lock = threading.Lock()
+
+# Measurements configured for "aggregate" are summarised per window before queueing
+_aggregators = {
+    measurement: WindowAggregator(rule["window"])
+    for measurement, rule in INFLUX_AGGREGATION.items()
+    if rule.get("mode") == "aggregate"
+}
+_window_jobs = []
+
+# After a failed spool replay the next attempt waits, doubling up to INFLUX_REPLAY_MAX_DELAY,
+# so an outage does not re-read (and rewrite) the spool on the SD card every flush interval
+_replay_after = 0.0
+_replay_delay = 0.0
+
+_log_reading_seconds = metrics.histogram("influx_log_reading_seconds")
+_flush_seconds = metrics.histogram("influx_flush_seconds")
+
+_stats_lock = threading.Lock()
+_stats = {
+    "queued": 0,
+    "written": 0,
+    "dropped": 0,
+    "spooled": 0,
+    "replayed": 0,
+    "flushes": 0,
+    "failed_flushes": 0,
+    "last_flush_seconds": 0.0,
+    "max_flush_seconds": 0.0,
+}
+
+
+def _count(name, amount=1):
+    with _stats_lock:
+        _stats[name] += amount
+
+
+def get_influx_stats():
+    """Return a snapshot of the writer counters, including current queue depth."""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["queue_depth"] = _queue.qsize()
+    stats["spool_bytes"] = _spool_size()
+    for measurement, aggregator in _aggregators.items():
+        for key, value in aggregator.stats().items():
+            stats[f"{measurement}_aggregated_{key}"] = value
+    return stats
+
+
+metrics.register_stats("influx", get_influx_stats)
+
+
+def start_influx_writer():
+    """Start the writer (and its connection) in the background; log_reading also starts it on demand."""
+    if _writer_wakeup is None:
+        _start_writer()
+
+
+def attach_writer(wakeup):
+    """
+    Let an external driver (the asyncio runtime) flush instead of the writer thread:
+    wakeup() is called once a full batch is queued, and the driver uses drain_points(),
+    record_flush(), and replay_due(), read_spool() and spool_replayed() for the spool.
+    """
+    global _writer_wakeup
+    _writer_wakeup = wakeup
+    _schedule_window_closing()
+
+
+def _schedule_window_closing():
+    """Close aggregation windows on the timer service as each one ends, busy or quiet."""
+    with _writer_lock:
+        if _window_jobs:
+            return
+        for window in sorted({aggregator.window for aggregator in _aggregators.values()}):
+            _window_jobs.append(timers.at(aligned(window), close_windows, name=f"influx-window-{window}s"))
+
+
+def drain_points(limit=INFLUX_BATCH_SIZE):
+    points = []
+    while len(points) < limit:
+        try:
+            points.append(_queue.get_nowait())
+        except queue.Empty:
+            break
+    return points
+
+
+def record_flush(batch, ok, elapsed, spool=True):
+    """Account for a flush done by an external driver; on failure the batch is spooled (unless it came from the spool)."""
+    _flush_seconds.observe(elapsed)
+    with _stats_lock:
+        _stats["flushes"] += 1
+        _stats["last_flush_seconds"] = elapsed
+        _stats["max_flush_seconds"] = max(_stats["max_flush_seconds"], elapsed)
+    if ok:
+        _count("written", len(batch))
+    else:
+        _count("failed_flushes")
+        if spool:
+            _spool(batch)
+
+
+def replay_due():
+    """True if there is a spool and the backoff after the last failed replay has passed."""
+    return time.monotonic() >= _replay_after and os.path.exists(INFLUX_SPOOL_PATH)
+
+
+def read_spool():
+    """Return the spooled points, leaving the file in place until spool_replayed() is called."""
+    points = []
+    try:
+        with open(INFLUX_SPOOL_PATH) as f:
+            for line in f:
+                try:
+                    points.append(json.loads(line))
+                except ValueError:
+                    logger.warning(f"[Influx] Skipping corrupt spool line: {line!r}")
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.error(f"[Influx] Could not read spool file {INFLUX_SPOOL_PATH}: {e}")
+    return points
+
+
+def spool_replayed(points, written):
+    """
+    Settle a replay of read_spool()'s points of which the first `written` were accepted:
+    remove the spool when all were, keep only the rest otherwise (the file is untouched
+    if none were) and back off before the next attempt.
+    """
+    global _replay_after, _replay_delay
+    _count("replayed", written)
+    if written >= len(points):
+        try:
+            os.remove(INFLUX_SPOOL_PATH)
+        except OSError as e:
+            logger.error(f"[Influx] Could not remove spool file {INFLUX_SPOOL_PATH}: {e}")
+        _replay_after = _replay_delay = 0.0
+        logger.info(f"[Influx] Replayed {written} spooled points")
+        return
+
+    _replay_delay = min(max(2 * _replay_delay, INFLUX_FLUSH_INTERVAL), INFLUX_REPLAY_MAX_DELAY)
+    _replay_after = time.monotonic() + _replay_delay
+    logger.warning(f"[Influx] Spool replay stopped after {written} of {len(points)} points, "
+                   f"next attempt in {_replay_delay:.0f}s")
+    if not written:
+        return
+    try:
+        tmp_path = INFLUX_SPOOL_PATH + ".tmp"
+        with open(tmp_path, "w") as f:
+            for point in points[written:]:
+                f.write(json.dumps(point) + "\n")
+        os.replace(tmp_path, INFLUX_SPOOL_PATH)
+    except OSError as e:
+        logger.error(f"[Influx] Could not rewrite spool file {INFLUX_SPOOL_PATH}: {e}")
+
+
+def to_line_protocol(points):
+    from influxdb.line_protocol import make_lines
+    return make_lines({"points": points})
+
+
+def _start_writer():
+    global _writer_thread
+    with _writer_lock:
+        if _writer_thread is None or not _writer_thread.is_alive():
+            _writer_thread = threading.Thread(target=_run_writer, name="influx-writer", daemon=True)
+            _writer_thread.start()
+    _schedule_window_closing()
+
+
+def log_reading(model, sensor_id, channel, temperature_C, humidity, tags=None):
+    """Queue temperature and humidity data for the background InfluxDB writer; `tags` are added to the point."""
+    started = time.perf_counter()
     if temperature_C is None or humidity is None:
         logger.warning(f"[Influx] Skipped write: missing temperature or humidity: "
                        f"temperature_C={temperature_C}, humidity={humidity}")
         return
 
-    influx_payload = [{
+    influx_point = {
         "measurement": "readings",
         "tags": {
             "model": str(model or "unknown"),
             "sensor_id": str(sensor_id or "unknown"),
             "channel": str(channel or "unknown"),
+            **(tags or {}),
         },
         "time": datetime.utcnow().isoformat(),
         "fields": {
             "temperature": float(temperature_C),
             "humidity": float(humidity)
         }
-    }]
+    }
+
+    if _writer_wakeup is None:
+        _start_writer()
+    aggregator = _aggregators.get(influx_point["measurement"])
+    if aggregator is None:
+        _enqueue(influx_point)
+    else:
+        for point in aggregator.add(influx_point, time.time()):
+            _enqueue(point)
+    _log_reading_seconds.observe(time.perf_counter() - started)
+
+
+def _enqueue(point):
+    try:
+        _queue.put_nowait(point)
+        _count("queued")
+        if _writer_wakeup is not None and _queue.qsize() >= INFLUX_BATCH_SIZE:
+            _writer_wakeup()
+    except queue.Full:
+        _count("dropped")
+        logger.warning("[Influx] Write queue full, dropped reading")
+
+
+def close_windows(now=None):
+    """Queue the summary of every aggregation window that has ended; runs on the timer service at each window end."""
+    now = time.time() if now is None else now
+    for aggregator in _aggregators.values():
+        for point in aggregator.expire(now):
+            _enqueue(point)
+
+
+def _run_writer():
+    logger.info("[Influx] Background writer started")
+    batch = []
+    deadline = time.monotonic() + INFLUX_FLUSH_INTERVAL
+    while True:
+        try:
+            timeout = max(0.0, deadline - time.monotonic())
+            batch.append(_queue.get(timeout=timeout))
+            if len(batch) < INFLUX_BATCH_SIZE:
+                continue
+        except queue.Empty:
+            batch.extend(drain_points(INFLUX_BATCH_SIZE - len(batch)))
+        except Exception:
+            logger.exception("[Influx] Writer loop error")
+
+        if batch:
+            _flush(batch)
+            batch = []
+        elif replay_due():
+            _replay_spool()
+        deadline = time.monotonic() + INFLUX_FLUSH_INTERVAL
+
+
+def _write(points):
+    started = time.monotonic()
+    try:
+        get_client().write_points(points)
+    finally:
+        elapsed = time.monotonic() - started
+        _flush_seconds.observe(elapsed)
+        with _stats_lock:
+            _stats["flushes"] += 1
+            _stats["last_flush_seconds"] = elapsed
+            _stats["max_flush_seconds"] = max(_stats["max_flush_seconds"], elapsed)
+
+
+def _flush(batch):
+    try:
+        _write(batch)
+        _count("written", len(batch))
+        logger.debug(f"[Influx] Data written: {len(batch)} points")
+    except Exception as e:
+        _count("failed_flushes")
+        logger.error(f"[Influx] Write operation failed, spooling {len(batch)} points: {e}")
+        _spool(batch)
+        return
+
+    # Database is reachable again, so drain anything left over from an outage
+    if replay_due():
+        _replay_spool()
+
+
+def _spool_size():
+    try:
+        return os.path.getsize(INFLUX_SPOOL_PATH)
+    except OSError:
+        return 0
+
+
+def _spool(batch):
+    if _spool_size() >= INFLUX_SPOOL_MAX_BYTES:
+        _count("dropped", len(batch))
+        logger.error(f"[Influx] Spool full ({INFLUX_SPOOL_MAX_BYTES} bytes), dropped {len(batch)} points")
+        return
+    try:
+        with open(INFLUX_SPOOL_PATH, "a") as f:
+            for point in batch:
+                f.write(json.dumps(point) + "\n")
+        _count("spooled", len(batch))
+    except OSError as e:
+        _count("dropped", len(batch))
+        logger.error(f"[Influx] Could not write spool file {INFLUX_SPOOL_PATH}: {e}")
+
 
+def _replay_spool():
+    """Write spooled points back to InfluxDB in chunks; see spool_replayed() for what happens to the file."""
+    points = read_spool()
+    written = 0
     try:
-        influx_client.write_points(influx_payload)
-        logger.debug(f"[Influx] Data written: {influx_payload}")
+        for i in range(0, len(points), INFLUX_BATCH_SIZE):
+            chunk = points[i:i + INFLUX_BATCH_SIZE]
+            _write(chunk)
+            written += len(chunk)
+            _count("written", len(chunk))
     except Exception as e:
-        logger.exception("[Influx] Write operation failed")
\ No newline at end of file
+        logger.warning(f"[Influx] Spool replay failed: {e}")
+    spool_replayed(points, written)
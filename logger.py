@@ -1,13 +1,106 @@
 
+import atexit
 import logging
 import logging.config
+import logging.handlers
 import os
+import queue
+import threading
+import time
+from config import LOG_QUEUE_SIZE, SUSPICIOUS_LOG_RATE, SUSPICIOUS_LOG_PERIOD
+import metrics
+
+# Callers only append records to an in-memory queue; a listener thread per channel does
+# the formatting and the file/console writes, so a slow SD card never stalls ingest.
+
+_listeners = []
+_dropped = metrics.counter("log_records_dropped")
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets at most `rate` records through per `period` seconds; the next one let through notes how many were dropped."""
+
+    def __init__(self, rate, period):
+        super().__init__()
+        self.rate = rate
+        self.period = period
+        self._window_start = 0.0
+        self._passed = 0
+        self._suppressed = 0
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        now = time.monotonic()
+        with self._lock:
+            if now - self._window_start >= self.period:
+                self._window_start = now
+                self._passed = 0
+            if self._passed >= self.rate:
+                self._suppressed += 1
+                return False
+            self._passed += 1
+            suppressed, self._suppressed = self._suppressed, 0
+        if suppressed:
+            record.msg = f"{record.msg} [{suppressed} earlier messages suppressed]"
+        return True
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops (and counts) records when the queue is full instead of raising."""
+
+    def prepare(self, record):
+        # The queue never leaves the process, so hand the record over as-is and let the
+        # listener thread do the %-formatting rather than the caller
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _dropped.inc()
+
+
+def start_queue_logging():
+    """
+    Move the handlers of the root and `suspicious` loggers behind QueueListeners. Each
+    logger keeps one NonBlockingQueueHandler; the `suspicious` channel is rate limited
+    before its records are even queued.
+    """
+    if _listeners:
+        return
+    for name, record_filter in ((None, None),
+                                ("suspicious", RateLimitFilter(SUSPICIOUS_LOG_RATE, SUSPICIOUS_LOG_PERIOD))):
+        target_logger = logging.getLogger(name)
+        handlers = [h for h in target_logger.handlers if not isinstance(h, NonBlockingQueueHandler)]
+        if not handlers:
+            continue
+        queue_handler = NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+        queue_handler.setLevel(min(h.level for h in handlers))
+        if record_filter is not None:
+            queue_handler.addFilter(record_filter)
+        for handler in handlers:
+            target_logger.removeHandler(handler)
+        target_logger.addHandler(queue_handler)
+
+        listener = logging.handlers.QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+        listener.start()
+        _listeners.append(listener)
+    atexit.register(stop_queue_logging)
+
+
+def stop_queue_logging():
+    """Flush whatever is queued and stop the listener threads."""
+    while _listeners:
+        _listeners.pop().stop()
+
 
 # Logging Setup
 def setup_logging():
     # Load logging config from external file
     config_file = os.path.join(os.path.dirname(__file__), "logging.conf")
     if os.path.exists(config_file):
-        logging.config.fileConfig(config_file)
+        # modules create their loggers ("influx", "suspicious") at import, before this runs
+        logging.config.fileConfig(config_file, disable_existing_loggers=False)
     else:
         logging.basicConfig(filename='/home/debian/logs/ninja2mqtt.log', level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    start_queue_logging()
@@ -0,0 +1,194 @@
+# metrics.py
+import bisect
+import json
+import logging
+import threading
+import time
+
+# Low-overhead counters and fixed-bucket histograms for the hot paths. Updates are plain
+# attribute adds without a lock: a rare lost increment under thread contention is an
+# acceptable price for keeping each observation to a few hundred nanoseconds.
+
+# Latency buckets in seconds, 50µs .. 5s
+DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+PROMETHEUS_PREFIX = "ninja2mqtt_"
+
+
+class Counter:
+    __slots__ = ("name", "value")
+
+    def __init__(self, name):
+        self.name = name
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Histogram:
+    __slots__ = ("name", "bounds", "counts", "sum", "count")
+
+    def __init__(self, name, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.bounds = tuple(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        return _Timer(self)
+
+    def quantile(self, q):
+        """Upper bucket bound containing quantile q (None when empty or beyond the last bucket)."""
+        if not self.count:
+            return None
+        target = q * self.count
+        running = 0
+        for bound, count in zip(self.bounds, self.counts):
+            running += count
+            if running >= target:
+                return bound
+        return None
+
+
+class _Timer:
+    __slots__ = ("histogram", "started")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started)
+        return False
+
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_stats_sources = {}
+
+
+def counter(name):
+    """Get or create a counter. Call once at import time and keep the object."""
+    with _lock:
+        if name not in _counters:
+            _counters[name] = Counter(name)
+        return _counters[name]
+
+
+def histogram(name, buckets=DEFAULT_BUCKETS):
+    with _lock:
+        if name not in _histograms:
+            _histograms[name] = Histogram(name, buckets)
+        return _histograms[name]
+
+
+def register_stats(prefix, source):
+    """Expose a module's existing stats dict (e.g. get_influx_stats) as gauges named <prefix>_<key>."""
+    with _lock:
+        _stats_sources[prefix] = source
+
+
+def _gauges():
+    values = {}
+    for prefix, source in list(_stats_sources.items()):
+        try:
+            stats = source()
+        except Exception as e:
+            logging.debug(f"[Metrics] Stats source '{prefix}' failed: {e}")
+            continue
+        for key, value in stats.items():
+            if isinstance(value, (int, float)):
+                values[f"{prefix}_{key}"] = value
+    return values
+
+
+def snapshot():
+    """Compact view: counters, histogram count/sum/p50/p99 and gauges."""
+    return {
+        "counters": {c.name: c.value for c in list(_counters.values())},
+        "histograms": {
+            h.name: {"count": h.count, "sum": round(h.sum, 6), "p50": h.quantile(0.5), "p99": h.quantile(0.99)}
+            for h in list(_histograms.values())
+        },
+        "gauges": _gauges(),
+    }
+
+
+def render_prometheus():
+    lines = []
+    for c in list(_counters.values()):
+        name = PROMETHEUS_PREFIX + c.name + "_total"
+        lines += [f"# TYPE {name} counter", f"{name} {c.value}"]
+    for h in list(_histograms.values()):
+        name = PROMETHEUS_PREFIX + h.name
+        lines.append(f"# TYPE {name} histogram")
+        running = 0
+        for bound, count in zip(h.bounds, h.counts):
+            running += count
+            lines.append(f'{name}_bucket{{le="{bound}"}} {running}')
+        lines.append(f'{name}_bucket{{le="+Inf"}} {h.count}')
+        lines += [f"{name}_sum {h.sum}", f"{name}_count {h.count}"]
+    for key, value in _gauges().items():
+        name = PROMETHEUS_PREFIX + key
+        lines += [f"# TYPE {name} gauge", f"{name} {float(value)}"]
+    return "\n".join(lines) + "\n"
+
+
+def publish_snapshot(client, topic):
+    try:
+        if client.is_connected():
+            client.publish(topic, json.dumps(snapshot(), separators=(",", ":")))
+    except Exception as e:
+        logging.error(f"[Metrics] Failed to publish metrics: {e}")
+
+
+def _run_publisher(client, topic, interval):
+    while True:
+        time.sleep(interval)
+        publish_snapshot(client, topic)
+
+
+def start_publisher(client, topic, interval):
+    thread = threading.Thread(target=_run_publisher, args=(client, topic, interval), name="metrics", daemon=True)
+    thread.start()
+    logging.info(f"[Metrics] Publishing snapshot to {topic} every {interval}s")
+    return thread
+
+
+def start_http_server(port, host="0.0.0.0"):
+    # http.server is only imported when the endpoint is enabled
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class PrometheusHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = render_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), PrometheusHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True)
+    thread.start()
+    logging.info(f"[Metrics] Prometheus endpoint on http://{host}:{port}/metrics")
+    return server
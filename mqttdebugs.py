@@ -1,44 +1,66 @@
 # mqttdebugs.py
 import logging
-import time
-from config import STATUS_LED_ID, EYES_LED_ID
-from scheduler import perform_blink, choose_blink_color, send_led
-from statehandler import get_all_states, current_states
+from scheduler import perform_blink, choose_blink_color, animator, get_led_colors
+from animator import Timeline
+from statehandler import get_all_states, get_changes_since, get_state_version
 from persisthandler import get_all_persisted_states
+from sensorregistry import registry as sensor_registry
 
-def handle_debugs(mqttclient, topic, payload):
-    
-    if topic == "ninjaCape/debug/states":
+
+def debug_states(mqttclient, payload):
+    # a version number as payload lists only what changed after that version
+    if payload.strip().isdigit():
+        version, state_snapshot = get_changes_since(int(payload))
+        logging.info(f"State changes since version {int(payload)} requested via MQTT (now {version}):")
+    else:
         state_snapshot = get_all_states()
-        logging.info("Current state dump requested via MQTT:")
-        for key, value in state_snapshot.items():
-            logging.info(f"  {key}: {value}")
-        return f"[Debug] States"  # or return True
-    
-    if topic == "ninjaCape/debug/shelf":
-        shelf_snapshot = get_all_persisted_states()
-        logging.info("Current shelf dump requested via MQTT:")
-        for key, value in shelf_snapshot.items():
-            logging.info(f"  {key}: {value}")
-        return f"[Debug] Shelf"  # or return True
-
-    if topic.startswith("ninjaCape/debug/blink"):
-        try:
-
-            if topic == "ninjaCape/debug/blink/1007":
-                send_led(1007, "000000")
-                time.sleep(1)
-                send_led(1007, "0000FF")
-                time.sleep(1)
-                send_led(1007, "00FF00")
-            else:
-                count = int(payload) if payload.isdigit() else 12
-                status_before = current_states.get(str(STATUS_LED_ID), "0000FF")
-                eyes_before = current_states.get(str(EYES_LED_ID), "0000FF")
-                blink_color = choose_blink_color(status_before, eyes_before)
-
-                perform_blink(count, blink_color, status_before, eyes_before)
-                logging.info(f"Manually triggered blink for {count} o'clock")
-        except Exception as e:
-            logging.error(f"Failed to trigger manual blink: {e}")
-        return f"[Debug] Blink triggered for {count} blinks"  # or return True
\ No newline at end of file
+        logging.info(f"Current state dump requested via MQTT (version {get_state_version()}):")
+    for key, value in state_snapshot.items():
+        logging.info(f"  {key}: {value}")
+
+
+def debug_shelf(mqttclient, payload):
+    shelf_snapshot = get_all_persisted_states()
+    logging.info("Current shelf dump requested via MQTT:")
+    for key, value in shelf_snapshot.items():
+        logging.info(f"  {key}: {value}")
+
+
+def debug_sensors(mqttclient, payload):
+    logging.info("RF sensors requested via MQTT:")
+    for sensor in sensor_registry.known():
+        logging.info(f"  known {sensor.key}: {sensor.name}")
+    for key, entry in sensor_registry.quarantined().items():
+        logging.info(f"  quarantined {key}: {entry['frames']} frames, last {entry['temperature']}°C "
+                     f"{entry['humidity']}%")
+
+
+def debug_blink_1007(mqttclient, payload):
+    try:
+        timeline = Timeline().set(1007, "000000", hold=1).set(1007, "0000FF", hold=1).set(1007, "00FF00")
+        animator.play(timeline.build("debug blink 1007"))
+    except Exception as e:
+        logging.error(f"Failed to trigger manual blink: {e}")
+
+
+def debug_blink(mqttclient, payload):
+    try:
+        count = int(payload) if payload.isdigit() else 12
+        status_before, eyes_before = get_led_colors()
+        blink_color = choose_blink_color(status_before, eyes_before)
+
+        perform_blink(count, blink_color, status_before, eyes_before)
+        logging.info(f"Manually triggered blink for {count} o'clock")
+    except Exception as e:
+        logging.error(f"Failed to trigger manual blink: {e}")
+
+
+# (pattern, handler) pairs for mqtthandler's router; handlers take (mqttclient, payload)
+DEBUG_ROUTES = (
+    ("ninjaCape/debug/states", debug_states),
+    ("ninjaCape/debug/shelf", debug_shelf),
+    ("ninjaCape/debug/sensors", debug_sensors),
+    ("ninjaCape/debug/blink", debug_blink),
+    ("ninjaCape/debug/blink/1007", debug_blink_1007),
+    ("ninjaCape/debug/blink/+", debug_blink),
+)
@@ -1,125 +1,301 @@
 # mqtthandler.py
 import logging
 import json
+import threading
 import time
+from collections import OrderedDict
+from functools import partial
 import paho.mqtt.client as mqtt
 from utils import convert_to_hex
 from notifier import send_notification
 from config import MQTT_BROKER, MQTT_PORT
-from serialhandler import send_ninjacape_messages
+from config import MQTT_TOPIC_POLICIES, MQTT_OFFLINE_BUFFER_SIZE
+from config import MQTT_RECONNECT_MIN_DELAY, MQTT_RECONNECT_MAX_DELAY
+from config import PUBLISH_FILTER_RULES, PUBLISH_FILTER_CACHE_SIZE
+from config import HISTORY_QUERY_TOPIC, HISTORY_RESPONSE_TOPIC
+from publishfilter import PublishFilter
+from serialhandler import send_ninjacape_messages, capes
 from statehandler import set_state
 from config import STATUS_LED_ID, EYES_LED_ID
-from mqttdebugs import handle_debugs
+from mqttdebugs import DEBUG_ROUTES
+from topicrouter import TopicRouter
+from scheduler import animator_for
+from sensorregistry import registry as sensor_registry
+import historyhandler
+import metrics
 
-# Cache of recent publishes
-recent_publishes = {}
 
-# Device IDs to throttle
-THROTTLED_IDS = {999, 1007, 30, 31}
-THROTTLE_SECONDS = 300  # 5 minutes
+def _filter_rules():
+    """PUBLISH_FILTER_RULES plus the topic rules of each registered RF sensor on every cape."""
+    rules = {}
+    for cape in capes:
+        for sensor in sensor_registry.known():
+            rules.update(sensor.filter_rules(cape))
+    rules.update(PUBLISH_FILTER_RULES)
+    return rules
 
 
-def setup_mqtt():
-    client = mqtt.Client(client_id="beaglebone-ninja")
+# Suppresses duplicate / within-deadband publishes, see PUBLISH_FILTER_RULES
+publish_filter = PublishFilter(_filter_rules(), PUBLISH_FILTER_CACHE_SIZE)
+
+_publish_seconds = metrics.histogram("mqtt_publish_seconds")
+_throttled = metrics.counter("mqtt_publish_throttled")
+_inbound = metrics.counter("mqtt_messages_received")
+_inbound_errors = metrics.counter("mqtt_message_errors")
+
+DEFAULT_TOPIC_POLICY = {"qos": 0, "retain": False, "latest_only": False}
+_policy_cache = {}
+
+# Outbound publish state. While the broker is unreachable publishes are held in
+# _offline_buffer (latest value only for state topics) and replayed on reconnect.
+_pub_lock = threading.Lock()
+_connected = False
+_offline_buffer = OrderedDict()
+_buffer_seq = 0
+_unacked = set()  # mids of QoS>0 publishes the broker has not acknowledged yet
+_pub_stats = {"published": 0, "acked": 0, "buffered": 0, "replayed": 0, "dropped": 0, "errors": 0}
+
+
+def topic_policy(topic):
+    """QoS/retain/latest_only for a topic, from the first matching MQTT_TOPIC_POLICIES pattern."""
+    policy = _policy_cache.get(topic)
+    if policy is None:
+        policy = DEFAULT_TOPIC_POLICY
+        for pattern, settings in MQTT_TOPIC_POLICIES:
+            if mqtt.topic_matches_sub(pattern, topic):
+                policy = {**DEFAULT_TOPIC_POLICY, **settings}
+                break
+        if len(_policy_cache) < 1024:
+            _policy_cache[topic] = policy
+    return policy
+
+
+def get_mqtt_stats():
+    with _pub_lock:
+        stats = dict(_pub_stats)
+        stats["connected"] = _connected
+        stats["queued"] = len(_offline_buffer)
+        stats["in_flight"] = len(_unacked)
+    return stats
+
+
+metrics.register_stats("mqtt", get_mqtt_stats)
+metrics.register_stats("publish_filter", publish_filter.stats)
+
+
+def _buffer_publish(topic, payload, policy):
+    """Hold a publish until reconnect; caller holds _pub_lock."""
+    global _buffer_seq
+    if policy["latest_only"]:
+        key = topic
+        _offline_buffer.pop(key, None)
+    else:
+        _buffer_seq += 1
+        key = (topic, _buffer_seq)
+    _offline_buffer[key] = (topic, payload)
+    _pub_stats["buffered"] += 1
+    while len(_offline_buffer) > MQTT_OFFLINE_BUFFER_SIZE:
+        _offline_buffer.popitem(last=False)
+        _pub_stats["dropped"] += 1
+
+
+def _send(client, topic, payload):
+    """Publish now, or buffer if disconnected / paho refuses; caller holds _pub_lock."""
+    policy = topic_policy(topic)
+    if not client.is_connected():
+        _buffer_publish(topic, payload, policy)
+        return False
+
+    info = client.publish(topic, payload, qos=policy["qos"], retain=policy["retain"])
+    if info.rc != mqtt.MQTT_ERR_SUCCESS:
+        _pub_stats["errors"] += 1
+        logging.warning(f"[MQTTHandler] Publish to {topic} failed (rc={info.rc}), buffering")
+        _buffer_publish(topic, payload, policy)
+        return False
+
+    _pub_stats["published"] += 1
+    if policy["qos"] > 0:
+        _unacked.add(info.mid)
+    if policy["latest_only"]:
+        # an older value still waiting for replay must not overwrite this one
+        _offline_buffer.pop(topic, None)
+    return True
+
+
+def _replay_offline_buffer(client):
+    with _pub_lock:
+        _replay_locked(client)
+
+
+def _replay_locked(client):
+    """Send everything buffered while offline, oldest first; caller holds _pub_lock."""
+    pending = list(_offline_buffer.values())
+    _offline_buffer.clear()
+    replayed = 0
+    for topic, payload in pending:
+        if not _send(client, topic, payload):
+            break
+        replayed += 1
+    _pub_stats["replayed"] += replayed
+    if pending:
+        logging.info(f"[MQTTHandler] Replayed {replayed}/{len(pending)} buffered publishes after reconnect")
+
+
+def _output_root(client, payload, cape):
+    logging.debug(f"[MQTTHandler] Received {cape.topic_prefix}/output root message — ignoring.")
+
+
+def _led_on(client, payload, cape, device_id):
+    if str(payload).lower() == "true":
+        return
+    animator_for(cape).preempt(device_id)
+    command = json.dumps({"DEVICE": [{"G": "0", "V": 0, "D": device_id, "DA": "000000"}]})
+    send_ninjacape_messages(command, cape)
+
+
+def _led_colour(client, payload, cape, device_id):
+    #convert to hex if tuple
+    moderated = convert_to_hex(payload)
+    # an explicit colour wins over any running blink on this LED
+    animator_for(cape).preempt(device_id)
+    command = json.dumps({"DEVICE": [{"G": "0", "V": 0, "D": device_id, "DA": str(moderated)}]})
+    set_state(cape.state_key(device_id), moderated)
+    send_ninjacape_messages(command, cape)
+
+    if device_id == 674:
+        logging.info(f"Message from device 674: {moderated}")
+        send_notification(f"Message from device 674: {moderated}", category="mqtt-674")
+
+
+def _history_query(client, payload):
+    # the range query runs on the history worker, not on paho's network thread
+    historyhandler.submit_query(payload, lambda response: publish_payload(client, HISTORY_RESPONSE_TOPIC, response))
+
+
+def build_router():
+    """Routes for every cape's <prefix>/output topics, history queries and the debug topics; handlers take (client, payload)."""
+    topic_router = TopicRouter()
+    for cape in capes:
+        prefix = cape.topic_prefix
+        topic_router.add(f"{prefix}/output", partial(_output_root, cape=cape))
+        topic_router.add(f"{prefix}/output/{{device_id:int}}", partial(_led_colour, cape=cape))
+        topic_router.add(f"{prefix}/output/{{device_id:int}}/on", partial(_led_on, cape=cape))
+    topic_router.add(HISTORY_QUERY_TOPIC, _history_query)
+    for pattern, handler in DEBUG_ROUTES:
+        topic_router.add(pattern, handler)
+    return topic_router
+
+
+router = build_router()
+metrics.register_stats("mqtt_router", router.stats)
+
+
+def create_mqtt_client(client_id="beaglebone-ninja"):
+    """Client with the bridge's callbacks attached, not yet connected."""
+    client = mqtt.Client(client_id=client_id)
 
     def on_connect(client, userdata, flags, rc):
+        global _connected
         if rc == 0:
             logging.info("[MQTTHandler] Connected to MQTT broker")
-            client.subscribe("ninjaCape/output/#")
+            # one connection for every cape: each listens on its own <prefix>/output/#
+            client.subscribe([(f"{cape.topic_prefix}/output/#", 0) for cape in capes])
             client.subscribe("ninjaCape/debug/#")
+            client.subscribe(HISTORY_QUERY_TOPIC)
+            # replay before marking connected, with no live publish in between
+            with _pub_lock:
+                _replay_locked(client)
+                _connected = True
         else:
             logging.error(f"[MQTTHandler] MQTT connection failed with code {rc}")
 
+    def on_disconnect(client, userdata, rc):
+        global _connected
+        with _pub_lock:
+            _connected = False
+        if rc != 0:
+            logging.warning(f"[MQTTHandler] Unexpected disconnect (rc={rc}), buffering publishes until reconnect")
+
+    def on_publish(client, userdata, mid, *args):
+        # paho reports QoS 0 publishes here too; only QoS>0 mids are waiting for an ack
+        with _pub_lock:
+            if mid in _unacked:
+                _unacked.discard(mid)
+                _pub_stats["acked"] += 1
+
     def on_message(client, userdata, msg):
-        payload = msg.payload.decode()
-        topic = msg.topic
-        topic_parts = topic.split("/")
+        _inbound.inc()
         try:
-
             if msg.retain:
                 logging.debug(
                     f"[MQTTHandler] Skipped retained message from broker — "
                     f"topic: '{msg.topic}', payload: '{msg.payload.decode()}'"
                 )
                 return
-
-            if topic == "ninjaCape/output":
-                logging.debug("[MQTTHandler] Received ninjaCape/output root message — ignoring.")
-                return
-            
-            if topic.startswith("ninjaCape/debug/"):
-                handle_debugs(client, topic, payload)
-                return
-            
-            if topic_parts[-1] == "on":
-                device_id = int(topic_parts[-2])
-                is_on = str(payload).lower() == "true"
-                if not is_on:
-                    command = json.dumps({"DEVICE": [{"G": "0", "V": 0, "D": int(device_id), "DA": "000000"}]})
-                else:
-                    return
-            else:
-                # Handle RGB
-                device_id = int(topic_parts[-1])
-                #convert to hex if tuple
-                moderated = convert_to_hex(payload)
-                command = json.dumps({"DEVICE": [{"G": "0", "V": 0, "D": int(device_id), "DA": str(moderated)}]})
-                #current_states[device_id] = moderated
-                set_state(device_id, moderated)
-
-             # Send command to NinjaCape via Serial
-            send_ninjacape_messages(command)
-            #ser.write((command + "\n").encode("utf-8"))
-            #logging.info(f"Sent to serial: {command}")
-
-            if int(device_id) == 674:
-                logging.info(f"Message from device 674: {moderated}")
-                send_notification(f"Message from device 674: {moderated}")
-
-
-            #logging.debug(f"MQTT received on topic: {msg.topic}, payload: {payload}")
-            #logging.debug(f"Device ID: {device_id}, Moderated: {moderated}")
-            #logging.debug(f"Final command: {command}")
-            #serial_bytes = (command + "\n").encode("utf-8")
-            #logging.debug(f"[MQTTHandler] Serial payload bytes: {serial_bytes}")
-
-
+            router.dispatch(msg.topic, client, msg.payload.decode())
         except Exception as e:
+            _inbound_errors.inc()
             logging.error(f"[MQTTHandler] Error processing MQTT message: {e}")
-            send_notification(f"[MQTTHandler] MQTT processing error: {e}")
+            send_notification(f"[MQTTHandler] MQTT processing error: {e}", category="mqtt-error")
 
     client.on_connect = on_connect
+    client.on_disconnect = on_disconnect
     client.on_message = on_message
-    client.connect(MQTT_BROKER, MQTT_PORT, keepalive=60)
+    client.on_publish = on_publish
+    client.reconnect_delay_set(min_delay=MQTT_RECONNECT_MIN_DELAY, max_delay=MQTT_RECONNECT_MAX_DELAY)
+    return client
+
+
+def setup_mqtt(client_id="beaglebone-ninja"):
+    client = create_mqtt_client(client_id)
+    # paho's network thread reconnects on its own, backing off between attempts
+    client.connect_async(MQTT_BROKER, MQTT_PORT, keepalive=60)
     client.loop_start()
     return client
-    
+
+
+def wait_connected(timeout):
+    """Block until on_connect has run (and replayed the offline buffer); False on timeout."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with _pub_lock:
+            if _connected:
+                return True
+        time.sleep(0.05)
+    return False
+
+
+def wait_delivered(timeout):
+    """Block until nothing is buffered offline or waiting for a QoS>0 ack; False on timeout."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with _pub_lock:
+            if not _offline_buffer and not _unacked:
+                return True
+        time.sleep(0.05)
+    return False
+
 
 def publish_payload(client, topic, payload, dev_id=None):
     """
-    Publish to MQTT, applying throttling logic for specific dev_ids.
+    Publish to MQTT unless the publish filter rules for this topic/device suppress it.
     """
 
+    started = time.perf_counter()
     try:
         dev_id = int(dev_id)
     except (TypeError, ValueError):
         dev_id = None
 
-    if dev_id in THROTTLED_IDS:
-        logging.debug(f"[MQTTHandler] [THROTTLE] Checking {dev_id=} {topic=} {payload=}")
-        now = time.time()
-        cache_key = (dev_id, topic)  # 🔄 Cache key uses dev_id AND topic
-        last_entry = recent_publishes.get(cache_key)
-
-        if last_entry:
-            last_time = last_entry["timestamp"]
-            last_value = last_entry["payload"]
-            if last_value == payload and now - last_time < THROTTLE_SECONDS:
-                logging.debug(f"[MQTTHandler] [THROTTLE] Throttled publish for {topic} (dev_id={dev_id}, unchanged, <5m)")
-                return
-
-        recent_publishes[cache_key] = {"timestamp": now, "payload": payload}
+    if not publish_filter.should_publish(topic, payload, dev_id):
+        _throttled.inc()
+        logging.debug("[MQTTHandler] [THROTTLE] Throttled publish for %s (dev_id=%s, payload=%s)", topic, dev_id, payload)
+        return
 
-    client.publish(topic, payload)
-    logging.info(f"[MQTTHandler] Published: {topic} -> {payload}")
-    
\ No newline at end of file
+    with _pub_lock:
+        sent = _send(client, topic, payload)
+    _publish_seconds.observe(time.perf_counter() - started)
+    if sent:
+        logging.info("[MQTTHandler] Published: %s -> %s", topic, payload)
+    else:
+        logging.debug("[MQTTHandler] Buffered while offline: %s -> %s", topic, payload)
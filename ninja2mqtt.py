@@ -1,24 +1,49 @@
 # ninja2mqtt.py
+import argparse
 import logging
-import threading
 
 from logger import setup_logging
 from config import SERIAL_PORT, BAUD_RATE, SERIAL_TIMEOUT
 from serialhandler import init_serial, process_ninjacape_messages
 from mqtthandler import setup_mqtt
-from scheduler import run_scheduler
+from influxhandler import start_influx_writer
+from scheduler import start_scheduler
+from statehandler import restore_states, start_checkpointing
+from config import METRICS_TOPIC, METRICS_INTERVAL, METRICS_HTTP_PORT
+import metrics
 
 
 def main():
+    parser = argparse.ArgumentParser(description="NinjaCape to MQTT bridge")
+    parser.add_argument("--asyncio", action="store_true", help="run everything on one asyncio event loop")
+    args = parser.parse_args()
+
     setup_logging()
     logging.info("Starting NinjaCape MQTT Bridge")
 
+    # Warm start: last known LED colours and sensor values before anything reports in
+    restore_states()
+    start_checkpointing()
+
     init_serial()
+    if METRICS_HTTP_PORT:
+        metrics.start_http_server(METRICS_HTTP_PORT)
+
+    if args.asyncio:
+        # imported here so the threaded runtime never loads asyncio
+        import asyncruntime
+        asyncruntime.run()
+        return
+
     mqtt_client = setup_mqtt()
 
-    # Start the scheduler after mqtt is ready
-    scheduler_thread = threading.Thread(target=run_scheduler, args=(), daemon=True)
-    scheduler_thread.start()
+    # Sinks connect in the background once serial and MQTT are live
+    start_influx_writer()
+
+    metrics.start_publisher(mqtt_client, METRICS_TOPIC, METRICS_INTERVAL)
+
+    # Start the scheduler after mqtt is ready; its jobs run on the timer service thread
+    start_scheduler()
 
     process_ninjacape_messages(mqtt_client)
 
@@ -1,19 +1,189 @@
 import logging
-import requests
+import queue
+import threading
+import time
+from collections import deque
 from config import PUSHOVER_USER_KEY, PUSHOVER_API_TOKEN
+from config import NOTIFY_QUEUE_SIZE, NOTIFY_TIMEOUT, NOTIFY_COALESCE_SECONDS
+from config import NOTIFY_RATE_LIMIT, NOTIFY_RATE_PERIOD
+import metrics
 
-def send_notification(message, title="NinjaCape Alert"):
+PUSHOVER_URL = "https://api.pushover.net/1/messages.json"
+
+_queue = queue.Queue(maxsize=NOTIFY_QUEUE_SIZE)
+_dispatcher_thread = None
+_dispatcher_wakeup = None
+_dispatcher_lock = threading.Lock()
+
+_send_seconds = metrics.histogram("notify_send_seconds")
+_post_seconds = metrics.histogram("notify_post_seconds")
+
+_stats_lock = threading.Lock()
+_stats = {
+    "queued": 0,
+    "sent": 0,
+    "failed": 0,
+    "coalesced": 0,
+    "rate_limited": 0,
+    "dropped": 0,
+}
+
+
+def _count(name, amount=1):
+    with _stats_lock:
+        _stats[name] += amount
+
+
+def get_notifier_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["queue_depth"] = _queue.qsize()
+    return stats
+
+
+metrics.register_stats("notify", get_notifier_stats)
+
+
+def send_notification(message, title="NinjaCape Alert", category=None):
+    """
+    Queue a Pushover notification. Returns immediately; delivery, coalescing of
+    repeated messages and per-category rate limiting happen on the dispatcher thread.
+    """
     if not PUSHOVER_USER_KEY or not PUSHOVER_API_TOKEN:
         logging.error("Pushover credentials not set. Skipping notification.")
         return
 
+    started = time.perf_counter()
+    if _dispatcher_wakeup is None:
+        _start_dispatcher()
     try:
-        response = requests.post("https://api.pushover.net/1/messages.json", data={
-            "token": PUSHOVER_API_TOKEN,
-            "user": PUSHOVER_USER_KEY,
-            "message": message,
-            "title": title
-        })
-        response.raise_for_status()
-    except requests.RequestException as e:
-        logging.error(f"Failed to send Pushover notification: {e}")
+        _queue.put_nowait((category or title, title, str(message)))
+        _count("queued")
+        if _dispatcher_wakeup is not None:
+            _dispatcher_wakeup()
+    except queue.Full:
+        _count("dropped")
+        logging.debug(f"[Notifier] Queue full, dropped notification: {message}")
+    _send_seconds.observe(time.perf_counter() - started)
+
+
+def attach_dispatcher(wakeup):
+    """
+    Let an external driver (the asyncio runtime) deliver instead of the dispatcher thread:
+    wakeup() is called after each enqueue; the driver feeds drain_notifications() into
+    make_dispatcher(post).
+    """
+    global _dispatcher_wakeup
+    _dispatcher_wakeup = wakeup
+
+
+def drain_notifications():
+    items = []
+    while True:
+        try:
+            items.append(_queue.get_nowait())
+        except queue.Empty:
+            return items
+
+
+def make_dispatcher(post):
+    """Coalescing / rate-limiting front end; post(title, message) does the delivery."""
+    return _Dispatcher(post)
+
+
+def record_post(ok, elapsed):
+    _post_seconds.observe(elapsed)
+    _count("sent" if ok else "failed")
+
+
+def pushover_form(title, message):
+    return {"token": PUSHOVER_API_TOKEN, "user": PUSHOVER_USER_KEY, "message": message, "title": title}
+
+
+def _start_dispatcher():
+    global _dispatcher_thread
+    with _dispatcher_lock:
+        if _dispatcher_thread is None or not _dispatcher_thread.is_alive():
+            _dispatcher_thread = threading.Thread(target=_run_dispatcher, name="notifier", daemon=True)
+            _dispatcher_thread.start()
+
+
+class _Dispatcher:
+    def __init__(self, post):
+        self.post = post
+        # (category, title, message) -> [first_seen, repeats_since_sent]
+        self.windows = {}
+        # category -> deque of send times inside the rate period
+        self.sent_times = {}
+
+    def handle(self, category, title, message, now):
+        key = (category, title, message)
+        window = self.windows.get(key)
+        if window is not None:
+            window[1] += 1
+            _count("coalesced")
+            return
+        self.windows[key] = [now, 0]
+        self.deliver(category, title, message, now)
+
+    def expire(self, now):
+        """Close finished coalescing windows, sending one summary for any repeats."""
+        for key, (first_seen, repeats) in list(self.windows.items()):
+            if now - first_seen < NOTIFY_COALESCE_SECONDS:
+                continue
+            del self.windows[key]
+            if repeats:
+                category, title, message = key
+                summary = f"{message} ×{repeats + 1} in {NOTIFY_COALESCE_SECONDS}s"
+                self.deliver(category, title, summary, now)
+
+    def next_deadline(self):
+        if not self.windows:
+            return None
+        return min(first_seen for first_seen, _ in self.windows.values()) + NOTIFY_COALESCE_SECONDS
+
+    def deliver(self, category, title, message, now):
+        sent = self.sent_times.setdefault(category, deque())
+        while sent and now - sent[0] >= NOTIFY_RATE_PERIOD:
+            sent.popleft()
+        if len(sent) >= NOTIFY_RATE_LIMIT:
+            _count("rate_limited")
+            logging.warning(f"[Notifier] Rate limit reached for '{category}', not sent: {message}")
+            return
+        sent.append(now)
+        self.post(title, message)
+
+
+def _run_dispatcher():
+    # requests costs ~100ms and several MB to import; only pay for it once something is sent
+    import requests
+    import requests.adapters
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=2, max_retries=1)
+    session.mount("https://", adapter)
+
+    def post(title, message):
+        started = time.perf_counter()
+        ok = False
+        try:
+            response = session.post(PUSHOVER_URL, data=pushover_form(title, message), timeout=NOTIFY_TIMEOUT)
+            response.raise_for_status()
+            ok = True
+        except requests.RequestException as e:
+            logging.error(f"Failed to send Pushover notification: {e}")
+        record_post(ok, time.perf_counter() - started)
+
+    dispatcher = _Dispatcher(post)
+    while True:
+        try:
+            deadline = dispatcher.next_deadline()
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                category, title, message = _queue.get(timeout=timeout)
+                dispatcher.handle(category, title, message, time.monotonic())
+            except queue.Empty:
+                pass
+            dispatcher.expire(time.monotonic())
+        except Exception as e:
+            logging.error(f"[Notifier] Dispatcher error: {e}")
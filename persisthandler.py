@@ -1,31 +1,125 @@
+import atexit
+import logging
+import os
+import pickle
 import shelve
+import sqlite3
 import threading
-import os
-from config import SHELF_PATH
+import time
+from config import SHELF_PATH, PERSIST_DB_PATH, PERSIST_FLUSH_INTERVAL, PERSIST_SYNC
 
-# Path to persistent shelf file
-#SHELF_PATH = '/home/debian/ninja2mqtt_state.db'
+# State lives in a single SQLite database (WAL mode) that stays open for the life of
+# the process. Reads are served from an in-memory cache; writes are marked dirty and
+# committed in one transaction by a background flusher every PERSIST_FLUSH_INTERVAL
+# seconds (0 commits on every write). Values are pickled, as shelve did.
 
 # Internal lock for thread safety
 _lock = threading.Lock()
 
+_conn = None
+_cache = {}
+_dirty = {}
+_DELETED = object()
+_flusher_thread = None
+
+
+def _open():
+    """Open the store on first use; caller holds _lock."""
+    global _conn, _flusher_thread
+    if _conn is not None:
+        return
+
+    conn = sqlite3.connect(PERSIST_DB_PATH, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(f"PRAGMA synchronous={PERSIST_SYNC}")
+    conn.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value BLOB NOT NULL)")
+    for key, value in conn.execute("SELECT key, value FROM state"):
+        _cache[key] = pickle.loads(value)
+
+    if not _cache:
+        _import_shelf(conn)
+
+    _conn = conn
+    atexit.register(flush_persisted_states)
+    if PERSIST_FLUSH_INTERVAL > 0:
+        _flusher_thread = threading.Thread(target=_run_flusher, name="persist-flusher", daemon=True)
+        _flusher_thread.start()
+
+
+def _import_shelf(conn):
+    """One-off migration of the old shelve file into the SQLite store."""
+    if not any(os.path.exists(SHELF_PATH + suffix) for suffix in ("", ".db", ".dat")):
+        return
+    try:
+        with shelve.open(SHELF_PATH, flag="r") as db:
+            legacy = dict(db)
+    except Exception as e:
+        logging.warning(f"[Persist] Could not read legacy shelf {SHELF_PATH}: {e}")
+        return
+
+    with conn:
+        conn.execute("BEGIN")
+        conn.executemany("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)",
+                         [(key, pickle.dumps(value)) for key, value in legacy.items()])
+    _cache.update(legacy)
+    logging.info(f"[Persist] Imported {len(legacy)} keys from legacy shelf {SHELF_PATH}")
+
+
+def _commit():
+    """Write all dirty keys in one atomic transaction; caller holds _lock."""
+    if not _dirty or _conn is None:
+        return
+    upserts = [(key, pickle.dumps(value)) for key, value in _dirty.items() if value is not _DELETED]
+    deletes = [(key,) for key, value in _dirty.items() if value is _DELETED]
+    with _conn:
+        _conn.execute("BEGIN")
+        if upserts:
+            _conn.executemany("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", upserts)
+        if deletes:
+            _conn.executemany("DELETE FROM state WHERE key = ?", deletes)
+    _dirty.clear()
+
+
+def _run_flusher():
+    while True:
+        time.sleep(PERSIST_FLUSH_INTERVAL)
+        try:
+            flush_persisted_states()
+        except Exception as e:
+            logging.error(f"[Persist] Background flush failed: {e}")
+
+
+def _mark_dirty(key, value):
+    _dirty[key] = value
+    if PERSIST_FLUSH_INTERVAL <= 0:
+        _commit()
+
+
+def flush_persisted_states():
+    """Commit pending writes now (also run at exit)."""
+    with _lock:
+        _commit()
+
+
 def set_persisted_state(key: str, value):
     with _lock:
-        with shelve.open(SHELF_PATH, writeback=True) as db:
-            db[key] = value
+        _open()
+        _cache[key] = value
+        _mark_dirty(key, value)
 
 def get_persisted_state(key: str, default=None):
     with _lock:
-        with shelve.open(SHELF_PATH) as db:
-            return db.get(key, default)
+        _open()
+        return _cache.get(key, default)
 
 def delete_persisted_state(key: str):
     with _lock:
-        with shelve.open(SHELF_PATH, writeback=True) as db:
-            if key in db:
-                del db[key]
+        _open()
+        if key in _cache:
+            del _cache[key]
+            _mark_dirty(key, _DELETED)
 
 def get_all_persisted_states():
     with _lock:
-        with shelve.open(SHELF_PATH) as db:
-            return dict(db)  # return as a regular dict for inspection
+        _open()
+        return dict(_cache)  # return as a regular dict for inspection
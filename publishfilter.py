@@ -0,0 +1,79 @@
+# publishfilter.py
+import threading
+import time
+from collections import OrderedDict
+
+
+class PublishFilter:
+    """
+    Decides whether a publish is worth sending. Rules are looked up by topic first,
+    then by device id, and may set:
+      window    - seconds an unchanged payload is suppressed
+      deadband  - minimum numeric change (against the last published value) to publish
+      heartbeat - republish after this many seconds of silence regardless
+    The last published value per (dev_id, topic) is kept in an LRU cache of bounded size.
+    `clock` supplies `now` when the caller does not (replay.py points it at capture times).
+    """
+
+    def __init__(self, rules, max_entries=256, clock=time.time):
+        self.rules = dict(rules)
+        self.max_entries = max_entries
+        self.clock = clock
+        self._last = OrderedDict()
+        self._lock = threading.Lock()
+        self._counts = {"passed": 0, "suppressed_duplicate": 0, "suppressed_deadband": 0, "evicted": 0}
+
+    def rule_for(self, topic, dev_id):
+        return self.rules.get(topic) or self.rules.get(dev_id)
+
+    def should_publish(self, topic, payload, dev_id=None, now=None):
+        rule = self.rule_for(topic, dev_id)
+        if not rule:
+            with self._lock:
+                self._counts["passed"] += 1
+            return True
+
+        now = self.clock() if now is None else now
+        key = (dev_id, topic)
+        with self._lock:
+            last = self._last.get(key)
+            if last is not None:
+                self._last.move_to_end(key)
+                reason = self._suppress_reason(rule, last, payload, now)
+                if reason:
+                    self._counts[reason] += 1
+                    return False
+
+            self._last[key] = (payload, now)
+            if len(self._last) > self.max_entries:
+                self._last.popitem(last=False)
+                self._counts["evicted"] += 1
+            self._counts["passed"] += 1
+            return True
+
+    @staticmethod
+    def _suppress_reason(rule, last, payload, now):
+        last_payload, last_time = last
+        age = now - last_time
+
+        heartbeat = rule.get("heartbeat")
+        if heartbeat and age >= heartbeat:
+            return None
+
+        if last_payload == payload and age < rule.get("window", 0):
+            return "suppressed_duplicate"
+
+        deadband = rule.get("deadband")
+        if deadband:
+            try:
+                if abs(float(payload) - float(last_payload)) < deadband:
+                    return "suppressed_deadband"
+            except (TypeError, ValueError):
+                pass
+        return None
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counts)
+            stats["cached"] = len(self._last)
+        return stats
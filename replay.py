@@ -0,0 +1,173 @@
+# replay.py
+"""
+Feed frames from the raw capture ring (framecapture.py) back through the decoding pipeline.
+
+    python replay.py --list --since "2026-10-18 07:00"   # print the captured lines
+    python replay.py --since 1760770800 --until 1760774400
+                                                          # dry run: decode everything, report publishes
+    python replay.py --speed 10                           # keep the original spacing, 10x faster
+    python replay.py --mqtt --speed 1                     # publish to the configured broker
+
+Replays never write to InfluxDB or send Pushover notifications; those are counted instead.
+The publish filter runs on the capture timestamps, so a sped-up replay suppresses the same
+publishes the live bridge did. With --mqtt the replay connects under its own client id (the
+bridge can stay up) and waits for the broker before the first frame and for every publish to
+be acknowledged before exiting.
+"""
+import argparse
+import logging
+import os
+import time
+from collections import Counter
+from datetime import datetime
+
+import historyhandler
+import influxhandler
+import metrics
+import mqtthandler
+import notifier
+import serialhandler
+from config import CAPTURE_PATH
+from framecapture import FrameRing
+
+CONNECT_TIMEOUT = 30   # seconds to wait for the broker with --mqtt
+DELIVER_TIMEOUT = 60   # seconds to wait for buffered and unacknowledged publishes before exiting
+
+
+class DryRunClient:
+    """Stand-in MQTT client that records publishes instead of sending them."""
+
+    def __init__(self, verbose=False):
+        self.verbose = verbose
+        self.topics = Counter()
+
+    def is_connected(self):
+        return True
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        self.topics[topic] += 1
+        if self.verbose:
+            print(f"  {topic} -> {payload}")
+        return _MessageInfo(sum(self.topics.values()))
+
+
+class _MessageInfo:
+    rc = 0
+
+    def __init__(self, mid):
+        self.mid = mid
+
+
+def parse_time(value):
+    """Unix seconds or an ISO date/time (local time)."""
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+def list_frames(ring, since, until):
+    for timestamp, cape_index, line in ring.records(since, until):
+        when = datetime.fromtimestamp(timestamp).isoformat(sep=" ", timespec="milliseconds")
+        print(f"{when} [{cape_index}] {line.decode('utf-8', 'replace')}")
+
+
+def replay(ring, client, since=None, until=None, speed=None):
+    """Process every frame in the range; returns counts of frames, Influx points and notifications."""
+    counts = Counter()
+
+    # Sinks stay inside this process: queued points and notifications are counted and discarded
+    def drain_influx():
+        counts["influx_points"] += len(influxhandler.drain_points())
+
+    def drain_notifications():
+        counts["notifications"] += len(notifier.drain_notifications())
+
+    influxhandler.attach_writer(drain_influx)
+    notifier.attach_dispatcher(drain_notifications)
+    # replayed readings are already in the local history
+    historyhandler.set_recording(False)
+
+    # window, deadband and heartbeat are judged by when the frame arrived, not when it is replayed
+    frame_time = None
+    clock = mqtthandler.publish_filter.clock
+    mqtthandler.publish_filter.clock = lambda: frame_time
+    started = time.monotonic()
+    first = None
+    try:
+        for timestamp, cape_index, line in ring.records(since, until):
+            if speed:
+                if first is None:
+                    first = timestamp
+                delay = started + (timestamp - first) / speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            cape = serialhandler.capes[cape_index] if cape_index < len(serialhandler.capes) else serialhandler.default_cape
+            frame_time = timestamp
+            serialhandler.process_frame(client, line, cape, received_at=timestamp)
+            counts["frames"] += 1
+    finally:
+        mqtthandler.publish_filter.clock = clock
+
+    influxhandler.close_windows(now=float("inf"))
+    counts["influx_points"] += len(influxhandler.drain_points(limit=float("inf")))
+    return counts
+
+
+def report(counts, elapsed, client):
+    counters = metrics.snapshot()["counters"]
+    print(f"replayed {counts['frames']} frames in {elapsed:.2f}s")
+    print(f"invalid={counters.get('serial_invalid_frames', 0)} unknown={counters.get('serial_unknown_frames', 0)} "
+          f"rf_invalid={counters.get('rf_invalid_readings', 0)} influx_points={counts['influx_points']} "
+          f"notifications={counts['notifications']}")
+    if isinstance(client, DryRunClient):
+        print(f"publishes={sum(client.topics.values())}")
+        for topic, count in client.topics.most_common():
+            print(f"  {count:6d} {topic}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured NinjaCape serial frames")
+    parser.add_argument("--ring", default=CAPTURE_PATH, help="capture ring file")
+    parser.add_argument("--since", help="start time, unix seconds or ISO (local)")
+    parser.add_argument("--until", help="end time, unix seconds or ISO (local)")
+    parser.add_argument("--list", action="store_true", help="print the frames instead of replaying them")
+    parser.add_argument("--speed", type=float, default=None,
+                        help="keep the original spacing, sped up by this factor (default: as fast as possible)")
+    parser.add_argument("--mqtt", action="store_true", help="publish to the configured broker instead of a dry run")
+    parser.add_argument("--verbose", action="store_true", help="print every publish and keep bridge logging")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logging.disable(logging.CRITICAL)
+    ring = FrameRing(args.ring, readonly=True)
+    since, until = parse_time(args.since), parse_time(args.until)
+    if args.list:
+        list_frames(ring, since, until)
+        return
+
+    if args.mqtt:
+        # a client id of its own, or the broker would disconnect the running bridge
+        client = mqtthandler.setup_mqtt(client_id=f"beaglebone-ninja-replay-{os.getpid()}")
+        if not mqtthandler.wait_connected(CONNECT_TIMEOUT):
+            client.loop_stop()
+            raise SystemExit(f"could not connect to the broker within {CONNECT_TIMEOUT}s")
+    else:
+        client = DryRunClient(verbose=args.verbose)
+
+    started = time.monotonic()
+    counts = replay(ring, client, since, until, args.speed)
+    if args.mqtt:
+        if not mqtthandler.wait_delivered(DELIVER_TIMEOUT):
+            stats = mqtthandler.get_mqtt_stats()
+            print(f"gave up after {DELIVER_TIMEOUT}s with {stats['queued']} publishes buffered "
+                  f"and {stats['in_flight']} unacknowledged")
+        client.disconnect()
+        client.loop_stop()
+    report(counts, time.monotonic() - started, client)
+
+
+if __name__ == "__main__":
+    main()
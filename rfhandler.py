@@ -1,89 +1,236 @@
 import logging
+import threading
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+from sensorregistry import registry as sensor_registry
 
 suspicious_logger = logging.getLogger("suspicious")
 
-def parse_sensor_data(value_str: str) -> dict:
-    result = {
-        "valid": True,
-        "reason": "Parsed successfully",
-    }
 
+class BitField(NamedTuple):
+    name: str
+    shift: int
+    mask: int
+    offset: int = 0
+
+    def extract(self, word):
+        return ((word >> self.shift) & self.mask) + self.offset
+
+
+# Protocol 5 (temperature/humidity) 32-bit word layout
+PROTOCOL_5_FIELDS = (
+    BitField("house", 28, 0x0F),
+    BitField("station", 26, 0x03, offset=1),
+    BitField("unknown", 18, 0xFF),
+    BitField("humidity", 16, 0xFF),
+    BitField("temperature", 8, 0xFF, offset=-50),
+    BitField("fraction", 4, 0x0F),
+    BitField("id", 0, 0x0F),
+)
+PROTOCOL_5 = {field.name: field for field in PROTOCOL_5_FIELDS}
+
+# Fraction nibble bits are worth 1/2, 1/4, 1/8 and 1/16 of a degree
+FRACTION_TABLE = tuple(
+    ((f >> 3) & 1) * 0.5 + ((f >> 2) & 1) * 0.25 + ((f >> 1) & 1) * 0.125 + (f & 1) * 0.0625
+    for f in range(16)
+)
+
+# Whole degrees and fraction are adjacent, so both decoders read them as one index:
+# (word >> TEMPERATURE_SHIFT) & TEMPERATURE_MASK, i.e. whole degrees << 4 | fraction
+TEMPERATURE_SHIFT = PROTOCOL_5["fraction"].shift
+TEMPERATURE_MASK = (PROTOCOL_5["temperature"].mask << (PROTOCOL_5["temperature"].shift - TEMPERATURE_SHIFT)
+                    | PROTOCOL_5["fraction"].mask)
+
+# Rounded temperature for every (whole degrees << 4 | fraction) index
+TEMPERATURE_TABLE = tuple(
+    round((index >> 4) + PROTOCOL_5["temperature"].offset + FRACTION_TABLE[index & 0x0F], 1)
+    for index in range(TEMPERATURE_MASK + 1)
+)
+
+TEMPERATURE_RANGE = (-50, 60)
+HUMIDITY_RANGE = (0, 100)
+
+# Reason codes carried by SensorReading
+REASON_OK = 0
+REASON_NOT_INTEGER = 1
+REASON_OUT_OF_RANGE = 2
+REASON_IMPLAUSIBLE = 3
+
+REASON_TEXT = {
+    REASON_OK: "Parsed successfully",
+    REASON_NOT_INTEGER: "Invalid input string: not a valid integer",
+    REASON_OUT_OF_RANGE: "Input out of expected 32-bit unsigned range",
+    REASON_IMPLAUSIBLE: "Parsed, but values fall outside typical temperature/humidity range",
+}
+
+
+class SensorReading(NamedTuple):
+    valid: bool
+    reason: int
+    house: Optional[int] = None
+    station: Optional[int] = None
+    humidity: Optional[int] = None
+    temperature: Optional[float] = None
+    id: Optional[int] = None
+    unknown: Optional[int] = None
+
+    @property
+    def reason_text(self):
+        return REASON_TEXT[self.reason]
+
+
+# (shift, mask, offset) of the integer fields decode_protocol_5 extracts, in this order
+_SCALAR_FIELDS = tuple(
+    (PROTOCOL_5[name].shift, PROTOCOL_5[name].mask, PROTOCOL_5[name].offset)
+    for name in ("house", "station", "humidity", "id", "unknown")
+)
+
+
+def decode_protocol_5(data: int) -> SensorReading:
+    """Decode a 32-bit protocol 5 word. Fields are always filled in, even if implausible."""
+    if not (0 <= data <= 0xFFFFFFFF):
+        return SensorReading(False, REASON_OUT_OF_RANGE)
+
+    house, station, humidity, sensor_id, unknown = [((data >> shift) & mask) + offset
+                                                    for shift, mask, offset in _SCALAR_FIELDS]
+    temperature = TEMPERATURE_TABLE[(data >> TEMPERATURE_SHIFT) & TEMPERATURE_MASK]
+    valid = (TEMPERATURE_RANGE[0] <= temperature <= TEMPERATURE_RANGE[1]
+             and HUMIDITY_RANGE[0] <= humidity <= HUMIDITY_RANGE[1])
+    return SensorReading(valid, REASON_OK if valid else REASON_IMPLAUSIBLE,
+                         house, station, humidity, temperature, sensor_id, unknown)
+
+
+def parse_sensor_data(value_str: str) -> SensorReading:
     try:
         # Support for both decimal and hex
         if value_str.startswith(("0x", "0X")):
             data = int(value_str, 16)
         else:
             data = int(value_str)
-    except (ValueError, TypeError):
-        return {
-            "valid": False,
-            "reason": "Invalid input string: not a valid integer"
-        }
+    except (ValueError, TypeError, AttributeError):
+        return SensorReading(False, REASON_NOT_INTEGER)
+    return decode_protocol_5(data)
 
-    # Check 32-bit range
-    if not (0 <= data <= 0xFFFFFFFF):
-        return {
-            "valid": False,
-            "reason": "Input out of expected 32-bit unsigned range"
-        }
-
-    # Extract fields
-    house = (data >> 28) & 0x0F
-    station = ((data >> 26) & 0x03) + 1
-    humidity = (data >> 16) & 0xFF
-    temperature_raw = (data >> 8) & 0xFF
-    temperature = temperature_raw - 50
-
-    tempfraction = (data >> 4) & 0x0F
-    tempdecimal = ((tempfraction >> 3) & 1) * 0.5 + \
-                  ((tempfraction >> 2) & 1) * 0.25 + \
-                  ((tempfraction >> 1) & 1) * 0.125 + \
-                  (tempfraction & 1) * 0.0625
-
-    temperature = round(temperature + tempdecimal, 1)
-
-    id_field = data & 0x0F
-    unknown = (data >> 18) & 0xFF
-
-    # Likelihood checks
-    likely_temp = -50 <= temperature <= 60
-    likely_humidity = 0 <= humidity <= 100
-
-    if not (likely_temp and likely_humidity):
-        result["valid"] = False
-        result["reason"] = "Parsed, but values fall outside typical temperature/humidity range"
-        result["note"] = "Data may be another device using protocol 5"
-
-    # Always return fields, even if questionable
-    result.update({
-        "house": house,
-        "station": station,
+
+def decode_batch(words):
+    """
+    Vectorised protocol 5 decode of many captured words at once (needs numpy).
+    Returns a dict of equal-length numpy arrays keyed like SensorReading's fields.
+    """
+    try:
+        import numpy as np
+    except ImportError as e:
+        raise ImportError("decode_batch requires numpy (pip install numpy)") from e
+
+    data = np.asarray(words, dtype=np.int64)
+    in_range = (data >= 0) & (data <= 0xFFFFFFFF)
+    data = np.where(in_range, data, 0).astype(np.uint32)
+
+    def field(name):
+        f = PROTOCOL_5[name]
+        return ((data >> f.shift) & f.mask).astype(np.int16) + f.offset
+
+    temperature = np.asarray(TEMPERATURE_TABLE)[(data >> TEMPERATURE_SHIFT) & TEMPERATURE_MASK]
+    humidity = field("humidity")
+    plausible = ((temperature >= TEMPERATURE_RANGE[0]) & (temperature <= TEMPERATURE_RANGE[1])
+                 & (humidity >= HUMIDITY_RANGE[0]) & (humidity <= HUMIDITY_RANGE[1]))
+    reason = np.where(in_range, np.where(plausible, REASON_OK, REASON_IMPLAUSIBLE), REASON_OUT_OF_RANGE)
+
+    return {
+        "valid": in_range & plausible,
+        "reason": reason,
+        "house": field("house"),
+        "station": field("station"),
         "humidity": humidity,
         "temperature": temperature,
-        "id": id_field,
-        "unknown": unknown
-    })
+        "id": field("id"),
+        "unknown": field("unknown"),
+    }
 
-    return result
 
 def log_if_suspicious_rf(data, raw_line=""):
     device_list = data.get("DEVICE", [])
     for device in device_list:
-        dev_id = device.get("D")
-        protocol = device.get("V")
-        da = device.get("DA")
-
-        if dev_id == 11:
-            if protocol != 5:
-                suspicious_logger.warning(f"Suspicious: dev_id=11 but unexpected protocol={protocol}. Raw: {raw_line}")
-            elif isinstance(da, (str, int)):
-                parsed = parse_sensor_data(str(da))
-                if not parsed["valid"]:
-                    suspicious_logger.warning(
-                        f"Suspicious: dev_id=11/protocol=5, but parse failed. Reason: {parsed['reason']}. Raw: {raw_line}"
-                    )
-                elif parsed.get("house") != 1 or parsed.get("station") != 1:
-                    suspicious_logger.warning(
-                        f"Suspicious: dev_id=11/protocol=5, house={parsed.get('house')}, station={parsed.get('station')} "
-                        f"(expected 1/1). Raw: {raw_line}"
-                    )
\ No newline at end of file
+        check_suspicious_device(device, raw_line)
+
+def check_suspicious_device(device, raw_line="", reading=None):
+    """Warn about unexpected RF frames. Pass `reading` if the caller already decoded DA."""
+    dev_id = device.get("D")
+    protocol = device.get("V")
+    da = device.get("DA")
+
+    if dev_id == 11:
+        if protocol != 5:
+            suspicious_logger.warning("Suspicious: dev_id=11 but unexpected protocol=%s. Raw: %s", protocol, raw_line)
+        elif reading is not None or isinstance(da, (str, int)):
+            parsed = reading or parse_sensor_data(str(da))
+            if not parsed.valid:
+                suspicious_logger.warning(
+                    "Suspicious: dev_id=11/protocol=5, but parse failed. Reason: %s. Raw: %s", parsed.reason_text, raw_line
+                )
+            elif sensor_registry.lookup(parsed) is None:
+                suspicious_logger.warning(
+                    "Suspicious: dev_id=11/protocol=5, unregistered sensor house=%s, station=%s, id=%s. Raw: %s",
+                    parsed.house, parsed.station, parsed.id, raw_line
+                )
+
+
+class BurstCollapser:
+    """
+    433 MHz sensors send every packet several times in quick succession. The first copy
+    of a key (cape, D, V, DA) is passed on at once; further copies within `window`
+    seconds of it are swallowed and counted. Once a burst's window has passed,
+    closed() reports it with its number of copies, which doubles as link quality:
+    a sensor normally heard 4 times per packet that arrives once is close to the edge.
+    """
+
+    def __init__(self, window, max_entries=64):
+        self.window = window
+        self.max_entries = max_entries
+        self._open = OrderedDict()  # key -> [first_seen, copies], oldest first
+        self._finished = []
+        self._lock = threading.Lock()
+        self._counts = {"bursts": 0, "collapsed": 0}
+
+    def is_repeat(self, key, now):
+        with self._lock:
+            burst = self._open.get(key)
+            if burst is not None:
+                if now - burst[0] < self.window:
+                    burst[1] += 1
+                    self._counts["collapsed"] += 1
+                    return True
+                del self._open[key]
+                self._finished.append((key, burst[1]))
+            self._open[key] = [now, 1]
+            self._counts["bursts"] += 1
+            if len(self._open) > self.max_entries:
+                old_key, (_, copies) = self._open.popitem(last=False)
+                self._finished.append((old_key, copies))
+            return False
+
+    def closed(self, now):
+        """Pop (key, copies) for every burst whose window has ended."""
+        with self._lock:
+            while self._open:
+                key, (first_seen, copies) = next(iter(self._open.items()))
+                if now - first_seen < self.window:
+                    break
+                del self._open[key]
+                self._finished.append((key, copies))
+            finished, self._finished = self._finished, []
+        return finished
+
+    def next_close(self):
+        """When the oldest open burst's window ends (on the clock passed as `now`), or None if none is open."""
+        with self._lock:
+            if not self._open:
+                return None
+            first_seen, _ = next(iter(self._open.values()))
+            return first_seen + self.window
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counts)
+            stats["open"] = len(self._open)
+        return stats
@@ -4,29 +4,89 @@ import time
 import json
 import logging
 import random
-import schedule
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
-from config import STATUS_LED_ID, EYES_LED_ID, TIME_ZONE
-from serialhandler import send_ninjacape_messages
-from statehandler import get_state
+from config import TIME_ZONE, DEFAULT_LED_COLOR
+from serialhandler import send_ninjacape_messages, capes, default_cape
+from statehandler import get_state, subscribe
 from persisthandler import get_persisted_state, set_persisted_state
-from utils import convert_to_hex, timezone_convert
+from utils import convert_to_hex
+from animator import Animator, blink_animation
+from timerservice import timers, daily_at, hourly_at, MISSED_SKIP
+import metrics
 
 LEDSLEEP = "LEDSLEEP"
 
+_job_errors = metrics.counter("scheduler_job_errors")
+
 VALID_LED_COLORS = [
     "FF0000", "00FF00", "0000FF",
     "FFFF00", "00FFFF", "FF00FF", "FFFFFF"
 ]
 
 
-def send_led(device_id, color_hex):
+def send_led(device_id, color_hex, cape=None):
+    cape = cape or default_cape
     command = json.dumps({"DEVICE": [{"G": "0", "V": 0, "D": int(device_id), "DA": color_hex}]})
-    send_ninjacape_messages(command)
+    send_ninjacape_messages(command, cape)
     #topic = f"ninjaCape/output/{device_id}"
     #mqtt_client.publish(topic, color_hex)
-    logging.info(f"LED {device_id} -> {color_hex}")
+    logging.info(f"LED {cape.name}/{device_id} -> {color_hex}")
+
+
+def _led_sender(cape):
+    return lambda device_id, color_hex: send_led(device_id, color_hex, cape)
+
+
+def _drive_animator(animator):
+    """Run an animator's steps from the timer service rather than a thread of its own."""
+    def run_steps():
+        deadline = animator.run_due()
+        if deadline is not None:
+            timers.schedule(job, deadline, earlier_only=True)
+
+    job = timers.job(run_steps, name="animator")
+    animator.attach_driver(lambda: timers.schedule(job, time.monotonic(), earlier_only=True))
+    return animator
+
+
+# Runs LED timelines (blinks, fades) without holding the scheduler or MQTT threads.
+# LED ids are per cape, so each cape gets its own animator.
+animators = {cape.name: _drive_animator(Animator(_led_sender(cape))) for cape in capes}
+animator = animators[default_cape.name]
+
+
+def animator_for(cape=None):
+    return animators[(cape or default_cape).name]
+
+
+# Current colour (hex) of every cape's LEDs, kept up to date by a state store subscription
+# (which also sees the values restored from the last checkpoint at startup)
+_led_colors = {}
+
+
+def _track_led_color(key, value, old_value, entry):
+    _led_colors[key] = convert_to_hex(str(value)) or DEFAULT_LED_COLOR
+
+
+def _watch_led_colors():
+    keys = [cape.state_key(led_id) for cape in capes for led_id in cape.led_ids]
+    subscribe(_track_led_color, keys=keys)
+    for key in keys:
+        value = get_state(key)
+        if value is not None:
+            _track_led_color(key, value, None, None)
+
+
+_watch_led_colors()
+
+
+def get_led_colors(cape=None):
+    """Current (status, eyes) colours as hex."""
+    cape = cape or default_cape
+    status = _led_colors.get(cape.state_key(cape.status_led_id), DEFAULT_LED_COLOR)
+    eyes = _led_colors.get(cape.state_key(cape.eyes_led_id), DEFAULT_LED_COLOR)
+    return status, eyes
 
 
 def get_next_hour_time(now=None):
@@ -44,28 +104,14 @@ def choose_blink_color(status_color, eyes_color):
     return random.choice(available_colors or VALID_LED_COLORS)
 
 
-def perform_blink(count, blink_color, status_before, eyes_before):
-
-    logging.info(f"[Scheduler] perform_hourly_blink - hour {count}, blink_color {blink_color}, status_before {status_before}, eyes_before {eyes_before}")
+def perform_blink(count, blink_color, status_before, eyes_before, cape=None):
+    """Start the blink animation and return at once; the animator restores the colors when done."""
+    cape = cape or default_cape
 
-    send_led(STATUS_LED_ID, "000000")
-    time.sleep(0.2)
-    send_led(EYES_LED_ID, "000000")
-    time.sleep(2)
-    for _ in range(count):
-        send_led(STATUS_LED_ID, blink_color)
-        time.sleep(0.2)
-        send_led(EYES_LED_ID, blink_color)
-        time.sleep(1)
-        send_led(STATUS_LED_ID, "000000")
-        time.sleep(0.2)
-        send_led(EYES_LED_ID, "000000")
-        time.sleep(0.5)
+    logging.info(f"[Scheduler] perform_hourly_blink ({cape.name}) - hour {count}, blink_color {blink_color}, status_before {status_before}, eyes_before {eyes_before}")
 
-    send_led(STATUS_LED_ID, status_before)
-    time.sleep(0.2)
-    send_led(EYES_LED_ID, eyes_before)
-    logging.info("[Scheduler] LED colors restored after blinking")
+    animation = blink_animation(count, blink_color, cape.status_led_id, status_before, cape.eyes_led_id, eyes_before)
+    return animator_for(cape).play(animation)
 
 
 def blink_hourly_leds():
@@ -78,15 +124,13 @@ def blink_hourly_leds():
 
         logging.info(f"[Scheduler] Blinking {blink_hour} times to mark hour {blink_hour} AEST")
 
-        status_rgb = get_state(str(STATUS_LED_ID), "0,0,255")
-        eyes_rgb = get_state(str(EYES_LED_ID), "0,0,255")
-        status_before = convert_to_hex(status_rgb) or "0000FF"
-        eyes_before = convert_to_hex(eyes_rgb) or "0000FF"
-        blink_color = choose_blink_color(status_before, eyes_before)
-        logging.info(f"[Scheduler] Blink color chosen: {blink_color}")
+        for cape in capes:
+            status_before, eyes_before = get_led_colors(cape)
+            blink_color = choose_blink_color(status_before, eyes_before)
+            logging.info(f"[Scheduler] Blink color chosen: {blink_color}")
 
-        logging.info(f"[Scheduler] blink_hourly_leds - hour {blink_hour}, blink_color {blink_color}, status_before {status_before}, eyes_before {eyes_before}")
-        perform_blink(blink_hour, blink_color, status_before, eyes_before)
+            logging.info(f"[Scheduler] blink_hourly_leds - hour {blink_hour}, blink_color {blink_color}, status_before {status_before}, eyes_before {eyes_before}")
+            perform_blink(blink_hour, blink_color, status_before, eyes_before, cape)
     else:
         logging.info("[Scheduler] Skipping blink_hourly_leds; LEDSLEEP is active")
 
@@ -94,15 +138,13 @@ def blink_half_hour_beep():
     logging.info("[Scheduler] blink_half_hour_beep into method")
 
     if get_persisted_state(LEDSLEEP, "0") == "0":
-        status_rgb = get_state(str(STATUS_LED_ID), "0,0,255")
-        eyes_rgb = get_state(str(EYES_LED_ID), "0,0,255")
-        status_before = convert_to_hex(status_rgb) or "0000FF"
-        eyes_before = convert_to_hex(eyes_rgb) or "0000FF"
-        blink_color = choose_blink_color(status_before, eyes_before)
-        
-        perform_blink(1, blink_color, status_before, eyes_before)
-
-        logging.info(f"[Scheduler] Half-hour beep color: {blink_color}")
+        for cape in capes:
+            status_before, eyes_before = get_led_colors(cape)
+            blink_color = choose_blink_color(status_before, eyes_before)
+
+            perform_blink(1, blink_color, status_before, eyes_before, cape)
+
+            logging.info(f"[Scheduler] Half-hour beep color ({cape.name}): {blink_color}")
     else:
         logging.info("[Scheduler] Skipping blink_half_hour_beep; LEDSLEEP is active")
 
@@ -110,6 +152,7 @@ def safe_blink_hourly_leds():
     try:
         blink_hourly_leds()
     except Exception as e:
+        _job_errors.inc()
         logging.error(f"[Scheduler] Error in blink_hourly_leds: {e}")
         logging.exception("[Scheduler] Exception details:")
 
@@ -117,68 +160,59 @@ def safe_blink_half_hour_beep():
     try:
         blink_half_hour_beep()
     except Exception as e:
+        _job_errors.inc()
         logging.error(f"[Scheduler] Error in blink_half_hour_beep: {e}")
         logging.exception("[Scheduler] Exception details:")
 
 def turn_leds_off():
     try:
         set_persisted_state(LEDSLEEP, "1")
-        status_rgb = get_state(str(STATUS_LED_ID), "0,0,255")
-        eyes_rgb = get_state(str(EYES_LED_ID), "0,0,255")
-        set_persisted_state(str(STATUS_LED_ID), status_rgb)
-        set_persisted_state(str(EYES_LED_ID), eyes_rgb)
-
-        send_led(STATUS_LED_ID, "000000")
-        time.sleep(0.2)
-        send_led(EYES_LED_ID, "000000")
+        for cape in capes:
+            status_before, eyes_before = get_led_colors(cape)
+            set_persisted_state(cape.state_key(cape.status_led_id), status_before)
+            set_persisted_state(cape.state_key(cape.eyes_led_id), eyes_before)
+
+            animator_for(cape).cancel_all(restore=False)
+            send_led(cape.status_led_id, "000000", cape)
+            send_led(cape.eyes_led_id, "000000", cape)
         logging.info("[Scheduler] LEDs Turned Off")
     except Exception as e:
+        _job_errors.inc()
         logging.error(f"[Scheduler] Error in turn_leds_off: {e}")
         logging.exception("[Scheduler] Exception details:")
 
 def turn_leds_on():
     try:
         set_persisted_state(LEDSLEEP, "0")
-        status_rgb = get_persisted_state(str(STATUS_LED_ID), get_state(str(STATUS_LED_ID), "0,0,255"))
-        eyes_rgb = get_persisted_state(str(EYES_LED_ID), get_state(str(EYES_LED_ID), "0,0,255"))
-        status_before = convert_to_hex(status_rgb) or "0000FF"
-        eyes_before = convert_to_hex(eyes_rgb) or "0000FF"
-        send_led(STATUS_LED_ID, status_before)
-        time.sleep(0.2)
-        send_led(EYES_LED_ID, eyes_before)
+        for cape in capes:
+            status_now, eyes_now = get_led_colors(cape)
+            status_key, eyes_key = cape.state_key(cape.status_led_id), cape.state_key(cape.eyes_led_id)
+            status_before = convert_to_hex(get_persisted_state(status_key, status_now)) or DEFAULT_LED_COLOR
+            eyes_before = convert_to_hex(get_persisted_state(eyes_key, eyes_now)) or DEFAULT_LED_COLOR
+            animator_for(cape).cancel_all(restore=False)
+            send_led(cape.status_led_id, status_before, cape)
+            send_led(cape.eyes_led_id, eyes_before, cape)
         logging.info("[Scheduler] LEDs Turned On")
     except Exception as e:
+        _job_errors.inc()
         logging.error(f"[Scheduler] Error in turn_leds_on: {e}")
         logging.exception("[Scheduler] Exception details:")
 
-def run_scheduler():
+def schedule_jobs():
+    """Turn the LEDs on and register the hourly/daily jobs with the timer service."""
+    turn_leds_on()
+
+    # a blink or an on/off switch that comes too late (e.g. after the clock is set at boot) is dropped
+    timers.at(hourly_at(0), safe_blink_hourly_leds, tz=TIME_ZONE, missed=MISSED_SKIP)
+    timers.at(hourly_at(30), safe_blink_half_hour_beep, tz=TIME_ZONE, missed=MISSED_SKIP)
+    timers.at(daily_at(22, 31), turn_leds_off, tz=TIME_ZONE, missed=MISSED_SKIP)
+    timers.at(daily_at(7, 31), turn_leds_on, tz=TIME_ZONE, missed=MISSED_SKIP)
+
+
+def start_scheduler():
     try:
-        logging.info("[Scheduler] Starting scheduler loop")
-
-        turn_leds_on()
-
-        schedule.every().hour.at(":00").do(safe_blink_hourly_leds)
-        schedule.every().hour.at(":30").do(safe_blink_half_hour_beep)
-
-        utc_time = timezone_convert(TIME_ZONE, "UTC", 22, 31)
-        utc_str = utc_time.strftime("%H:%M")
-        logging.info(f"[Scheduler] Off Set for {utc_str} UTC")
-        schedule.every().day.at(utc_str).do(turn_leds_off)
-
-        utc_time = timezone_convert(TIME_ZONE, "UTC", 7, 31)
-        utc_str = utc_time.strftime("%H:%M")
-        logging.info(f"[Scheduler] On Set for {utc_str} UTC")
-        schedule.every().day.at(utc_str).do(turn_leds_on)
-
-        while True:
-            try:
-                schedule.run_pending()
-            except Exception as e:
-                logging.error(f"[Scheduler] Error running scheduled tasks: {e}")
-                logging.exception("[Scheduler] Exception in scheduler loop")
-            time.sleep(1)
+        logging.info("[Scheduler] Starting scheduler")
+        schedule_jobs()
     except Exception as e:
-        logging.error(f"[Scheduler] Fatal error in run_scheduler: {e}")
+        logging.error(f"[Scheduler] Fatal error in start_scheduler: {e}")
         logging.exception("[Scheduler] Exception details at startup or setup")
-
-
@@ -0,0 +1,121 @@
+# sensorregistry.py
+import logging
+import threading
+import time
+from collections import OrderedDict
+from config import RF_SENSORS, RF_QUARANTINE_SIZE, PUBLISH_FILTER_RULES
+import metrics
+
+_quarantined_frames = metrics.counter("rf_quarantined_frames")
+
+
+class Sensor:
+    """
+    One known protocol 5 RF sensor. A legacy sensor keeps the original layout (input/31,
+    input/30, state keys 31/30, Influx sensor_id 3130); any other publishes to
+    <prefix>/input/rf/<name>/temperature and /humidity and writes sensor_id=<name>.
+    """
+
+    def __init__(self, key, name, legacy=False, sensor_id=None, filter=None):
+        self.key = key
+        self.name = name
+        self.legacy = legacy
+        self.sensor_id = sensor_id or (3130 if legacy else name)
+        # publish filter rule per field; legacy topics use the device-id rules for 31/30
+        filter = filter or {}
+        self.filter = {
+            "temperature": filter.get("temperature", PUBLISH_FILTER_RULES.get(31)),
+            "humidity": filter.get("humidity", PUBLISH_FILTER_RULES.get(30)),
+        }
+        # device ids passed to the publish filter: (temperature, humidity)
+        self.dev_ids = (31, 30) if legacy else (None, None)
+
+    def __repr__(self):
+        return f"Sensor({self.name!r}, {self.key})"
+
+    def topics(self, cape):
+        """(temperature topic, humidity topic) on `cape`."""
+        if self.legacy:
+            return cape.input_topic(31), cape.input_topic(30)
+        return cape.input_topic(f"rf/{self.name}", "temperature"), cape.input_topic(f"rf/{self.name}", "humidity")
+
+    def repeats_topic(self, cape):
+        """Copies received per transmission (link quality), see serialhandler._report_burst."""
+        return cape.input_topic(f"rf/{self.name}", "repeats")
+
+    def state_keys(self, cape):
+        if self.legacy:
+            return cape.state_key(31), cape.state_key(30)
+        return cape.state_key(f"rf/{self.name}/temperature"), cape.state_key(f"rf/{self.name}/humidity")
+
+    def filter_rules(self, cape):
+        """Publish filter rules keyed by this sensor's topics on `cape` (none for legacy topics)."""
+        if self.legacy:
+            return {}
+        temperature_topic, humidity_topic = self.topics(cape)
+        rules = {temperature_topic: self.filter["temperature"], humidity_topic: self.filter["humidity"]}
+        return {topic: rule for topic, rule in rules.items() if rule}
+
+
+class SensorRegistry:
+    """
+    Known sensors keyed by the decoded (house, station, id); a key with id None matches
+    any id for that house and station, since the id nibble changes with the batteries.
+    Readings from anything else are kept in a bounded quarantine list instead of being
+    published, so a neighbour's sensor cannot overwrite ours.
+    """
+
+    def __init__(self, sensors, quarantine_size=32):
+        self._sensors = {tuple(key): Sensor(tuple(key), **settings) for key, settings in sensors.items()}
+        self.quarantine_size = quarantine_size
+        # (house, station, id) -> {"first_seen", "last_seen", "frames", "temperature", "humidity"}
+        self._quarantine = OrderedDict()
+        self._lock = threading.Lock()
+        self._counts = {"quarantined_frames": 0, "quarantine_evicted": 0}
+
+    def known(self):
+        return list(self._sensors.values())
+
+    def lookup(self, reading):
+        """The Sensor a decoded reading came from, or None."""
+        sensors = self._sensors
+        return (sensors.get((reading.house, reading.station, reading.id))
+                or sensors.get((reading.house, reading.station, None)))
+
+    def quarantine(self, reading, now=None):
+        """Record a reading from an unknown sensor; logs the first one seen from each."""
+        key = (reading.house, reading.station, reading.id)
+        now = time.time() if now is None else now
+        _quarantined_frames.inc()
+        with self._lock:
+            self._counts["quarantined_frames"] += 1
+            entry = self._quarantine.get(key)
+            if entry is None:
+                entry = self._quarantine[key] = {"first_seen": now, "frames": 0}
+                if len(self._quarantine) > self.quarantine_size:
+                    self._quarantine.popitem(last=False)
+                    self._counts["quarantine_evicted"] += 1
+            else:
+                self._quarantine.move_to_end(key)
+            first = entry["frames"] == 0
+            entry.update(last_seen=now, frames=entry["frames"] + 1,
+                         temperature=reading.temperature, humidity=reading.humidity)
+        if first:
+            logging.warning("[Sensors] Unknown RF sensor house=%s station=%s id=%s (%s°C, %s%%) quarantined; "
+                            "add it to RF_SENSORS to publish it", key[0], key[1], key[2],
+                            reading.temperature, reading.humidity)
+
+    def quarantined(self):
+        with self._lock:
+            return {key: dict(entry) for key, entry in self._quarantine.items()}
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counts)
+            stats["quarantined_sensors"] = len(self._quarantine)
+        stats["known_sensors"] = len(self._sensors)
+        return stats
+
+
+registry = SensorRegistry(RF_SENSORS, RF_QUARANTINE_SIZE)
+metrics.register_stats("rf_sensors", registry.stats)
@@ -2,138 +2,552 @@
 import serial
 import json
 import logging
-from config import SERIAL_PORT, BAUD_RATE, SERIAL_TIMEOUT
-from utils import hex_to_rgb_string
-from notifier import send_notification
-from rfhandler import parse_sensor_data
-from rfhandler import log_if_suspicious_rf
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from config import BAUD_RATE, CAPES
 from config import STATUS_LED_ID, EYES_LED_ID
-from statehandler import set_state
-from influxhandler import log_reading
-from utils import is_int
+from config import SERIAL_QUEUE_SIZE, SERIAL_MAX_FRAME_BYTES, SERIAL_OUTAGE_WRITES
+from config import SERIAL_PACK_DEVICES, SERIAL_WRITE_MAX_DEVICES, SERIAL_WRITE_GAP
+from config import RF_BURST_DEVICES, RF_BURST_WINDOW
+from config import CAPTURE_PATH, CAPTURE_BYTES
+from notifier import send_notification
+from devicehandlers import dispatch_device, publish_to_mqtt
+from rfhandler import BurstCollapser, parse_sensor_data
+from sensorregistry import registry as sensor_registry
+from framecapture import FrameRing
+from seriallink import SerialLink
+from statehandler import get_state
+from timerservice import timers
+from utils import convert_to_hex
+import metrics
+
+# Complete (cape, line) pairs handed from the reader threads to the processing loop
+_frame_queue = queue.Queue(maxsize=SERIAL_QUEUE_SIZE)
+
+
+class Cape:
+    """
+    One NinjaCape (or compatible RF receiver) on its own serial port: the port, its
+    outbound write queue and the namespace its devices live in. Device ids are only
+    unique per cape, so topics are <topic_prefix>/input/<id> and state keys are
+    <state_namespace>/<id> (just <id> when the namespace is empty).
+    """
+
+    def __init__(self, name, port, topic_prefix, status_led_id=STATUS_LED_ID, eyes_led_id=EYES_LED_ID,
+                 state_namespace="", baud=BAUD_RATE):
+        self.name = name
+        self.port = port
+        self.topic_prefix = topic_prefix
+        self.status_led_id = int(status_led_id)
+        self.eyes_led_id = int(eyes_led_id)
+        self.led_ids = (self.status_led_id, self.eyes_led_id)
+        self.state_namespace = state_namespace
+        self.baud = baud
+        self.index = 0  # position in `capes`, recorded with captured frames
+        self.ser = None  # the open port, None while the link is down
+        self.link = SerialLink(self, on_open=_link_opened)
+
+        # Outbound commands waiting for the writer: latest DEVICE entry per device id,
+        # plus any non-DEVICE commands in arrival order
+        self.write_cond = threading.Condition()
+        self.pending_devices = OrderedDict()
+        self.pending_raw = deque(maxlen=SERIAL_QUEUE_SIZE)
+        self.writer_thread = None
+        self.writer_wakeup = None
+        self.write_stats = {"frames": 0, "coalesced": 0, "outage_dropped": 0}
+
+    def __repr__(self):
+        return f"Cape({self.name!r}, {self.port!r})"
+
+    def input_topic(self, dev_id, suffix=None):
+        topic = f"{self.topic_prefix}/input/{dev_id}"
+        return f"{topic}/{suffix}" if suffix else topic
+
+    def state_key(self, key):
+        return f"{self.state_namespace}/{key}" if self.state_namespace else str(key)
+
+    @property
+    def influx_tags(self):
+        # capes with the original flat layout keep writing the original series
+        return {"cape": self.name} if self.state_namespace else {}
+
+
+def _link_opened(cape, reconnected):
+    """SerialLink callback: re-send the LED colours after an outage and let the writer go."""
+    if reconnected:
+        _resync_leds(cape)
+    with cape.write_cond:
+        cape.write_cond.notify_all()
+    if cape.writer_wakeup is not None:
+        cape.writer_wakeup()
+    elif reconnected:
+        _start_writer(cape)
+
+
+def _resync_leds(cape):
+    """Queue the last known colour of each LED the cape may have lost, unless a newer write is pending."""
+    with cape.write_cond:
+        for led_id in cape.led_ids:
+            colour = get_state(cape.state_key(led_id))
+            if colour is None or str(led_id) in cape.pending_devices:
+                continue
+            cape.pending_devices[str(led_id)] = {"G": "0", "V": 0, "D": led_id, "DA": convert_to_hex(str(colour))}
+    logging.info(f"[SerialHandler] Re-syncing LEDs on {cape.name} after reconnect")
+
+
+capes = [Cape(**settings) for settings in CAPES]
+for _index, _cape in enumerate(capes):
+    _cape.index = _index
+default_cape = capes[0]
+
+
+class _RateMeter:
+    """Counts events and keeps a smoothed events/sec figure, updated once a second."""
+
+    def __init__(self):
+        self.count = 0
+        self.rate = 0.0
+        self._window_start = time.monotonic()
+        self._window_count = 0
+
+    def tick(self):
+        self.count += 1
+        self._window_count += 1
+        now = time.monotonic()
+        elapsed = now - self._window_start
+        if elapsed >= 1.0:
+            self.rate = 0.7 * self.rate + 0.3 * (self._window_count / elapsed)
+            self._window_start = now
+            self._window_count = 0
+
+
+_read_rate = _RateMeter()
+_processed_rate = _RateMeter()
+_stats_lock = threading.Lock()
+_stats = {"dropped": 0, "overlong": 0}
+
+
+def _count(name, amount=1):
+    with _stats_lock:
+        _stats[name] += amount
+
 
-ser = None
+_frame_seconds = metrics.histogram("serial_frame_seconds")
+_decode_seconds = metrics.histogram("serial_json_decode_seconds")
+_invalid_frames = metrics.counter("serial_invalid_frames")
+_unknown_frames = metrics.counter("serial_unknown_frames")
+_cape_errors = metrics.counter("serial_cape_errors")
+_burst_copies = metrics.histogram("rf_burst_copies", buckets=(1, 2, 3, 4, 5, 6, 8, 10, 15, 20))
+_unattributed_bursts = metrics.counter("rf_bursts_unattributed")
+
+# Repeated RF copies are dropped here, before decoding, publishing and Influx
+_bursts = BurstCollapser(RF_BURST_WINDOW) if RF_BURST_WINDOW else None
+_link_quality = {}  # (cape name, sensor name) -> smoothed copies per burst
+_burst_client = None  # client the burst timer reports on, the last one that handled a live frame
+
+# Raw frame capture ring, opened by the first frame read
+_capture = None
+_capture_lock = threading.Lock()
+_capture_disabled = not CAPTURE_PATH
+
+
+def get_serial_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+    stats.update({
+        "frames_read": _read_rate.count,
+        "frames_processed": _processed_rate.count,
+        "read_fps": round(_read_rate.rate, 2),
+        "processed_fps": round(_processed_rate.rate, 2),
+        "queue_depth": _frame_queue.qsize(),
+    })
+    return stats
 
 def init_serial():
-    global ser
+    """
+    Try once to open every configured cape's port; returns the default cape's port (None if
+    it is not there yet). A missing port does not hold up startup: the reader keeps
+    reopening it with backoff (see seriallink.py).
+    """
+    for cape in capes:
+        cape.link.try_open()
+    return default_cape.ser
+
+
+def send_ninjacape_messages(command, cape=None):
+    """
+    Queue a command for the cape's serial writer. DEVICE entries are kept per device
+    with the latest value winning, so a burst of colour changes collapses to the
+    final colour instead of being replayed one by one at 9600 baud.
+    """
+    cape = cape or default_cape
+    if cape.ser is None and SERIAL_OUTAGE_WRITES == "drop":
+        with cape.write_cond:
+            cape.write_stats["outage_dropped"] += 1
+        logging.debug("Serial link down (%s), dropped: %s", cape.name, command)
+        return
+
     try:
-        ser = serial.Serial(SERIAL_PORT, BAUD_RATE, timeout=SERIAL_TIMEOUT)
-        logging.info(f"Serial port {SERIAL_PORT} opened.")
-    except Exception as e:
-        logging.error(f"Error opening serial port: {e}")
-        exit(1)
+        devices = json.loads(command).get("DEVICE")
+    except (ValueError, AttributeError):
+        devices = None
 
-def send_ninjacape_messages(command):
-    if ser:
-        ser.write((command + "\n").encode("utf-8"))
-        logging.info(f"Sent to serial: {command}")
+    with cape.write_cond:
+        if isinstance(devices, list) and devices:
+            for device in devices:
+                key = str(device.get("D"))
+                if key in cape.pending_devices:
+                    cape.write_stats["coalesced"] += 1
+                cape.pending_devices[key] = device
+        else:
+            cape.pending_raw.append(command)
+        cape.write_cond.notify()
+    if cape.writer_wakeup is not None:
+        cape.writer_wakeup()
     else:
-        logging.error("Serial port not initialized.")
+        _start_writer(cape)
 
 
-def publish_to_mqtt(mqtt_client, topic, payload, dev_id):
-    from mqtthandler import publish_payload
-    publish_payload(mqtt_client, topic, payload, dev_id=dev_id)
+def attach_writer(cape, wakeup):
+    """
+    Hand a cape's outbound writes to an external driver (the asyncio runtime) instead of
+    its writer thread: wakeup() is called after each enqueue, and the driver sends with
+    pop_next_write() / write_command().
+    """
+    cape.writer_wakeup = wakeup
 
 
-def process_ninjacape_messages(mqtt_client):
+def pop_next_write(cape):
+    with cape.write_cond:
+        if not cape.pending_raw and not cape.pending_devices:
+            return None
+        return _next_write(cape)
+
+
+def write_command(cape, command):
+    """Write one line to the cape's port; returns the seconds to wait before the next write."""
+    data = (command + "\n").encode("utf-8")
+    ser = cape.ser
+    if ser is None:
+        raise serial.SerialException("port is closed")
+    ser.write(data)
+    with cape.write_cond:
+        cape.write_stats["frames"] += 1
+    logging.info("Sent to serial (%s): %s", cape.name, command)
+    # 10 bit times per byte (start + 8 data + stop) keeps us from outrunning the cape
+    return len(data) * 10 / cape.baud + SERIAL_WRITE_GAP
+
+
+def _start_writer(cape):
+    with cape.write_cond:
+        if cape.writer_thread is None or not cape.writer_thread.is_alive():
+            cape.writer_thread = threading.Thread(target=_write_serial_frames, args=(cape,),
+                                                  name=f"serial-writer-{cape.name}", daemon=True)
+            cape.writer_thread.start()
+
+
+def _next_write(cape):
+    """Pop the next line to send; caller holds cape.write_cond."""
+    if cape.pending_raw:
+        return cape.pending_raw.popleft()
+    batch_size = SERIAL_WRITE_MAX_DEVICES if SERIAL_PACK_DEVICES else 1
+    batch = []
+    while cape.pending_devices and len(batch) < batch_size:
+        _, device = cape.pending_devices.popitem(last=False)
+        batch.append(device)
+    return json.dumps({"DEVICE": batch})
+
+
+def requeue_write(cape, command):
+    """Put back a line that failed to send, unless the outage policy drops it or a newer value is pending."""
+    with cape.write_cond:
+        if SERIAL_OUTAGE_WRITES == "drop":
+            cape.write_stats["outage_dropped"] += 1
+            return
+        try:
+            devices = json.loads(command).get("DEVICE")
+        except (ValueError, AttributeError):
+            devices = None
+        if not isinstance(devices, list):
+            cape.pending_raw.appendleft(command)
+            return
+        for device in reversed(devices):
+            key = str(device.get("D"))
+            if key not in cape.pending_devices:
+                cape.pending_devices[key] = device
+                cape.pending_devices.move_to_end(key, last=False)
+
+
+def _write_serial_frames(cape):
     while True:
+        with cape.write_cond:
+            # while the link is down, writes wait here (or were dropped, per SERIAL_OUTAGE_WRITES)
+            while cape.ser is None or (not cape.pending_raw and not cape.pending_devices):
+                cape.write_cond.wait()
+            command = _next_write(cape)
+
         try:
-            raw = ser.readline()
-            if not raw:
-                continue
+            time.sleep(write_command(cape, command))
+        except Exception as e:
+            logging.error(f"Serial write error ({cape.name}): {e}")
+            requeue_write(cape, command)
+            time.sleep(cape.link.failed(e, "write"))
 
-            try:
-                line = raw.decode("utf-8").strip()
-                data = json.loads(line)
-            except Exception:
-                logging.warning(f"Invalid data received: {raw}")
-                send_notification(f"Invalid data: {raw}")
-                continue
 
-            # --- Handle ERROR messages ---
-            if "ERROR" in data:
-                for err in data["ERROR"]:
-                    err_msg = err.get("ERR", "Unknown error")
-                    err_code = err.get("CODE", "Unknown code")
-                    log_msg = f"[SerialHandler] Error received - ERR: {err_msg}, CODE: {err_code}"
-                    logging.error(log_msg)
+def get_rf_burst_stats():
+    stats = _bursts.stats() if _bursts is not None else {}
+    for (cape_name, sensor_name), copies in list(_link_quality.items()):
+        stats[f"link_quality_{cape_name}_{sensor_name}"] = round(copies, 2)
+    return stats
 
-            if "ACK" in data:
-                logging.info(f"ACK: {data}")
-                continue
 
-            if "DEVICE" in data:
-                dev = data["DEVICE"][0]
-                protocol = str(dev["V"])
-                dev_id = str(dev["D"])
-                dev_value = str(dev["DA"])
-
-                #convert to rgb if ninja status (999) or rgb (1007) led's
-                if is_int(dev_id) and int(dev_id) in {STATUS_LED_ID, EYES_LED_ID}:
-                    dev_value = hex_to_rgb_string(dev_value)
-
-                #logging.debug(f"Dev_ID: {dev_id}, protocol: {protocol}")
-
-                if dev_id == "11": 
-                    log_if_suspicious_rf(data, line)
-                    if protocol == "5":
-                        #logging.debug(f"Dev_ID: 11 and protocol: 5")
-                        result = parse_sensor_data(dev_value)
-                        if result.get("valid"):
-
-                            # Always log all parsed fields
-                            logging.debug(
-                                f"Parsed sensor data (raw={dev_value}): "
-                                f"House={result.get('house')}, Station={result.get('station')}, "
-                                f"Temperature={result.get('temperature')}°C, Humidity={result.get('humidity')}%, "
-                                f"ID={result.get('id')}, Unknown={result.get('unknown')} "
-                                f"(Valid={result.get('valid')}, Reason={result.get('reason')})"
-                            )
-
-                            temp = result["temperature"]
-                            hum = result["humidity"]
-
-
-                            publish_to_mqtt(mqtt_client, "ninjaCape/input/31", temp, dev_id=31)
-                            set_state("31", temp)
-                            logging.debug(f"[MQTTHandler] Published: (11/5) 31 -> {temp} (temperature)")
-
-                            publish_to_mqtt(mqtt_client, "ninjaCape/input/30", hum, dev_id=30)
-                            set_state("30", hum)
-                            logging.debug(f"[MQTTHandler] Published: (11/5) 30 -> {hum} (humidity)")
-
-                            #log to influx
-                            log_reading("ninja", 3130, result.get('station'), temp, hum)
-
-                            continue  # Skip default publish for dev_id=11 if handled above
-                        else:
-                            logging.info(f"[MQTTHandler] Unrecognized or non-temperature protocol 5 data: {dev_value} "
-                                        f"(Reason: {result.get('reason')})")
-                
-                # Publish received sensor data to MQTT
-                #current_states[dev_id] = dev_value
-                set_state(dev_id, dev_value)
-                publish_to_mqtt(mqtt_client, f"ninjaCape/input/{dev_id}", dev_value, dev_id=dev_id)
-
-
-                #Eye and Status LED specific logic
-                if is_int(dev_id) and int(dev_id) in {STATUS_LED_ID, EYES_LED_ID}:
-                    logging.debug(f"Published dev_id: {dev_id} -> {dev_value}")
-                    # specific on / off for LED's
-                    on_value = "true"
-                    if dev_value == "0,0,0":
-                        on_value = "false"
-                    publish_to_mqtt(mqtt_client, f"ninjaCape/input/{dev_id}/on", on_value, dev_id=dev_id)
-                    logging.debug(f"Published On dev_id: {dev_id} -> {on_value}")
-                else:
-                    # log and notify if anything other than 999 or 1007
-                    logging.info(f"Published Else: {dev_id} -> {dev_value}")
-                    send_notification(f"Published Else: {dev_id} -> {dev_value}")
+def get_serial_write_stats():
+    stats = {"frames": 0, "coalesced": 0, "outage_dropped": 0, "pending": 0}
+    for cape in capes:
+        with cape.write_cond:
+            for key, value in cape.write_stats.items():
+                stats[key] += value
+            stats["pending"] += len(cape.pending_raw) + len(cape.pending_devices)
+    return stats
 
-            else:
-                logging.warning(f"Unknown format: {line}")
-                send_notification(f"Unknown serial data: {line}")
+
+metrics.register_stats("serial", get_serial_stats)
+metrics.register_stats("serial_write", get_serial_write_stats)
+metrics.register_stats("rf_burst", get_rf_burst_stats)
+for _cape in capes:
+    metrics.register_stats(f"serial_link_{_cape.name}", _cape.link.stats)
+
+
+class LineFramer:
+    """Splits a byte stream into non-empty lines using one reusable bytearray."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, chunk):
+        buffer = self.buffer
+        buffer += chunk
+        frames = []
+        start = 0
+        while True:
+            end = buffer.find(b"\n", start)
+            if end < 0:
+                break
+            frame = bytes(buffer[start:end])
+            start = end + 1
+            if frame.strip():
+                frames.append(frame)
+        if start:
+            del buffer[:start]
+
+        if len(buffer) > SERIAL_MAX_FRAME_BYTES:
+            logging.warning(f"[SerialHandler] Discarding {len(buffer)} bytes without a line ending")
+            _count("overlong")
+            buffer.clear()
+        return frames
+
+
+def _read_serial_frames(cape):
+    """
+    Reader thread (one per cape): pull whatever the UART has buffered in one read, split
+    it into lines in a reusable bytearray and hand complete frames to the processing queue.
+    """
+    framer = LineFramer()
+    link = cape.link
+    generation = link.generation
+    while True:
+        ser = link.wait_until_open()
+        if link.generation != generation:
+            # a partial line from before a reopen would corrupt the first new frame
+            generation = link.generation
+            framer = LineFramer()
+        try:
+            chunk = ser.read(ser.in_waiting or 1)
         except Exception as e:
-            logging.error(f"Serial read error: {e}")
-            send_notification(f"Serial read error: {e}")
+            time.sleep(link.failed(e))
+            continue
+        if not chunk:
+            link.check_stall()
+            continue
+        link.received()
+        for frame in framer.feed(chunk):
+            capture_frame(cape, frame)
+            _enqueue_frame(cape, frame)
+
+
+def _enqueue_frame(cape, frame):
+    try:
+        _frame_queue.put_nowait((cape, frame))
+        _read_rate.tick()
+    except queue.Full:
+        _count("dropped")
+        logging.warning(f"[SerialHandler] Processing queue full, dropped frame: {frame}")
+
+
+def process_ninjacape_messages(mqtt_client):
+    """Start a reader thread per cape and process every cape's frames on this thread."""
+    for cape in capes:
+        reader_thread = threading.Thread(target=_read_serial_frames, args=(cape,),
+                                         name=f"serial-reader-{cape.name}", daemon=True)
+        reader_thread.start()
+
+    while True:
+        cape, raw = _frame_queue.get()
+        process_frame(mqtt_client, raw, cape)
+
+
+def process_frame(mqtt_client, raw, cape=None, received_at=None):
+    """Handle one framed line with timing and error reporting; shared by both runtimes and replay."""
+    started = time.perf_counter()
+    try:
+        handle_frame(mqtt_client, raw, cape, received_at)
+    except Exception as e:
+        logging.error(f"Serial processing error: {e}")
+        send_notification(f"Serial processing error: {e}", category="serial-error")
+    _frame_seconds.observe(time.perf_counter() - started)
+    _processed_rate.tick()
+
+
+def record_frame_read():
+    _read_rate.tick()
+
+
+def set_capture(enabled):
+    """Turn raw frame capture on or off (benchmark.py keeps synthetic frames out of the ring)."""
+    global _capture_disabled
+    _capture_disabled = not (enabled and CAPTURE_PATH)
+
+
+def capture_frame(cape, frame):
+    """Append a raw line to the capture ring (see framecapture.py); both runtimes call this per line read."""
+    global _capture, _capture_disabled
+    if _capture_disabled:
+        return
+    if _capture is None:
+        with _capture_lock:
+            if _capture is None and not _capture_disabled:
+                try:
+                    _capture = FrameRing(CAPTURE_PATH, CAPTURE_BYTES)
+                    logging.info(f"[SerialHandler] Capturing raw frames to {CAPTURE_PATH}")
+                except (OSError, ValueError) as e:
+                    _capture_disabled = True
+                    logging.error(f"[SerialHandler] Frame capture disabled, cannot open {CAPTURE_PATH}: {e}")
+                    return
+    _capture.append(frame, time.time(), cape.index)
+
+
+def handle_frame(mqtt_client, raw, cape=None, received_at=None):
+    """
+    Decode one raw serial line from `cape` and route it to state, MQTT and Influx.
+    received_at (any steady clock, e.g. capture timestamps on replay) times RF bursts;
+    it defaults to now.
+    """
+    cape = cape or default_cape
+    started = time.perf_counter()
+    try:
+        line = raw.decode("utf-8").strip()
+        data = json.loads(line)
+    except Exception:
+        _invalid_frames.inc()
+        logging.warning("Invalid data received: %s", raw)
+        send_notification(f"Invalid data: {raw}", category="serial-invalid")
+        return
+    _decode_seconds.observe(time.perf_counter() - started)
+
+    # --- Handle ERROR messages ---
+    if "ERROR" in data:
+        for err in data["ERROR"]:
+            _cape_errors.inc()
+            err_msg = err.get("ERR", "Unknown error")
+            err_code = err.get("CODE", "Unknown code")
+            log_msg = f"[SerialHandler] Error received ({cape.name}) - ERR: {err_msg}, CODE: {err_code}"
+            logging.error(log_msg)
+
+    if "ACK" in data:
+        logging.info("ACK: %s", data)
+        return
+
+    if "DEVICE" in data:
+        if _bursts is not None:
+            if received_at is None:
+                now = time.monotonic()
+            else:
+                # frames on their own clock (replay) close their bursts as they arrive
+                now = received_at
+                for key, copies in _bursts.closed(now):
+                    _report_burst(mqtt_client, key, copies)
+
+        # Every entry of a multi-device frame is dispatched, not just the first
+        for device in data["DEVICE"]:
+            try:
+                if _bursts is not None and _is_burst_repeat(cape, device, now):
+                    continue
+                dispatch_device(mqtt_client, device, line, cape)
+            except Exception as e:
+                logging.error(f"[SerialHandler] Failed to handle device {device}: {e}")
+
+        if _bursts is not None and received_at is None:
+            _schedule_burst_close(mqtt_client)
+
+    else:
+        _unknown_frames.inc()
+        logging.warning(f"Unknown format: {line}")
+        send_notification(f"Unknown serial data: {line}", category="serial-unknown")
+
+
+def _is_burst_repeat(cape, device, now):
+    try:
+        dev_id = int(device["D"])
+    except (KeyError, TypeError, ValueError):
+        return False
+    if dev_id not in RF_BURST_DEVICES:
+        return False
+    return _bursts.is_repeat((cape, dev_id, device.get("V"), str(device.get("DA"))), now)
+
+
+def close_bursts(now=None):
+    """Report every live burst whose window has ended; runs on the timer service, so a lone sensor is not kept waiting."""
+    now = time.monotonic() if now is None else now
+    for key, copies in _bursts.closed(now):
+        _report_burst(_burst_client, key, copies)
+    _schedule_burst_close(_burst_client)
+
+
+_burst_job = timers.job(close_bursts, name="rf-bursts")
+
+
+def _schedule_burst_close(mqtt_client):
+    global _burst_client
+    _burst_client = mqtt_client
+    next_close = _bursts.next_close()
+    if next_close is not None:
+        timers.schedule(_burst_job, next_close, earlier_only=True)
+
+
+def _report_burst(mqtt_client, key, copies):
+    """
+    Publish how many copies of one RF transmission arrived, as the link quality of the
+    registered sensor that sent it. Bursts that cannot be attributed to one (other
+    protocols, neighbours' sensors) only count towards the rf_burst_copies histogram.
+    """
+    cape, _, protocol, data = key
+    _burst_copies.observe(copies)
+    sensor = _burst_sensor(protocol, data)
+    if sensor is None:
+        _unattributed_bursts.inc()
+        return
+    previous = _link_quality.get((cape.name, sensor.name))
+    _link_quality[(cape.name, sensor.name)] = copies if previous is None else 0.8 * previous + 0.2 * copies
+    publish_to_mqtt(mqtt_client, sensor.repeats_topic(cape), copies, dev_id=None)
+
+
+def _burst_sensor(protocol, data):
+    try:
+        if int(protocol) != 5:
+            return None
+    except (TypeError, ValueError):
+        return None
+    reading = parse_sensor_data(data)
+    return sensor_registry.lookup(reading) if reading.valid else None
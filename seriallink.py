@@ -0,0 +1,185 @@
+# seriallink.py
+import logging
+import threading
+import time
+import serial
+from config import SERIAL_TIMEOUT, SERIAL_RETRY_MAX_DELAY, SERIAL_ERROR_LIMIT, SERIAL_STALL_SECONDS
+from notifier import send_notification
+import metrics
+
+# A cape's port moves between these states; only losing and regaining the link notify.
+#   closed       - never opened (or opened by someone else, e.g. the benchmark)
+#   connected    - open and reading
+#   degraded     - open, but the last reads/writes failed; retried after a short pause
+#   reconnecting - closed after SERIAL_ERROR_LIMIT consecutive errors or SERIAL_STALL_SECONDS
+#                  of silence, and reopened with exponential backoff. A quiet radio (e.g.
+#                  sensors with flat batteries) is not an outage, so a stall reopen only
+#                  notifies if the port then fails to open.
+CLOSED = "closed"
+CONNECTED = "connected"
+DEGRADED = "degraded"
+RECONNECTING = "reconnecting"
+
+_read_errors = metrics.counter("serial_read_errors")
+_write_errors = metrics.counter("serial_write_errors")
+_reconnects = metrics.counter("serial_reconnects")
+
+
+class SerialLink:
+    """
+    Supervises one cape's serial port. The runtimes ask it to open the port, report every
+    read/write failure and every received chunk, and it decides when to pause, when the
+    port is dead and when to try again; cape.ser is the open port or None while down.
+    on_open(cape, reconnected) runs after each successful open and on_drop(cape) after the
+    port is closed for a reopen.
+    """
+
+    def __init__(self, cape, on_open=None):
+        self.cape = cape
+        self.on_open = on_open
+        self.on_drop = None
+        self.state = CLOSED
+        self.errors = 0           # consecutive failures
+        self.last_rx = None       # monotonic time of the last received bytes
+        self.lost_at = None       # when the link went down, None while up
+        self.generation = 0       # bumped on every open, so readers can drop partial lines
+        self.drop_reason = None
+        self._quiet_drop = False  # dropped for a stall and not notified (yet)
+        self._delay = 1
+        self._next_attempt = 0.0
+        self._lock = threading.Lock()
+        self._stats = {"opens": 0, "open_failures": 0, "read_errors": 0, "write_errors": 0,
+                       "stalls": 0, "reconnects": 0}
+
+    @property
+    def is_open(self):
+        return self.cape.ser is not None and self.state != RECONNECTING
+
+    def retry_in(self):
+        return max(0.0, self._next_attempt - time.monotonic())
+
+    def try_open(self):
+        """One attempt to open the port if the backoff allows it; True once it is open."""
+        now = time.monotonic()
+        with self._lock:
+            if now < self._next_attempt:
+                return False
+        cape = self.cape
+        try:
+            ser = serial.Serial(cape.port, cape.baud, timeout=SERIAL_TIMEOUT)
+        except Exception as e:
+            with self._lock:
+                self._stats["open_failures"] += 1
+                self._next_attempt = now + self._delay
+                delay, self._delay = self._delay, min(self._delay * 2, SERIAL_RETRY_MAX_DELAY)
+                quiet, self._quiet_drop = self._quiet_drop, False
+            logging.error(f"Error opening serial port {cape.port} ({cape.name}): {e} (retrying in {delay}s)")
+            if quiet:
+                # the stall was a real outage after all
+                send_notification(f"Serial link {cape.name} lost: {self.drop_reason}, reopen failed: {e}",
+                                  category="serial-link")
+            return False
+
+        with self._lock:
+            cape.ser = ser
+            self.state = CONNECTED
+            self.errors = 0
+            self.last_rx = now
+            self.generation += 1
+            self._delay = 1
+            self._stats["opens"] += 1
+            lost_at, self.lost_at = self.lost_at, None
+            quiet, self._quiet_drop = self._quiet_drop, False
+            if lost_at is not None:
+                self._stats["reconnects"] += 1
+        logging.info(f"Serial port {cape.port} opened ({cape.name}).")
+        if lost_at is not None:
+            _reconnects.inc()
+        if lost_at is not None and not quiet:
+            send_notification(f"Serial link {cape.name} restored after {now - lost_at:.0f}s", category="serial-link")
+        if self.on_open is not None:
+            self.on_open(cape, lost_at is not None)
+        return True
+
+    def wait_until_open(self):
+        """Block (the threaded reader) until the port is open; returns it."""
+        while True:
+            ser = self.cape.ser
+            if ser is not None and self.state != RECONNECTING:
+                return ser
+            if not self.try_open():
+                time.sleep(self.retry_in() or 0.1)
+
+    def received(self):
+        self.last_rx = time.monotonic()
+        if self.errors:
+            with self._lock:
+                self.errors = 0
+                if self.state == DEGRADED:
+                    self.state = CONNECTED
+                    logging.info(f"[SerialLink] {self.cape.name} recovered")
+
+    def failed(self, error, kind="read"):
+        """
+        Record a read or write failure. Returns the seconds to pause before trying the
+        port again; after SERIAL_ERROR_LIMIT failures in a row the port is closed for a
+        reopen instead (is_open turns False).
+        """
+        (_read_errors if kind == "read" else _write_errors).inc()
+        with self._lock:
+            self._stats[f"{kind}_errors"] += 1
+            self.errors += 1
+            errors = self.errors
+            if errors < SERIAL_ERROR_LIMIT and self.state != RECONNECTING:
+                self.state = DEGRADED
+        if errors >= SERIAL_ERROR_LIMIT:
+            self.drop(f"{errors} {kind} errors, last: {error}")
+            return 0.0
+        logging.warning(f"[SerialLink] {self.cape.name} {kind} error ({errors}/{SERIAL_ERROR_LIMIT}): {error}")
+        return float(errors)
+
+    def check_stall(self, now=None):
+        """Reopen the port if nothing arrived for SERIAL_STALL_SECONDS; returns True if it did."""
+        if not SERIAL_STALL_SECONDS or not self.is_open:
+            return False
+        now = time.monotonic() if now is None else now
+        if self.last_rx is None:
+            self.last_rx = now
+        if now - self.last_rx < SERIAL_STALL_SECONDS:
+            return False
+        with self._lock:
+            self._stats["stalls"] += 1
+        self.drop(f"nothing received for {now - self.last_rx:.0f}s", notify=False)
+        return True
+
+    def drop(self, reason, notify=True):
+        """Close the port and start reconnecting; without `notify`, only a failed reopen notifies."""
+        cape = self.cape
+        with self._lock:
+            if self.state == RECONNECTING:
+                return
+            ser, cape.ser = cape.ser, None
+            self.state = RECONNECTING
+            self.lost_at = time.monotonic()
+            self._next_attempt = self.lost_at
+            self._delay = 1
+            self.drop_reason = reason
+            self._quiet_drop = not notify
+        if ser is not None:
+            try:
+                ser.close()
+            except Exception:
+                pass
+        if notify:
+            logging.error(f"[SerialLink] {cape.name} link lost ({reason}), reconnecting")
+            send_notification(f"Serial link {cape.name} lost: {reason}", category="serial-link")
+        else:
+            logging.warning(f"[SerialLink] {cape.name} {reason}, reopening the port")
+        if self.on_drop is not None:
+            self.on_drop(cape)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["state"] = self.state
+        return stats
@@ -1,18 +1,151 @@
 # statehandler.py
 
+import atexit
+import json
+import logging
+import os
+import threading
+import time
 from threading import Lock
+from types import MappingProxyType
+from typing import Any, NamedTuple
+from config import STATE_SNAPSHOT_PATH, STATE_CHECKPOINT_INTERVAL
+
+# Last known value per device key. Every change bumps a global version, so consumers can
+# ask for "what changed since version N" or subscribe to change callbacks instead of
+# polling. Readers get an immutable mapping that is swapped (copy-on-write) on each change,
+# so get_all_states() never copies. Keys are always stored as strings.
+
+
+class StateEntry(NamedTuple):
+    value: Any
+    version: int
+    timestamp: float
+
 
-current_states = {}
 _lock = Lock()
+_entries = {}
+_values = MappingProxyType({})
+_version = 0
+_subscribers = []
+_checkpointed_version = 0
+_checkpoint_thread = None
+
 
 def set_state(key: str, value):
+    global _values, _version
+    key = str(key)
     with _lock:
-        current_states[key] = value
+        old = _entries.get(key)
+        if old is not None and old.value == value:
+            return
+        _version += 1
+        entry = StateEntry(value, _version, time.time())
+        _entries[key] = entry
+        values = dict(_values)
+        values[key] = value
+        _values = MappingProxyType(values)
+        subscribers = list(_subscribers)
+    _notify(subscribers, key, value, old.value if old is not None else None, entry)
+
+def _notify(subscribers, key, value, old_value, entry):
+    for callback, keys in subscribers:
+        if keys is None or key in keys:
+            try:
+                callback(key, value, old_value, entry)
+            except Exception as e:
+                logging.error(f"[State] Subscriber {callback} failed for {key}: {e}")
 
 def get_state(key: str, default=None):
+    return _values.get(str(key), default)
+
+def get_state_entry(key: str):
+    """StateEntry (value, version, timestamp) for key, or None."""
     with _lock:
-        return current_states.get(key, default)
+        return _entries.get(str(key))
 
 def get_all_states():
+    return _values  # read-only mapping, replaced rather than mutated on change
+
+def get_state_version():
+    return _version
+
+def get_changes_since(version: int):
+    """Return (current_version, {key: value}) for every key changed after `version`."""
+    with _lock:
+        changes = {key: entry.value for key, entry in _entries.items() if entry.version > version}
+        return _version, changes
+
+def subscribe(callback, keys=None):
+    """
+    Call callback(key, value, old_value, entry) after each change, optionally only for `keys`.
+    Callbacks run on the thread that changed the state (or restored it), so keep them short.
+    """
+    keys = None if keys is None else {str(k) for k in keys}
     with _lock:
-        return dict(current_states)  # shallow copy
+        _subscribers.append((callback, keys))
+    return callback
+
+
+def checkpoint_states():
+    """Write the current state to STATE_SNAPSHOT_PATH atomically if anything changed."""
+    global _checkpointed_version
+    with _lock:
+        if _version == _checkpointed_version:
+            return False
+        version = _version
+        snapshot = {key: [entry.value, entry.timestamp] for key, entry in _entries.items()}
+
+    tmp_path = STATE_SNAPSHOT_PATH + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"version": version, "states": snapshot}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, STATE_SNAPSHOT_PATH)
+    _checkpointed_version = version
+    return True
+
+def restore_states():
+    """Warm start: load the last checkpoint so LED colours and sensor values are known immediately."""
+    global _values, _version, _checkpointed_version
+    try:
+        with open(STATE_SNAPSHOT_PATH) as f:
+            saved = json.load(f)
+    except FileNotFoundError:
+        return 0
+    except (OSError, ValueError) as e:
+        logging.warning(f"[State] Could not read state snapshot {STATE_SNAPSHOT_PATH}: {e}")
+        return 0
+
+    restored = []
+    with _lock:
+        for key, (value, timestamp) in saved.get("states", {}).items():
+            if key in _entries:
+                continue  # something newer arrived already
+            _version += 1
+            _entries[key] = StateEntry(value, _version, timestamp)
+            restored.append((key, _entries[key]))
+        _values = MappingProxyType({key: entry.value for key, entry in _entries.items()})
+        _checkpointed_version = _version
+        subscribers = list(_subscribers)
+
+    # subscribers see restored values as changes from nothing
+    for key, entry in restored:
+        _notify(subscribers, key, entry.value, None, entry)
+    logging.info(f"[State] Restored {len(restored)} states from {STATE_SNAPSHOT_PATH}")
+    return len(restored)
+
+def _run_checkpointer():
+    while True:
+        time.sleep(STATE_CHECKPOINT_INTERVAL)
+        try:
+            checkpoint_states()
+        except Exception as e:
+            logging.error(f"[State] Checkpoint failed: {e}")
+
+def start_checkpointing():
+    global _checkpoint_thread
+    if _checkpoint_thread is None:
+        _checkpoint_thread = threading.Thread(target=_run_checkpointer, name="state-checkpoint", daemon=True)
+        _checkpoint_thread.start()
+        atexit.register(checkpoint_states)
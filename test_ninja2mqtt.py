@@ -6,15 +6,31 @@ import notifier
 import serialhandler
 import logging.config
 import json
+import random
+import types
+import emulator
 from rfhandler import log_if_suspicious_rf
 
 logging.config.fileConfig("logging.conf")
 
+@pytest.fixture(autouse=True)
+def _keep_test_frames_out_of_production_files(tmp_path, monkeypatch):
+    import historyhandler
+    monkeypatch.setattr(serialhandler, "_capture_disabled", True)
+    # garbage frames notify; discard them instead of posting to Pushover
+    monkeypatch.setattr(notifier, "_dispatcher_wakeup", notifier.drain_notifications)
+    monkeypatch.setattr(historyhandler, "HISTORY_DB_PATH", str(tmp_path / "history.sqlite"))
+    monkeypatch.setattr(historyhandler, "_recording", False)
+
 def test_config_loaded():
     assert hasattr(config, 'MQTT_BROKER')
 
 def test_utils_import():
-    assert callable(getattr(utils, 'parse_sensor_data', lambda: None))
+    assert callable(utils.is_int)
+
+def test_rfhandler_import():
+    import rfhandler
+    assert callable(rfhandler.parse_sensor_data)
 
 def test_logger_setup():
     assert hasattr(logger, 'logging')
@@ -31,4 +47,672 @@ def test_serialhandler_mock():
     {"DEVICE": [{"G": "0", "V": 5, "D": 11, "DA": "garbage"}]},
 ])
 def test_suspicious_detection(payload):
-    log_if_suspicious_rf(payload, raw_line=json.dumps(payload))
\ No newline at end of file
+    log_if_suspicious_rf(payload, raw_line=json.dumps(payload))
+class FakeMqttClient:
+    def __init__(self):
+        self.published = []
+
+    def is_connected(self):
+        return True
+
+    def publish(self, topic, payload, *args, **kwargs):
+        self.published.append((topic, payload))
+        return types.SimpleNamespace(rc=0, mid=len(self.published))
+
+def test_every_device_in_frame_is_dispatched():
+    client = FakeMqttClient()
+    frame = {"DEVICE": [
+        {"G": "0", "V": 0, "D": 999, "DA": "00FF00"},
+        {"G": "0", "V": 0, "D": 1007, "DA": "000000"},
+    ]}
+    serialhandler.handle_frame(client, json.dumps(frame).encode())
+    assert ("ninjaCape/input/999", "0,255,0") in client.published
+    assert ("ninjaCape/input/1007/on", "false") in client.published
+
+def test_line_framer_splits_chunks_and_discards_overlong_lines():
+    framer = serialhandler.LineFramer()
+    assert framer.feed(b'{"DEVICE": [{"D": 1,') == []
+    assert framer.feed(b' "DA": "2"}]}\n\n   \n{"ACK"') == [b'{"DEVICE": [{"D": 1, "DA": "2"}]}']
+    assert framer.feed(b': 1}\r\n\r\n') == [b'{"ACK": 1}\r']  # CR is left for handle_frame's strip()
+    assert json.loads(b'{"ACK": 1}\r') == {"ACK": 1}
+
+    before = serialhandler.get_serial_stats()["overlong"]
+    assert framer.feed(b"x" * (config.SERIAL_MAX_FRAME_BYTES + 1)) == []
+    assert serialhandler.get_serial_stats()["overlong"] == before + 1
+    assert framer.buffer == bytearray()
+    assert framer.feed(b"\n{}\n") == [b"{}"]
+
+def test_parse_sensor_data_fields():
+    from rfhandler import parse_sensor_data
+    reading = parse_sensor_data(str(0x14463210))
+    assert reading.valid
+    assert (reading.house, reading.station, reading.humidity, reading.temperature) == (1, 2, 70, 0.1)
+    assert not parse_sensor_data("garbage").valid
+
+def test_scalar_decode_follows_the_field_spec():
+    from rfhandler import PROTOCOL_5, decode_protocol_5
+    for word in random.Random(8).choices(range(1 << 32), k=200):
+        reading = decode_protocol_5(word)
+        for name in ("house", "station", "humidity", "id", "unknown"):
+            assert getattr(reading, name) == PROTOCOL_5[name].extract(word)
+        whole = PROTOCOL_5["temperature"].extract(word)
+        assert whole <= reading.temperature < whole + 1
+
+def test_decode_batch_matches_scalar():
+    np = pytest.importorskip("numpy")
+    from rfhandler import decode_batch, parse_sensor_data
+    words = [0x14463210, 0x30000000, 0xFFFFFFFF, 0x1046A5F3]
+    batch = decode_batch(words)
+    for i, word in enumerate(words):
+        reading = parse_sensor_data(str(word))
+        assert bool(batch["valid"][i]) == reading.valid
+        assert batch["temperature"][i] == pytest.approx(reading.temperature)
+        for name in ("house", "station", "humidity", "id", "unknown"):
+            assert batch[name][i] == getattr(reading, name)
+
+def test_publish_filter_window_deadband_heartbeat():
+    from publishfilter import PublishFilter
+    f = PublishFilter({31: {"window": 300, "deadband": 0.2, "heartbeat": 900}}, max_entries=2)
+    topic = "ninjaCape/input/31"
+    assert f.should_publish(topic, 20.0, 31, now=0)
+    assert not f.should_publish(topic, 20.0, 31, now=10)     # duplicate
+    assert not f.should_publish(topic, 20.1, 31, now=20)     # inside deadband
+    assert f.should_publish(topic, 20.3, 31, now=30)
+    assert f.should_publish(topic, 20.3, 31, now=1000)       # heartbeat
+    assert f.should_publish("other/topic", "x", None, now=0)  # no rule
+    assert f.stats()["suppressed_deadband"] == 1
+
+def test_publish_filter_cache_is_bounded():
+    from publishfilter import PublishFilter
+    f = PublishFilter({"a": {"window": 60}, "b": {"window": 60}, "c": {"window": 60}}, max_entries=2)
+    for topic in ("a", "b", "c"):
+        f.should_publish(topic, "1", now=0)
+    assert f.stats()["cached"] == 2
+    assert f.stats()["evicted"] == 1
+
+def test_publish_buffers_while_disconnected():
+    import mqtthandler
+    client = FakeMqttClient()
+    client.is_connected = lambda: False
+    mqtthandler.publish_payload(client, "ninjaCape/input/5", "a", dev_id=5)
+    mqtthandler.publish_payload(client, "ninjaCape/input/5", "b", dev_id=5)
+    assert client.published == []
+    assert mqtthandler._offline_buffer["ninjaCape/input/5"] == ("ninjaCape/input/5", "b")
+
+    client.is_connected = lambda: True
+    mqtthandler._replay_offline_buffer(client)
+    assert client.published == [("ninjaCape/input/5", "b")]
+
+def test_live_publish_wins_over_replay_and_only_qos_acks_count(monkeypatch):
+    import mqtthandler
+    monkeypatch.setattr(mqtthandler, "_unacked", set())
+    client = FakeMqttClient()
+    client.is_connected = lambda: False
+    mqtthandler.publish_payload(client, "ninjaCape/input/6", "old", dev_id=6)
+    client.is_connected = lambda: True  # paho reconnected, on_connect has not replayed yet
+    mqtthandler.publish_payload(client, "ninjaCape/input/6", "new", dev_id=6)
+    mqtthandler.publish_payload(client, "ninjaCape/metrics/test", "{}")  # QoS 0
+    mqtthandler._replay_offline_buffer(client)
+    assert client.published == [("ninjaCape/input/6", "new"), ("ninjaCape/metrics/test", "{}")]
+
+    assert mqtthandler.get_mqtt_stats()["in_flight"] == 1
+    paho = mqtthandler.create_mqtt_client()
+    paho.on_publish(paho, None, 2)  # QoS 0 publish reported by paho
+    assert mqtthandler.get_mqtt_stats()["in_flight"] == 1
+    paho.on_publish(paho, None, 1)
+    assert mqtthandler.get_mqtt_stats()["in_flight"] == 0
+
+@pytest.mark.parametrize("kind", sorted(emulator.DEFAULT_MIX))
+def test_emulator_frames_are_handled(kind):
+    line = emulator.make_frame(kind, random.Random(kind), seq=7)
+    serialhandler.handle_frame(FakeMqttClient(), line.encode())
+
+def test_metrics_histogram_and_prometheus_text():
+    import metrics
+    h = metrics.histogram("test_latency_seconds", buckets=(0.001, 0.01))
+    for value in (0.0005, 0.005, 0.5):
+        h.observe(value)
+    metrics.counter("test_events").inc(3)
+    text = metrics.render_prometheus()
+    assert 'ninja2mqtt_test_latency_seconds_bucket{le="0.01"} 2' in text
+    assert "ninja2mqtt_test_events_total 3" in text
+    assert h.quantile(0.5) == 0.01
+
+def test_state_versions_subscriptions_and_checkpoint(tmp_path, monkeypatch):
+    import statehandler
+    changes = []
+    statehandler.subscribe(lambda key, value, old, entry: changes.append((key, value, old)), keys=["77"])
+    version = statehandler.get_state_version()
+    statehandler.set_state(77, "a")
+    statehandler.set_state("77", "a")  # unchanged: no new version, no callback
+    statehandler.set_state("78", "b")
+    assert changes == [("77", "a", None)]
+    assert statehandler.get_changes_since(version)[1] == {"77": "a", "78": "b"}
+
+    monkeypatch.setattr(statehandler, "STATE_SNAPSHOT_PATH", str(tmp_path / "states.json"))
+    assert statehandler.checkpoint_states()
+    saved = json.loads((tmp_path / "states.json").read_text())
+    assert saved["states"]["77"][0] == "a"
+
+def test_scheduler_follows_led_state_including_warm_start(tmp_path, monkeypatch):
+    import scheduler
+    import statehandler
+    statehandler.set_state(config.STATUS_LED_ID, "0,255,0")
+    assert scheduler.get_led_colors()[0] == "00FF00"  # pushed by the subscription, not read back
+
+    snapshot = tmp_path / "states.json"
+    snapshot.write_text(json.dumps({"version": 3, "states": {"restored/7": ["12.5", 1000.0]}}))
+    monkeypatch.setattr(statehandler, "STATE_SNAPSHOT_PATH", str(snapshot))
+    restored = []
+    statehandler.subscribe(lambda key, value, old, entry: restored.append((key, value, old)), keys=["restored/7"])
+    assert statehandler.restore_states() == 1
+    assert restored == [("restored/7", "12.5", None)]
+
+def test_asyncio_ingest_publishes_emulated_frames(monkeypatch):
+    import asyncio
+    import asyncruntime
+    import serial
+    cape = emulator.NinjaCapeEmulator(mix={"probe": 1}, seed=3)
+    broker = emulator.FakeBroker()
+    bridged = serialhandler.default_cape
+    monkeypatch.setattr(bridged, "ser", serial.Serial(cape.port, config.BAUD_RATE, timeout=0))
+    monkeypatch.setattr(bridged, "writer_wakeup", None)
+
+    async def run():
+        ingest = asyncio.ensure_future(asyncruntime.run_ingest(broker))
+        cape.start(count=20, rate=0)
+        while len(broker.probe_arrivals()) < 20:
+            await asyncio.sleep(0.01)
+        ingest.cancel()
+
+    try:
+        asyncio.run(asyncio.wait_for(run(), 5))
+    finally:
+        cape.close()
+    assert len(broker.probe_arrivals()) == 20
+
+def test_second_cape_uses_its_own_namespace():
+    import statehandler
+    cape = serialhandler.Cape("rf2", "/dev/null", "rf2", status_led_id=900, eyes_led_id=901, state_namespace="rf2")
+    client = FakeMqttClient()
+    frame = {"DEVICE": [
+        {"G": "0", "V": 0, "D": 900, "DA": "FF0000"},
+        {"G": "0", "V": 0, "D": 1, "DA": "21.5"},
+    ]}
+    serialhandler.handle_frame(client, json.dumps(frame).encode(), cape)
+    assert ("rf2/input/900", "255,0,0") in client.published
+    assert ("rf2/input/900/on", "true") in client.published
+    assert statehandler.get_state("rf2/1") == "21.5"
+
+def test_window_aggregator_keeps_mean_and_extremes():
+    from aggregator import WindowAggregator
+    agg = WindowAggregator(60)
+    def point(temp):
+        return {"measurement": "readings", "tags": {"sensor_id": "1"}, "fields": {"temperature": temp}}
+    assert agg.add(point(20.0), now=120) == []
+    assert agg.add(point(23.0), now=150) == []
+    closed = agg.add(point(19.0), now=185)  # next window closes the first
+    assert closed[0]["fields"] == {"count": 2, "temperature": 21.5, "temperature_min": 20.0, "temperature_max": 23.0}
+    assert closed[0]["time"] == "1970-01-01T00:02:00+00:00"
+    assert agg.expire(now=239) == []
+    assert agg.expire(now=240)[0]["fields"]["count"] == 1
+
+def test_rf_burst_copies_are_collapsed():
+    import time
+    frame = json.dumps(emulator.rf_weather_frame(random.Random(18))).encode()
+    before = serialhandler.get_rf_burst_stats()["collapsed"]
+    for _ in range(3):
+        serialhandler.handle_frame(FakeMqttClient(), frame)
+    assert serialhandler.get_rf_burst_stats()["collapsed"] - before == 2
+    closed = dict((key[3], copies) for key, copies in serialhandler._bursts.closed(time.monotonic() + 10))
+    assert closed[json.loads(frame)["DEVICE"][0]["DA"]] == 3
+
+def test_suspicious_channel_is_rate_limited():
+    record = lambda: logging.LogRecord("suspicious", logging.WARNING, __file__, 0, "odd frame %s", ("x",), None)
+    limiter = logger.RateLimitFilter(rate=2, period=60)
+    passed = [limiter.filter(record()) for _ in range(5)]
+    assert passed == [True, True, False, False, False]
+    limiter._window_start -= 60
+    late = record()
+    assert limiter.filter(late)
+    assert late.getMessage() == "odd frame x [3 earlier messages suppressed]"
+
+def test_frame_ring_wraps_and_replays(tmp_path, monkeypatch):
+    import influxhandler
+    import replay
+    monkeypatch.setattr(influxhandler, "_writer_wakeup", influxhandler._writer_wakeup)
+    monkeypatch.setattr(notifier, "_dispatcher_wakeup", notifier._dispatcher_wakeup)
+    from framecapture import FrameRing
+    ring = FrameRing(str(tmp_path / "frames.ring"), capacity=400)
+    for seq in range(50):
+        line = json.dumps({"DEVICE": [{"G": "0", "V": 0, "D": 1, "DA": f"{seq}.5"}]}).encode()
+        assert ring.append(line, 1000.0 + seq)
+    kept = list(ring.records())
+    assert 0 < len(kept) < 50
+    assert [ts for ts, _, _ in kept] == [1000.0 + seq for seq in range(50 - len(kept), 50)]
+
+    client = replay.DryRunClient()
+    counts = replay.replay(FrameRing(ring.path, readonly=True), client, since=1045)
+    assert counts["frames"] == 5
+    assert client.topics["ninjaCape/input/1"] == 5
+
+def test_replay_filters_publishes_on_capture_time(tmp_path, monkeypatch):
+    import time
+    import influxhandler
+    import mqtthandler
+    import replay
+    from framecapture import FrameRing
+    from publishfilter import PublishFilter
+    monkeypatch.setattr(influxhandler, "_writer_wakeup", influxhandler._writer_wakeup)
+    monkeypatch.setattr(notifier, "_dispatcher_wakeup", notifier._dispatcher_wakeup)
+    monkeypatch.setattr(mqtthandler, "publish_filter", PublishFilter({"ninjaCape/input/1": {"window": 300}}))
+    ring = FrameRing(str(tmp_path / "frames.ring"), capacity=4096)
+    line = json.dumps({"DEVICE": [{"G": "0", "V": 0, "D": 1, "DA": "7"}]}).encode()
+    for ts in (1000.0, 1010.0, 1400.0, 1410.0, 1800.0):
+        ring.append(line, ts)
+
+    client = replay.DryRunClient()
+    replay.replay(FrameRing(ring.path, readonly=True), client)
+    # one publish per 300 s window of capture time, however fast the replay ran
+    assert client.topics["ninjaCape/input/1"] == 3
+    assert mqtthandler.publish_filter.clock is time.time
+
+def test_topic_router_captures_and_counts_unmatched():
+    from topicrouter import TopicRouter
+    calls = []
+    router = TopicRouter()
+    router.add("ninjaCape/output/{device_id:int}", lambda payload, device_id: calls.append(("rgb", device_id, payload)))
+    router.add("ninjaCape/output/{device_id:int}/on", lambda payload, device_id: calls.append(("on", device_id, payload)))
+    router.add("ninjaCape/debug/blink/1007", lambda payload: calls.append(("1007", payload)))
+    router.add("ninjaCape/debug/blink/+", lambda payload: calls.append(("blink", payload)))
+
+    assert router.dispatch("ninjaCape/output/999", "FF0000")
+    assert router.dispatch("ninjaCape/output/999/on", "false")
+    assert router.dispatch("ninjaCape/debug/blink/1007", "")
+    assert router.dispatch("ninjaCape/debug/blink/now", "3")
+    assert not router.dispatch("ninjaCape/output/lamp", "FF0000")
+    assert not router.dispatch("ninjaCape/output/999/off", "true")
+    assert calls == [("rgb", 999, "FF0000"), ("on", 999, "false"), ("1007", ""), ("blink", "3")]
+    assert router.stats()["unmatched"] == 2
+    with pytest.raises(ValueError):
+        router.add("ninjaCape/output/{name}", print)
+
+def test_timer_service_dst_rules_and_missed_runs():
+    import time
+    from datetime import datetime
+    from zoneinfo import ZoneInfo
+    from timerservice import TimerService, daily_at, hourly_at, MISSED_SKIP
+    tz = ZoneInfo("Australia/Melbourne")
+    before_dst = daily_at(7, 31)(datetime(2026, 10, 3, 8, 0, tzinfo=tz))
+    assert (before_dst.hour, before_dst.utcoffset().seconds // 3600) == (7, 11)
+    repeated = hourly_at(0)(datetime(2026, 4, 5, 2, 10, tzinfo=tz))  # clocks go back at 03:00
+    assert (repeated.hour, repeated.fold) == (2, 1)
+
+    timers = TimerService()
+    timers.attach_driver(lambda: None)
+    calls = []
+    timers.call_at(time.monotonic() - 1, lambda: calls.append("once"))
+    late = timers.every(10, lambda: calls.append("every"), missed=MISSED_SKIP, first=-120)
+    deadline = timers.run_due()
+    assert calls == ["once"]
+    assert timers.stats()["skipped"] == 1
+    assert late.due == deadline and 0 < deadline - time.monotonic() <= 10
+
+def test_serial_link_reconnects_and_resyncs_leds(monkeypatch):
+    import seriallink
+    import statehandler
+
+    class FakePort:
+        def write(self, data):
+            return len(data)
+
+        def close(self):
+            pass
+
+    attempts = []
+    def open_port(port, baud, timeout):
+        attempts.append(port)
+        if len(attempts) == 1:
+            raise OSError("no such device")
+        return FakePort()
+    monkeypatch.setattr(seriallink.serial, "Serial", open_port)
+
+    cape = serialhandler.Cape("link", "/dev/ttyFAKE", "link", status_led_id=950, eyes_led_id=951,
+                              state_namespace="link")
+    cape.writer_wakeup = lambda: None
+    assert not cape.link.try_open()
+    cape.link._next_attempt = 0.0
+    assert cape.link.try_open() and cape.link.state == seriallink.CONNECTED
+
+    for _ in range(config.SERIAL_ERROR_LIMIT):
+        cape.link.failed(OSError("I/O error"))
+    assert cape.ser is None and cape.link.state == seriallink.RECONNECTING
+
+    statehandler.set_state("link/950", "0,255,0")
+    serialhandler.send_ninjacape_messages(json.dumps({"DEVICE": [{"G": "0", "V": 0, "D": 951, "DA": "FF0000"}]}), cape)
+    assert cape.link.try_open()
+    assert cape.link.stats()["reconnects"] == 1
+    assert cape.pending_devices["950"]["DA"] == "00FF00"  # re-sent from the state store
+    assert cape.pending_devices["951"]["DA"] == "FF0000"  # buffered during the outage, not overwritten
+
+def test_rf_sensors_get_own_topics_and_unknown_are_quarantined(monkeypatch):
+    import devicehandlers
+    from sensorregistry import SensorRegistry
+    registry = SensorRegistry({(1, 1, None): {"name": "outdoor", "legacy": True}, (2, 1, 3): {"name": "shed"}})
+    monkeypatch.setattr(devicehandlers, "sensor_registry", registry)
+
+    def frame(house, sensor_id):
+        word = (house << 28) | (40 << 16) | (70 << 8) | sensor_id
+        return {"G": "0", "V": 5, "D": 11, "DA": str(word)}
+
+    client = FakeMqttClient()
+    for house, sensor_id in ((1, 7), (2, 3), (5, 1), (5, 1)):
+        devicehandlers.handle_rf_weather(client, frame(house, sensor_id), "", serialhandler.default_cape)
+    topics = [topic for topic, _ in client.published]
+    assert topics == ["ninjaCape/input/31", "ninjaCape/input/30",
+                      "ninjaCape/input/rf/shed/temperature", "ninjaCape/input/rf/shed/humidity"]
+    assert registry.quarantined()[(5, 1, 1)]["frames"] == 2
+
+def test_history_rollups_query_and_bounds(tmp_path, monkeypatch):
+    import time
+    import historyhandler
+    monkeypatch.setattr(historyhandler, "_conn", None)
+    monkeypatch.setattr(historyhandler, "_series_ids", {})
+    monkeypatch.setattr(historyhandler, "_buffer", [])
+    monkeypatch.setattr(historyhandler, "_recording", True)
+    monkeypatch.setattr(historyhandler, "_started", True)  # flushed by hand, no timer jobs
+
+    base = 472222 * 3600  # on an hour boundary
+    for i in range(240):  # two hours, every 30s, flushed in two batches that share buckets
+        historyhandler.record_reading("31", i % 10, ts=base + i * 30)
+        if i == 100:
+            historyhandler.flush()
+    historyhandler.record_reading("31", "not a number", ts=base)
+    historyhandler.flush()
+
+    tier, hours, _ = historyhandler.query("31", base, base + 7200, resolution="1h")
+    assert tier == "1h" and [(ts, mn, mx, n) for ts, _, mn, mx, n in hours] == [(base, 0, 9, 120), (base + 3600, 0, 9, 120)]
+    tier, minutes, _ = historyhandler.query("31", base + 90, base + 600, resolution="1m")
+    assert [row[0] for row in minutes] == list(range(base + 60, base + 601, 60)) and minutes[0][4] == 2
+    assert historyhandler.choose_tier(base, base + 3600, now=base + 7200) == "raw"
+    assert historyhandler.choose_tier(base, base + 10 * 86400, now=base + 11 * 86400) == "1h"
+    assert historyhandler.choose_tier(base, base + 86400, now=base + 3 * 86400) == "1m"
+
+    response = json.loads(historyhandler.handle_query(json.dumps(
+        {"id": 7, "series": "31", "start": base, "end": base + 60, "resolution": "raw"})))
+    assert response["id"] == 7 and [point[1] for point in response["points"]] == [0, 1, 2]
+    assert "error" in json.loads(historyhandler.handle_query('{"series": "31", "resolution": "5m"}'))
+    assert historyhandler._parse_time("2026-01-01T10:00", None) == 1767222000  # AEDT, not the host's zone
+
+    monkeypatch.setattr(historyhandler, "HISTORY_QUERY_MAX_POINTS", 5)
+    tier, rows, truncated = historyhandler.query("31", base, base + 600, resolution="raw")
+    assert truncated and [row[0] for row in rows] == [base + i * 30 for i in range(5)]
+    recent = int(time.time()) // 60 * 60 - 600
+    for i in range(7):
+        historyhandler.record_reading("32", i, ts=recent + i * 30)
+    tier, rows, truncated = historyhandler.query("32", recent, recent + 180, resolution="auto")
+    assert (tier, len(rows), truncated) == ("1m", 4, False)  # too many raw rows, answered from minutes
+    monkeypatch.setattr(historyhandler, "HISTORY_QUERY_MAX_POINTS", 1500)
+
+    historyhandler.prune(now=base + 3 * 86400)  # past raw retention, rollups kept
+    assert historyhandler.query("31", base, base + 7200, resolution="raw")[1] == []
+    assert len(historyhandler.query("31", base, base + 7200, resolution="1m")[1]) == 120
+
+    for i in range(20000):
+        historyhandler.record_reading("30", i, ts=base + 3 * 86400 + i)
+        if i % 5000 == 4999:
+            historyhandler.flush()
+    monkeypatch.setattr(historyhandler, "HISTORY_MAX_BYTES", 200 * 1024)
+    historyhandler.prune(now=base + 3 * 86400 + 20000)
+    stats = historyhandler.get_history_stats()
+    assert stats["trimmed_rows"] > 0 and stats["used_bytes"] <= 200 * 1024
+    assert historyhandler.query("30", base + 3 * 86400 + 19990, None, resolution="raw")[1][-1][1] == 19999  # newest kept
+
+def test_failed_influx_batches_are_spooled_and_replayed(tmp_path, monkeypatch):
+    import influxhandler
+    spool = tmp_path / "spool.jsonl"
+    monkeypatch.setattr(influxhandler, "INFLUX_SPOOL_PATH", str(spool))
+    monkeypatch.setattr(influxhandler, "INFLUX_BATCH_SIZE", 2)
+    monkeypatch.setattr(influxhandler, "_replay_after", 0.0)
+    monkeypatch.setattr(influxhandler, "_replay_delay", 0.0)
+    written = []
+
+    class FakeInflux:
+        up = False
+
+        def write_points(self, points):
+            if not self.up:
+                raise ConnectionError("influx down")
+            written.append(list(points))
+
+    influx = FakeInflux()
+    monkeypatch.setattr(influxhandler, "get_client", lambda: influx)
+    point = lambda n: {"measurement": "readings", "tags": {}, "fields": {"temperature": float(n)}}
+
+    influxhandler._flush([point(1), point(2)])
+    influxhandler._flush([point(3)])
+    assert [json.loads(line)["fields"]["temperature"] for line in spool.read_text().splitlines()] == [1, 2, 3]
+
+    inode = spool.stat().st_ino
+    influxhandler._replay_spool()  # still down: the spool is left alone and replays back off
+    assert spool.stat().st_ino == inode and not influxhandler.replay_due()
+    assert influxhandler._replay_delay == influxhandler.INFLUX_FLUSH_INTERVAL
+    influxhandler._replay_spool()
+    assert influxhandler._replay_delay == 2 * influxhandler.INFLUX_FLUSH_INTERVAL
+
+    influxhandler._replay_after = 0.0
+    influx.up = True
+    influxhandler._flush([point(4)])
+    assert written == [[point(4)], [point(1), point(2)], [point(3)]]  # live batch first, then the spool in chunks
+    assert not spool.exists()
+
+def test_notifier_coalesces_repeats_and_rate_limits_per_category(monkeypatch):
+    monkeypatch.setattr(notifier, "NOTIFY_COALESCE_SECONDS", 60)
+    monkeypatch.setattr(notifier, "NOTIFY_RATE_LIMIT", 2)
+    monkeypatch.setattr(notifier, "NOTIFY_RATE_PERIOD", 3600)
+    posted = []
+    dispatcher = notifier.make_dispatcher(lambda title, message: posted.append(message))
+
+    for now in (0, 5, 10):
+        dispatcher.handle("serial", "Alert", "port lost", now)
+    assert posted == ["port lost"]
+    assert dispatcher.next_deadline() == 60
+    dispatcher.expire(59)
+    dispatcher.expire(60)
+    assert posted == ["port lost", "port lost ×3 in 60s"]
+
+    dispatcher.handle("serial", "Alert", "another", 70)  # third in the category this hour
+    dispatcher.handle("mqtt", "Alert", "another", 70)    # other categories have their own budget
+    assert posted == ["port lost", "port lost ×3 in 60s", "another"]
+    dispatcher.handle("serial", "Alert", "later", 3600)
+    assert posted[-1] == "later"
+
+def test_persisted_state_writes_behind_and_imports_legacy_shelf(tmp_path, monkeypatch):
+    import pickle
+    import shelve
+    import sqlite3
+    import persisthandler
+    shelf_path = str(tmp_path / "state.db")
+    with shelve.open(shelf_path) as db:
+        db["999"] = "0,255,0"
+    monkeypatch.setattr(persisthandler, "SHELF_PATH", shelf_path)
+    monkeypatch.setattr(persisthandler, "PERSIST_DB_PATH", str(tmp_path / "state.sqlite"))
+    monkeypatch.setattr(persisthandler, "PERSIST_FLUSH_INTERVAL", 3600)
+    monkeypatch.setattr(persisthandler, "_conn", None)
+    monkeypatch.setattr(persisthandler, "_cache", {})
+    monkeypatch.setattr(persisthandler, "_dirty", {})
+
+    assert persisthandler.get_persisted_state("999") == "0,255,0"  # imported on first open
+    persisthandler.set_persisted_state("31", 21.5)
+    persisthandler.delete_persisted_state("999")
+
+    def stored():
+        with sqlite3.connect(str(tmp_path / "state.sqlite")) as db:
+            return {key: pickle.loads(value) for key, value in db.execute("SELECT key, value FROM state")}
+    assert stored() == {"999": "0,255,0"}  # nothing committed until the flush
+    persisthandler.flush_persisted_states()
+    assert stored() == {"31": 21.5}
+
+def test_serial_writes_coalesce_per_device_and_are_paced(monkeypatch):
+    class FakePort:
+        def __init__(self):
+            self.lines = []
+
+        def write(self, data):
+            self.lines.append(data)
+            return len(data)
+
+    cape = serialhandler.Cape("pace", "/dev/null", "pace", status_led_id=960, eyes_led_id=961, state_namespace="pace")
+    cape.writer_wakeup = lambda: None
+    cape.ser = FakePort()
+    device = lambda dev_id, colour: json.dumps({"DEVICE": [{"G": "0", "V": 0, "D": dev_id, "DA": colour}]})
+    for dev_id, colour in ((960, "FF0000"), (961, "00FF00"), (960, "0000FF"), (960, "FFFFFF")):
+        serialhandler.send_ninjacape_messages(device(dev_id, colour), cape)
+    assert cape.write_stats["coalesced"] == 2
+
+    command = serialhandler.pop_next_write(cape)
+    assert json.loads(command)["DEVICE"] == [{"G": "0", "V": 0, "D": 960, "DA": "FFFFFF"}]  # latest wins, first slot kept
+    delay = serialhandler.write_command(cape, command)
+    assert delay == pytest.approx((len(command) + 1) * 10 / cape.baud + config.SERIAL_WRITE_GAP)
+    assert cape.ser.lines == [(command + "\n").encode()]
+
+    monkeypatch.setattr(serialhandler, "SERIAL_PACK_DEVICES", True)
+    serialhandler.send_ninjacape_messages(device(962, "000000"), cape)
+    assert [entry["D"] for entry in json.loads(serialhandler.pop_next_write(cape))["DEVICE"]] == [961, 962]
+    assert serialhandler.pop_next_write(cape) is None
+
+def test_animator_preempt_and_restore_inheritance():
+    from animator import Animator, Timeline
+    sent = []
+    animator = Animator(lambda dev, colour: sent.append((dev, colour)))
+    animator.attach_driver(lambda: None)
+
+    first = animator.play(Timeline().set(1, "FF0000", hold=5).set(2, "FF0000", hold=5)
+                          .build("first", restore={1: "111111", 2: "222222"}))
+    animator.run_due()
+    assert sent == [(1, "FF0000")]
+    # the replacement takes over the pre-animation colours of the LEDs it shares
+    second = animator.play(Timeline().set(1, "00FF00", hold=5).build("second", restore={1: "00FF00"}))
+    assert first.cancelled and first.done.is_set()
+    assert second.restore == {1: "111111"}
+    assert sent == [(1, "FF0000"), (2, "222222")]
+
+    sent.clear()
+    animator.run_due()
+    animator.preempt(1)  # an explicit colour on LED 1 ends the animation without restoring LED 1
+    assert sent == [(1, "00FF00")] and second.done.is_set()
+    assert not animator.is_animating()
+
+def test_rf_repeats_are_reported_per_registered_sensor(monkeypatch):
+    import time
+    import devicehandlers
+    from sensorregistry import SensorRegistry
+    registry = SensorRegistry({(2, 1, 3): {"name": "shed"}})
+    monkeypatch.setattr(devicehandlers, "sensor_registry", registry)
+    monkeypatch.setattr(serialhandler, "sensor_registry", registry)
+
+    def frame(house, temperature):
+        word = (house << 28) | (temperature << 16) | (70 << 8) | 3
+        return json.dumps({"DEVICE": [{"G": "0", "V": 5, "D": 11, "DA": str(word)}]}).encode()
+
+    client = FakeMqttClient()
+    start = time.monotonic() + 100  # clear of bursts left open by other tests
+    for copy in range(3):
+        serialhandler.handle_frame(client, frame(2, 41), received_at=start + copy * 0.1)
+    for copy in range(2):
+        serialhandler.handle_frame(client, frame(6, 42), received_at=start + copy * 0.1)  # a neighbour's sensor
+    serialhandler.handle_frame(client, json.dumps({"DEVICE": []}).encode(), received_at=start + 5)
+
+    assert [(topic, copies) for topic, copies in client.published if topic.endswith("/repeats")] == [
+        ("ninjaCape/input/rf/shed/repeats", 3)]
+    assert serialhandler.get_rf_burst_stats()["link_quality_ninjaCape_shed"] == 3
+
+def test_lone_rf_sensor_repeats_are_reported_by_the_timer(monkeypatch):
+    import time
+    import devicehandlers
+    from rfhandler import BurstCollapser
+    from sensorregistry import SensorRegistry
+    registry = SensorRegistry({(3, 1, 3): {"name": "garage"}})
+    monkeypatch.setattr(devicehandlers, "sensor_registry", registry)
+    monkeypatch.setattr(serialhandler, "sensor_registry", registry)
+    monkeypatch.setattr(serialhandler, "_bursts", BurstCollapser(0.05))
+
+    word = (3 << 28) | (41 << 16) | (70 << 8) | 3
+    frame = json.dumps({"DEVICE": [{"G": "0", "V": 5, "D": 11, "DA": str(word)}]}).encode()
+    client = FakeMqttClient()
+    for _ in range(2):
+        serialhandler.handle_frame(client, frame)
+    # no later frame arrives: the burst is closed and reported on the timer thread
+    deadline = time.monotonic() + 5
+    while ("ninjaCape/input/rf/garage/repeats", 2) not in client.published and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert ("ninjaCape/input/rf/garage/repeats", 2) in client.published
+
+def test_stall_reopen_only_notifies_when_the_port_is_gone(monkeypatch):
+    import seriallink
+    sent = []
+    monkeypatch.setattr(seriallink, "send_notification", lambda message, **kwargs: sent.append(message))
+    ports = {"present": True}
+
+    class FakePort:
+        def close(self):
+            pass
+
+    def open_port(port, baud, timeout):
+        if not ports["present"]:
+            raise OSError("no such device")
+        return FakePort()
+    monkeypatch.setattr(seriallink.serial, "Serial", open_port)
+
+    cape = serialhandler.Cape("quiet", "/dev/ttyQUIET", "quiet", status_led_id=970, eyes_led_id=971,
+                              state_namespace="quiet")
+    cape.writer_wakeup = lambda: None
+    link = cape.link
+    assert link.try_open()
+    assert link.check_stall(now=link.last_rx + config.SERIAL_STALL_SECONDS + 1)
+    assert link.try_open() and link.stats()["reconnects"] == 1
+    assert sent == []  # sensors just went quiet
+
+    ports["present"] = False
+    assert link.check_stall(now=link.last_rx + config.SERIAL_STALL_SECONDS + 1)
+    assert not link.try_open()
+    assert sent == [f"Serial link quiet lost: nothing received for {config.SERIAL_STALL_SECONDS + 1}s, "
+                    "reopen failed: no such device"]
+    ports["present"] = True
+    link._next_attempt = 0.0
+    assert link.try_open()
+    assert sent[-1].startswith("Serial link quiet restored")
+
+def test_history_failures_stay_off_the_ingest_path(tmp_path, monkeypatch):
+    import devicehandlers
+    import historyhandler
+    import influxhandler
+    monkeypatch.setattr(historyhandler, "HISTORY_DB_PATH", str(tmp_path / "missing" / "history.sqlite"))
+    monkeypatch.setattr(historyhandler, "_conn", None)
+    monkeypatch.setattr(historyhandler, "_series_ids", {})
+    monkeypatch.setattr(historyhandler, "_buffer", [])
+    monkeypatch.setattr(historyhandler, "_recording", True)
+    monkeypatch.setattr(historyhandler, "_retry_after", 0.0)
+    monkeypatch.setattr(historyhandler, "_retry_delay", 0.0)
+    monkeypatch.setattr(historyhandler, "_started", True)
+    monkeypatch.setattr(influxhandler, "_writer_wakeup", lambda: None)
+    influxhandler.drain_points(limit=float("inf"))
+
+    word = (1 << 28) | (40 << 16) | (70 << 8) | 1
+    devicehandlers.handle_rf_weather(FakeMqttClient(), {"G": "0", "V": 5, "D": 11, "DA": str(word)}, "",
+                                     serialhandler.default_cape)
+    assert len(influxhandler.drain_points()) == 1
+    historyhandler.flush()  # cannot open the store: the readings wait for a retry
+    stats = historyhandler.get_history_stats()
+    assert stats["failures"] == 1 and stats["buffered"] == 2 and stats["retry_in"] > 0
+    response = json.loads(historyhandler.handle_query('{"id": 1, "series": "31"}'))
+    assert response["id"] == 1 and response["error"].startswith("history unavailable")
+
+    (tmp_path / "missing").mkdir()
+    historyhandler.flush()  # still backing off
+    assert historyhandler.get_history_stats()["buffered"] == 2
+    historyhandler._retry_after = 0.0
+    historyhandler.flush()
+    stats = historyhandler.get_history_stats()
+    assert stats["buffered"] == 0 and stats["retry_in"] == 0
+    assert historyhandler.query("31", 0, resolution="raw")[1][0][1] == 20.0
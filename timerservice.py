@@ -0,0 +1,281 @@
+# timerservice.py
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+from config import TIMER_GRACE, TIMER_CLOCK_CHECK
+import metrics
+
+# One heap of deadlines for everything timed in the bridge: the LED schedule, animation
+# steps and the Influx window flushes. A single thread (or the asyncio loop, through
+# attach_driver/run_due) sleeps until the earliest deadline instead of polling.
+#
+# Deadlines are kept on the monotonic clock. Wall-clock jobs also remember the wall time
+# they are for; when the wall clock is stepped (NTP at boot, manual changes) their
+# deadlines are moved to match, and the next occurrence is recomputed in the job's
+# timezone after every firing, so DST changes are picked up without a restart.
+
+MISSED_RUN = "run"    # a job that is late by more than its grace still runs, once
+MISSED_SKIP = "skip"  # ... or is skipped until its next occurrence
+
+_job_seconds = metrics.histogram("timer_job_seconds")
+
+
+def daily_at(hour, minute=0, second=0):
+    """Rule for a job at a local time of day."""
+    def next_after(now):
+        candidate = now.replace(hour=hour, minute=minute, second=second, microsecond=0)
+        if candidate.timestamp() <= now.timestamp():
+            # same-zone arithmetic is on the wall clock, so this is 'tomorrow, same time'
+            candidate = (candidate + timedelta(days=1)).replace(hour=hour, minute=minute, second=second)
+        return candidate
+    return next_after
+
+
+def hourly_at(minute, second=0):
+    """Rule for a job at a minute past every (local) hour."""
+    def next_after(now):
+        candidate = now.replace(minute=minute, second=second, microsecond=0)
+        # comparisons within one zone ignore the UTC offset, so compare instants
+        while candidate.timestamp() <= now.timestamp():
+            # step in absolute time so repeated or skipped hours at DST changes come out right
+            candidate = (candidate.astimezone(timezone.utc) + timedelta(hours=1)).astimezone(now.tzinfo)
+            candidate = candidate.replace(minute=minute, second=second)
+        return candidate
+    return next_after
+
+
+def aligned(seconds):
+    """Rule for a job at every multiple of `seconds` since the epoch."""
+    def next_after(now):
+        stamp = now.timestamp()
+        return datetime.fromtimestamp(stamp - stamp % seconds + seconds, now.tzinfo)
+    return next_after
+
+
+class Job:
+    def __init__(self, func, name, interval=None, rule=None, tz=None, jitter=0.0, missed=MISSED_RUN, grace=None):
+        self.func = func
+        self.name = name or getattr(func, "__name__", "job")
+        self.interval = interval  # seconds between runs of a repeating monotonic job
+        self.rule = rule          # next_after(aware datetime) for wall-clock jobs
+        self.tz = ZoneInfo(tz) if isinstance(tz, str) else tz
+        self.jitter = jitter
+        self.missed = missed
+        self.grace = TIMER_GRACE if grace is None else grace
+        self.base = None          # planned time before jitter (monotonic)
+        self.wall_due = None      # planned wall time (unix seconds), wall-clock jobs only
+        self.due = None           # deadline actually used (monotonic)
+        self.seq = None           # matches the live heap entry; older entries are stale
+        self.cancelled = False
+        self.runs = 0
+
+    def __repr__(self):
+        return f"Job({self.name!r})"
+
+
+class TimerService:
+    def __init__(self, clock_check=TIMER_CLOCK_CHECK):
+        self.clock_check = clock_check
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._wakeup = None
+        self._wall_jobs = set()
+        self._offset = time.time() - time.monotonic()
+        self._counts = {"fired": 0, "skipped": 0, "errors": 0, "clock_steps": 0}
+
+    def attach_driver(self, wakeup):
+        """
+        Drive the service from outside (the asyncio runtime) instead of its own thread:
+        wakeup() is called when the earliest deadline moves, and the driver calls run_due().
+        """
+        self._wakeup = wakeup
+
+    # --- Creating jobs ---
+
+    def job(self, func, name=None):
+        """A one-off job that is not scheduled yet; see schedule()."""
+        return Job(func, name)
+
+    def call_at(self, when, func, name=None):
+        """Run func once at `when` (time.monotonic() clock)."""
+        job = Job(func, name)
+        self.schedule(job, when)
+        return job
+
+    def call_later(self, delay, func, name=None, jitter=0.0):
+        job = Job(func, name, jitter=jitter)
+        self.schedule(job, time.monotonic() + delay)
+        return job
+
+    def every(self, interval, func, name=None, jitter=0.0, missed=MISSED_RUN, grace=None, first=None):
+        """Run func every `interval` seconds, the first time after `first` seconds (default: one interval)."""
+        job = Job(func, name, interval=interval, jitter=jitter, missed=missed, grace=grace)
+        self.schedule(job, time.monotonic() + (interval if first is None else first))
+        return job
+
+    def at(self, rule, func, name=None, tz="UTC", jitter=0.0, missed=MISSED_RUN, grace=None):
+        """Run func at each wall-clock time produced by `rule` (daily_at, hourly_at, aligned) in `tz`."""
+        job = Job(func, name, rule=rule, tz=tz, jitter=jitter, missed=missed, grace=grace)
+        with self._cond:
+            self._wall_jobs.add(job)
+            self._plan_wall(job, time.time())
+            self._push(job)
+        logging.info(f"[Timers] {job.name} first due {datetime.fromtimestamp(job.wall_due, job.tz).isoformat()}")
+        return job
+
+    def schedule(self, job, when, earlier_only=False):
+        """
+        (Re)schedule a job for `when` (monotonic), replacing its pending deadline. With
+        earlier_only, a deadline that is already pending and earlier is kept.
+        """
+        with self._cond:
+            if earlier_only and job.seq is not None and job.due <= when:
+                return
+            job.cancelled = False
+            job.base = when
+            job.due = when + (random.uniform(0, job.jitter) if job.jitter else 0.0)
+            self._push(job)
+
+    def cancel(self, job):
+        with self._cond:
+            job.cancelled = True
+            job.seq = None
+            self._wall_jobs.discard(job)
+
+    # --- Running ---
+
+    def _push(self, job):
+        """Add the job's heap entry and wake whoever sleeps if it is now the earliest; caller holds _cond."""
+        self._drop_stale()
+        job.seq = next(self._seq)
+        heapq.heappush(self._heap, (job.due, job.seq, job))
+        if self._heap[0][2] is job:
+            self._cond.notify()
+            if self._wakeup is not None:
+                self._wakeup()
+            elif self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="timers", daemon=True)
+                self._thread.start()
+
+    def _plan_wall(self, job, after):
+        """Set a wall-clock job's next occurrence after `after` (unix seconds); caller holds _cond."""
+        following = job.rule(datetime.fromtimestamp(after, job.tz))
+        job.wall_due = following.timestamp()
+        job.base = job.wall_due - self._offset
+        job.due = job.base + (random.uniform(0, job.jitter) if job.jitter else 0.0)
+
+    def _check_clock(self):
+        """Move wall-clock deadlines if the wall clock was stepped; caller holds _cond."""
+        offset = time.time() - time.monotonic()
+        if abs(offset - self._offset) < 1.0:
+            return
+        logging.warning(f"[Timers] Wall clock stepped by {offset - self._offset:+.1f}s, moving wall-clock jobs")
+        self._counts["clock_steps"] += 1
+        self._offset = offset
+        for job in self._wall_jobs:
+            jitter = job.due - job.base
+            job.base = job.wall_due - offset
+            job.due = job.base + jitter
+            self._push(job)
+
+    def next_deadline(self):
+        """Earliest deadline (monotonic), or None when nothing is scheduled."""
+        with self._cond:
+            return self._next_deadline()
+
+    def _drop_stale(self):
+        """Pop cancelled or rescheduled entries off the top of the heap; caller holds _cond."""
+        while self._heap and self._heap[0][1] != self._heap[0][2].seq:
+            heapq.heappop(self._heap)
+
+    def _next_deadline(self):
+        self._drop_stale()
+        deadline = self._heap[0][0] if self._heap else None
+        if self._wall_jobs:
+            # wake now and then to notice a stepped wall clock
+            check = time.monotonic() + self.clock_check
+            deadline = check if deadline is None else min(deadline, check)
+        return deadline
+
+    def run_due(self):
+        """Run every job that is due; returns the next deadline (monotonic) or None if idle."""
+        due = []
+        with self._cond:
+            self._check_clock()
+            now = time.monotonic()
+            while self._heap and self._heap[0][0] <= now:
+                _, seq, job = heapq.heappop(self._heap)
+                if seq == job.seq:
+                    job.seq = None
+                    due.append(job)
+
+        for job in due:
+            self._fire(job, now)
+
+        with self._cond:
+            return self._next_deadline()
+
+    def _fire(self, job, now):
+        late = now - job.due
+        if late > job.grace and job.missed == MISSED_SKIP:
+            with self._cond:
+                self._counts["skipped"] += 1
+            logging.warning(f"[Timers] Skipped {job.name}, {late:.0f}s late")
+        else:
+            if late > job.grace:
+                logging.warning(f"[Timers] Running {job.name} {late:.0f}s late")
+            started = time.perf_counter()
+            try:
+                job.func()
+            except Exception as e:
+                with self._cond:
+                    self._counts["errors"] += 1
+                logging.error(f"[Timers] Error in {job.name}: {e}")
+                logging.exception("[Timers] Exception details:")
+            _job_seconds.observe(time.perf_counter() - started)
+            job.runs += 1
+            with self._cond:
+                self._counts["fired"] += 1
+
+        with self._cond:
+            if job.cancelled or job.seq is not None:
+                return  # cancelled, or rescheduled by the job itself
+            if job.rule is not None:
+                self._plan_wall(job, max(job.wall_due, time.time()))
+                self._push(job)
+            elif job.interval is not None:
+                base = job.base + job.interval
+                current = time.monotonic()
+                if base <= current:
+                    # keep the phase, dropping the runs that were missed
+                    base += (current - base) // job.interval * job.interval + job.interval
+                job.base = base
+                job.due = base + (random.uniform(0, job.jitter) if job.jitter else 0.0)
+                self._push(job)
+
+    def _run(self):
+        while True:
+            self.run_due()
+            with self._cond:
+                if self._wakeup is not None:
+                    return
+                deadline = self._next_deadline()
+                self._cond.wait(None if deadline is None else max(0.0, deadline - time.monotonic()))
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._counts)
+            stats["pending"] = sum(1 for _, seq, job in self._heap if seq == job.seq)
+        return stats
+
+
+# The bridge's shared timer service
+timers = TimerService()
+metrics.register_stats("timers", timers.stats)
@@ -0,0 +1,117 @@
+# topicrouter.py
+import logging
+import threading
+from collections import OrderedDict
+import metrics
+
+# Capture types for "{name:type}" segments; a segment that does not convert does not match
+CONVERTERS = {"str": str, "int": int}
+
+_unmatched = metrics.counter("mqtt_unmatched_topics")
+
+
+class _Node:
+    __slots__ = ("children", "wildcard", "name", "convert", "handler")
+
+    def __init__(self):
+        self.children = {}
+        self.wildcard = None  # child node for "+" / "{name}" / "{name:type}"
+        self.name = None  # capture name on a wildcard node (None for a bare "+")
+        self.convert = str
+        self.handler = None
+
+
+class TopicRouter:
+    """
+    Dispatches inbound topics to handlers through a trie of topic segments, built once
+    from route patterns such as
+
+        ninjaCape/output/{device_id:int}/on
+        ninjaCape/debug/blink/+
+
+    A "{name}" or "{name:int}" segment matches any single level and passes it to the
+    handler as a keyword argument, already converted; "+" matches without capturing.
+    Each topic is resolved in one walk: a literal segment wins over the wildcard at the
+    same level, and there is no backtracking. Topics without a route are counted.
+    """
+
+    def __init__(self, max_unmatched=64):
+        self._root = _Node()
+        self.max_unmatched = max_unmatched
+        self._lock = threading.Lock()
+        self._counts = {"routes": 0, "matched": 0, "unmatched": 0}
+        self._unmatched_topics = OrderedDict()  # most recent unmatched topics -> count
+
+    def add(self, pattern, handler):
+        node = self._root
+        for segment in pattern.split("/"):
+            if segment == "+" or (segment.startswith("{") and segment.endswith("}")):
+                name, convert = self._parse_capture(segment)
+                if node.wildcard is None:
+                    node.wildcard = _Node()
+                    node.wildcard.name, node.wildcard.convert = name, convert
+                elif (node.wildcard.name, node.wildcard.convert) != (name, convert):
+                    raise ValueError(f"Route '{pattern}' conflicts with an existing wildcard at '{segment}'")
+                node = node.wildcard
+            else:
+                node = node.children.setdefault(segment, _Node())
+        if node.handler is not None:
+            raise ValueError(f"Duplicate route '{pattern}'")
+        node.handler = handler
+        self._counts["routes"] += 1
+
+    @staticmethod
+    def _parse_capture(segment):
+        if segment == "+":
+            return None, str
+        name, _, type_name = segment[1:-1].partition(":")
+        if type_name and type_name not in CONVERTERS:
+            raise ValueError(f"Unknown capture type '{type_name}' in '{segment}'")
+        return name, CONVERTERS[type_name or "str"]
+
+    def match(self, topic):
+        """(handler, captures) for `topic`, or None."""
+        node = self._root
+        captures = {}
+        for segment in topic.split("/"):
+            child = node.children.get(segment)
+            if child is None:
+                child = node.wildcard
+                if child is None:
+                    return None
+                if child.name is not None:
+                    try:
+                        captures[child.name] = child.convert(segment)
+                    except ValueError:
+                        return None
+            node = child
+        if node.handler is None:
+            return None
+        return node.handler, captures
+
+    def dispatch(self, topic, *args):
+        """Call the handler for `topic` with `args` plus its captures; False if nothing matched."""
+        found = self.match(topic)
+        if found is None:
+            self._record_unmatched(topic)
+            return False
+        with self._lock:
+            self._counts["matched"] += 1
+        handler, captures = found
+        handler(*args, **captures)
+        return True
+
+    def _record_unmatched(self, topic):
+        _unmatched.inc()
+        with self._lock:
+            self._counts["unmatched"] += 1
+            self._unmatched_topics[topic] = self._unmatched_topics.pop(topic, 0) + 1
+            if len(self._unmatched_topics) > self.max_unmatched:
+                self._unmatched_topics.popitem(last=False)
+        logging.debug("[TopicRouter] No route for topic '%s'", topic)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counts)
+            stats["unmatched_topics"] = dict(self._unmatched_topics)
+        return stats